@@ -4,10 +4,13 @@ import numpy as np
 import math
 from isaacgym import gymutil
 from isaacgym.torch_utils import quat_conjugate,quat_mul
+from rng import CAMPAIGN
+from excitation import design
 
 class input():
     """
-    Blueprint class for all control objects, inherited throughout
+    Blueprint class for all control objects, inherited throughout. rng holds the streams of the
+    campaign seed drawn and logged by the generation script, there is no fallback seed
 
             POSSIBLE TO UNITE ACTION AND OSC --- WORK IN PROGRESS
     """
@@ -19,8 +22,10 @@ class input():
                  frequency, 
                  input_type,
                  mass_vector,
-                 args):
+                 args,
+                 rng):
         self.args = args
+        self.rng = rng
         self.num_envs = num_envs
         self.num_iter = num_iter
         self.num_joints = num_joints
@@ -123,6 +128,7 @@ class action(input):
 
     Available trajectories are: 
     sinusoidal: multi-sinusoidal trajectory randomized magnitudes, directions and freqs
+    multisine: crest-factor optimized multisine designed in the frequency domain within the limits
     chirp: chirp trajectory, randomized freqs
     impulse: impulse trajectory with multiple rest and rise regimes
     trapezoidal: trapezoidal velocity profile trajectory with multiple rest and rise regimes
@@ -133,6 +139,10 @@ class action(input):
     num_joints: number of joints of the generic actor in the simulation
     frequency: master frequency of the trajectory - randomized inside the simulation
     input_type: input type of the generation
+    limits: bounds of the multisine, {"peak": (num joints,), "rate": (num joints,), "order": int,
+            "offset": (num joints,)} - the zero-mean design is shifted by offset, e.g. the middle of
+            the joint range for position targets
+    dt: solver time step the trajectory is designed for
     """
 
     def __init__(self,
@@ -143,11 +153,18 @@ class action(input):
                  frequency, 
                  input_type,
                  mass_vector,
-                 args):
-        super().__init__(num_envs, num_iter, num_joints, num_coords, frequency, input_type, mass_vector, args)
+                 args,
+                 rng,
+                 limits=None,
+                 dt=1/60):
+        super().__init__(num_envs, num_iter, num_joints, num_coords, frequency, input_type, mass_vector, args, rng)
+        self.limits = limits if limits is not None else {}
+        self.dt = dt
 
         if self.args.type_of_input == 'MS':
             self.control_action = self.sin()
+        elif self.args.type_of_input == 'OMS':
+            self.control_action = self.multisine()
         elif self.args.type_of_input == 'CH':
             self.control_action = self.chirp()
         elif self.args.type_of_input == "IMP":
@@ -166,65 +183,86 @@ class action(input):
         
     def sin(self):
         """
-        Sinusoidal randomized trajectory
+        Sinusoidal randomized trajectory, every env draws its amplitudes, frequencies and signs
+        from its own excitation stream
         """
-        def sin_signal(self,attenuation_factor):
-            r1,r2 = -1,1
-            a = 2* torch.rand(4).uniform_(-self.frequency*15,self.frequency*15)
-            t = self.t
-            freq = 2 * np.pi * torch.rand(1).uniform_(self.frequency/1.5, self.frequency*1.5)
-            _trajectory =  torch.sign(torch.rand(1).uniform_(r1,r2)) * (a[0]*torch.sin(freq*t) 
-                                + a[1] * torch.cos(freq*1.5*t) + a[2] *torch.sin(freq*2*t) 
-                                +torch.sign(torch.rand(1).uniform_(r1,r2))* a[3] * torch.cos(freq*3*t))/attenuation_factor          
-            trajectory = _trajectory.view(self.num_iter) 
-            return trajectory
+        r1,r2 = -1,1
+        attenuation_factor = np.full(self.num_joints, 1.6) # 1.6 # 3 for real
+        attenuation_factor[1] = 1.3 # 1.3 # 2 for real
+        attenuation_factor[7:] = np.inf
 
+        a, freq, s1, s2 = [], [], [], []
         for i in range(self.num_envs):
-            for j in range(self.num_joints):
-                if j ==8 or j==7:
-                    attenuation_factor = np.inf
-                elif j == 1:
-                    attenuation_factor = 1.3 # 1.3 # 2 for real
-                else:
-                    attenuation_factor = 1.6 # 1.6 # 3 for real               
-                single_dof = sin_signal(self,attenuation_factor)
-                self.control_action[i][j] = single_dof
-                #self.diff_action[i][j][1:] = torch.diff(self.control_action[i][j])      
+            g = self.rng.generator(i, "excitation")
+            a.append(2 * g.uniform(-self.frequency*15, self.frequency*15, (self.num_joints,4)))
+            freq.append(2 * np.pi * g.uniform(self.frequency/1.5, self.frequency*1.5, self.num_joints))
+            s1.append(np.sign(g.uniform(r1, r2, self.num_joints)))
+            s2.append(np.sign(g.uniform(r1, r2, self.num_joints)))
+        a = self.rng.tensor(a).unsqueeze(-1)
+        freq = self.rng.tensor(freq).unsqueeze(-1)
+        s1 = self.rng.tensor(s1).unsqueeze(-1)
+        s2 = self.rng.tensor(s2).unsqueeze(-1)
+        att = self.rng.tensor(attenuation_factor).view(1,self.num_joints,1)
+        t = self.t.view(1,1,self.num_iter)
+
+        self.control_action = s1 * (a[:,:,0]*torch.sin(freq*t)
+                                + a[:,:,1] * torch.cos(freq*1.5*t) + a[:,:,2] *torch.sin(freq*2*t)
+                                + s2 * a[:,:,3] * torch.cos(freq*3*t))/att
         return self.control_action.to(device=self.args.graphics_device_id)
         
+    def multisine(self):
+        """
+        Crest-factor optimized multisine over the band of the MS input up to its third harmonic,
+        scaled to a random fraction of the excitation level of the limits - refer to excitation.py
+        """
+        level = self.args.excitation_level
+        peak = self.limits.get("peak")
+        rate = self.limits.get("rate")
+        self.control_action, crest = design(num_envs=self.num_envs,
+                                            num_joints=self.num_joints,
+                                            num_iter=self.num_iter,
+                                            dt=self.dt,
+                                            band=(self.frequency/1.5, self.frequency*4.5),
+                                            rng=self.rng,
+                                            peak=None if peak is None else level*peak,
+                                            rate=None if rate is None else level*rate,
+                                            rate_order=self.limits.get("order", 1))
+        offset = self.limits.get("offset")
+        if offset is not None:
+            self.control_action = self.control_action + self.rng.tensor(offset).view(1,-1,1)
+        self.control_action[:,7:,:] = 0
+        print(f"Multisine crest factor: mean {crest[:,:7].mean():.3f} max {crest[:,:7].max():.3f}\n")
+        return self.control_action.to(device=self.args.graphics_device_id)
+
     def chirp(self):
         """
-        Chirp-like randomized trajectory
+        Chirp-like randomized trajectory, every env draws its phases, offsets, magnitudes and
+        frequencies from its own excitation stream
         """
-        def chirp_signal(self,attenuation_factor,j):
-            t = self.t
-            phi = torch.rand(1).uniform_(-np.pi,np.pi)
-            q0 = torch.rand(1).uniform_(-.5, .5) 
-            a = torch.rand(1).uniform_(-4,4)    #  [ -3,3]  
-
-            if self.frequency < 0.3:
-                f1 = torch.rand(1).uniform_(self.frequency/1.1,self.frequency*1.5)
-                f2 = torch.rand(1).uniform_(self.frequency/1.5, self.frequency*2)
-            else:
-                f1 = torch.rand(1).uniform_(self.frequency/1.3,self.frequency/1.2)
-                f2 = torch.rand(1).uniform_(self.frequency/1.1,self.frequency*1.1)
-            
-            if j>=7:
-                _trajectory = 0*t
-            else:
-                _trajectory = q0 + torch.sign(torch.rand(1).uniform_(-1,1))* a * torch.cos (2* np.pi * f1 *( 1 + 1/4 * torch.cos(  2 * np.pi * f2* t))*t + phi)
-            trajectory = _trajectory.view(self.num_iter)/attenuation_factor 
-            return trajectory
-        
+        attenuation_factor = np.full(self.num_joints, 2.0) # 1.6 safe
+        attenuation_factor[7:] = np.inf
+        if self.frequency < 0.3:
+            b1 = (self.frequency/1.1,self.frequency*1.5)
+            b2 = (self.frequency/1.5, self.frequency*2)
+        else:
+            b1 = (self.frequency/1.3,self.frequency/1.2)
+            b2 = (self.frequency/1.1,self.frequency*1.1)
+
+        phi, q0, a, f1, f2, sgn = [], [], [], [], [], []
         for i in range(self.num_envs):
-            for j in range(self.num_joints):
-                if j ==8 or j==7:
-                    attenuation_factor=np.inf
-                else: 
-                    attenuation_factor = 2 # 1.6 safe
-                single_dof = chirp_signal(self,attenuation_factor,j)
-                self.control_action[i][j] = single_dof
-                #self.diff_action[i][j][1:] = torch.diff(self.control_action[i][j])
+            g = self.rng.generator(i, "excitation")
+            phi.append(g.uniform(-np.pi,np.pi,self.num_joints))
+            q0.append(g.uniform(-.5,.5,self.num_joints))
+            a.append(g.uniform(-4,4,self.num_joints))    #  [ -3,3]
+            f1.append(g.uniform(*b1,self.num_joints))
+            f2.append(g.uniform(*b2,self.num_joints))
+            sgn.append(np.sign(g.uniform(-1,1,self.num_joints)))
+        phi, q0, a, f1, f2, sgn = [self.rng.tensor(x).unsqueeze(-1) for x in (phi, q0, a, f1, f2, sgn)]
+        att = self.rng.tensor(attenuation_factor).view(1,self.num_joints,1)
+        t = self.t.view(1,1,self.num_iter)
+
+        self.control_action = (q0 + sgn * a * torch.cos (2* np.pi * f1 *( 1 + 1/4 * torch.cos(  2 * np.pi * f2* t))*t + phi))/att
+        self.control_action[:,7:,:] = 0
         return self.control_action.to(device=self.args.graphics_device_id)
     
     def impulse(self):
@@ -336,13 +374,16 @@ class osc(input):
                  frequency, 
                  input_type,
                  mass_vector,
-                 args):
-        super().__init__(num_envs, num_iter, num_joints, num_coords, frequency, input_type, mass_vector, args)
-
-        self._radius = torch.rand((1,self.args.num_envs)).uniform_(0.01,0.12).to(device=self.args.graphics_device_id)
-        self._period = torch.rand(1).uniform_(20,100).to(device=self.args.graphics_device_id)
-        self._z_speed = torch.rand(1).uniform_(0.1,0.4).to(device=self.args.graphics_device_id)
-        self._sign = torch.sign(torch.rand(1).uniform_(-1,1)).to(device=self.args.graphics_device_id)
+                 args,
+                 rng):
+        super().__init__(num_envs, num_iter, num_joints, num_coords, frequency, input_type, mass_vector, args, rng)
+
+        g = self.rng.generator(CAMPAIGN, "osc")
+        self._radius = self.rng.tensor([[self.rng.uniform(i, "osc", 0.01, 0.12) for i in range(self.args.num_envs)]],
+                                       device=self.args.graphics_device_id)
+        self._period = self.rng.tensor(g.uniform(20,100,1), device=self.args.graphics_device_id)
+        self._z_speed = self.rng.tensor(g.uniform(0.1,0.4,1), device=self.args.graphics_device_id)
+        self._sign = torch.sign(self.rng.tensor(g.uniform(-1,1,1), device=self.args.graphics_device_id))
         #_offset =  torch.sign(torch.rand(1).uniform_(-0.3,0.3)).to(device=self.args.graphics_device_id)
 
         if self.args.random_osc_gains:
@@ -350,8 +391,11 @@ class osc(input):
             kv_lower_bound, kv_higher_bound = (1,5**0.5)
             print('\n OSC K randomization:\nKp -->\n'+str(kp_lower_bound)+'|'+str(kp_higher_bound) 
             +'\nKv -->\n' +str(kv_lower_bound)+'|'+str(kv_higher_bound))
-            self.kp = torch.FloatTensor(self.args.num_envs,1).uniform_(kp_lower_bound,kp_higher_bound).to(device=self.args.graphics_device_id)
-            self.kv = torch.FloatTensor(self.args.num_envs,1).uniform_(kv_lower_bound,kv_higher_bound).to(device=self.args.graphics_device_id)
+            gains = [self.rng.generator(i, "osc_gains").uniform((kp_lower_bound,kv_lower_bound),(kp_higher_bound,kv_higher_bound))
+                     for i in range(self.args.num_envs)]
+            gains = self.rng.tensor(gains, device=self.args.graphics_device_id)
+            self.kp = gains[:,0:1].contiguous()
+            self.kv = gains[:,1:2].contiguous()
         else:
             kp_nom = 10
             kv_nom = 2*(10**0.5)
@@ -0,0 +1,99 @@
+"""
+Frequency domain multisine excitation designer. The excitation of every (env, joint) pair is
+specified as an amplitude spectrum over a frequency band, its phases are optimized for a low crest
+factor and the signals are scaled to the peak and derivative limits of the joints, e.g. TOR_END for
+effort control, ACC_END on the second derivative of position targets or on the first derivative of
+velocity targets.
+
+All (envs, joints) signals are synthesized at once with batched inverse FFTs. Phases start from
+Schroeder phases shifted per signal and are refined by iterative clipping: the signal is clipped
+at a fraction of its peak, the phases of the clipped spectrum are kept and the designed amplitudes
+are restored. The lowest crest factor reached by each signal is kept.
+"""
+import math
+import torch
+
+def crest_factor(x):
+    """
+    Peak over rms value along the time axis
+    """
+    return x.abs().amax(-1) / x.pow(2).mean(-1).sqrt().clamp_min(1e-12)
+
+def excited_bins(num_iter, dt, band):
+    """
+    Boolean mask of the rfft bins inside the band, the nearest bin is excited when the band is
+    narrower than the frequency resolution
+    """
+    freqs = torch.fft.rfftfreq(num_iter, d=dt, dtype=torch.float64)
+    mask = (freqs >= band[0]) & (freqs <= band[1]) & (freqs > 0)
+    if not mask.any():
+        center = 0.5*(band[0] + band[1])
+        mask[1 + (freqs[1:] - center).abs().argmin()] = True
+    return freqs, mask
+
+def design(num_envs,
+           num_joints,
+           num_iter,
+           dt,
+           band,
+           rng,
+           peak=None,
+           rate=None,
+           rate_order=1,
+           level=(0.3, 1.0),
+           iterations=50,
+           clip=0.9):
+    """
+    Designs crest-factor optimized multisines of size (num envs, num joints, num iter)
+
+    band: (lower, upper) excited frequency band in Hz
+    rng: counter-based streams, every env draws its amplitudes, phase shifts and levels from its
+         own excitation stream
+    peak: (num joints,) bound on |u|, None for unbounded
+    rate: (num joints,) bound on |d^n u / dt^n| with n = rate_order, None for unbounded
+    level: range of the random fraction of the bounds used by each signal
+
+    Returns the signals and their crest factors (num envs, num joints)
+    """
+    freqs, mask = excited_bins(num_iter, dt, band)
+    K = int(mask.sum())
+    k = torch.arange(1, K+1, dtype=torch.float64)
+    schroeder = -math.pi * k * (k-1) / K
+
+    amp, shift, lvl = [], [], []
+    for i in range(num_envs):
+        g = rng.generator(i, "excitation")
+        amp.append(torch.as_tensor(g.uniform(0.5, 1.0, (num_joints, K))))
+        shift.append(torch.as_tensor(g.uniform(-math.pi, math.pi, (num_joints, 1))))
+        lvl.append(torch.as_tensor(g.uniform(level[0], level[1], num_joints)))
+    amp = torch.stack(amp)
+    phase = schroeder + torch.stack(shift) * k
+    lvl = torch.stack(lvl)
+
+    spectrum = torch.zeros((num_envs, num_joints, freqs.numel()), dtype=torch.complex128)
+    spectrum[..., mask] = torch.polar(amp, phase)
+    x = torch.fft.irfft(spectrum, n=num_iter)
+    best, bestcf = x, crest_factor(x)
+
+    for _ in range(iterations):
+        bound = clip * x.abs().amax(-1, keepdim=True)
+        xc = torch.maximum(torch.minimum(x, bound), -bound)
+        spectrum[..., mask] = torch.polar(amp, torch.fft.rfft(xc)[..., mask].angle())
+        x = torch.fft.irfft(spectrum, n=num_iter)
+        cf = crest_factor(x)
+        improved = cf < bestcf
+        best = torch.where(improved[..., None], x, best)
+        bestcf = torch.minimum(cf, bestcf)
+
+    scale = lvl.clone()
+    if peak is not None:
+        peak = torch.as_tensor(peak, dtype=torch.float64).reshape(-1)[:num_joints]
+        scale = scale * peak / best.abs().amax(-1).clamp_min(1e-12)
+    if rate is not None:
+        rate = torch.as_tensor(rate, dtype=torch.float64).reshape(-1)[:num_joints]
+        omega = (2j * math.pi * freqs) ** rate_order
+        derivative = torch.fft.irfft(torch.fft.rfft(best) * omega, n=num_iter)
+        ratescale = lvl * rate / derivative.abs().amax(-1).clamp_min(1e-12)
+        scale = ratescale if peak is None else torch.minimum(scale, ratescale)
+
+    return (best * scale[..., None]).float(), bestcf.float()
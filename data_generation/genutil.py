@@ -1,13 +1,20 @@
 from isaacgym import gymapi
-from isaacgym import torch_utils
+from isaacgym import gymtorch
 import argparse
 import torch
-import matplotlib.gridspec as grid
-from matplotlib import pyplot as plt
-import torch.nn.functional as F
 import numpy as np
 import pandas as pd
 import json
+import math
+import os
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from orientation import *
+from plotworker import submit
+from controllers import action, osc, compensate
+from randomenvs import envinit
+from rng import streams
 
 class parser():
     """
@@ -107,7 +114,7 @@ class parser():
         self.parser.add_argument("-fq", "--fix-quarternions", action="store_true",
                             help="compensate errors in quarternions instead of rejecting")
         self.parser.add_argument("-hdo", "--orientation-dimension", choices=["3D","4D","6D"], default="4D",
-                            help="implement 6d continuous rotation matrices instead of 4d discontinuous q's")
+                            help="DEPRECATED - raw 4d q's are always stored, 3D/6D are resolved by the training loader")
         self.parser.add_argument("-mf", "--measure-force", action="store_true",
                             help="measure forces - ground truth check")
         self.parser.add_argument("-mgf", "--measure-gravity-friction", action="store_true",
@@ -140,19 +147,24 @@ class parser():
                             help="randomize the dof coulomb friction by the specified percentage around nominal")
         self.parser.add_argument("-rad", "--random-angular-damping", type=float, default=0,
                             help="randomize the asset angular damping by the specified percentage around nominal")
-        self.parser.add_argument("-ti", "--type-of-input", type=str, choices=["MS","CH","IMP","TRAPZ"], default="",
+        self.parser.add_argument("-ti", "--type-of-input", type=str, choices=["MS","OMS","CH","IMP","TRAPZ"], default="",
                             help="type of imposed control: MS:multi sinusoidal"
+                                                          "OMS:crest-factor optimized multisine"
                                                           "CH:chirp"
                                                           "IMP:impulse"
                                                           "TRAPZ:trapezoidal")
         self.parser.add_argument("-f", "--frequency", type=float, default=0.1,
                             help="master frequency of imposed control")
+        self.parser.add_argument("-el", "--excitation-level", type=float, default=0.1,
+                            help="fraction of the joint limits reached by the OMS excitation")
         self.parser.add_argument("-ni", "--num-iters", type=int, default=1000,
                             help="number of iterations in a single simulation")
         self.parser.add_argument("-nr", "--num-runs", type=int, default=1,
                             help="number of consecutive runs in a single execution")
         self.parser.add_argument("-s", "--seed", default=False,
                             help="seed for reproducibility")
+        self.parser.add_argument("-eo", "--env-offset", type=int, default=0,
+                            help="global id of the first env, shards a campaign seed over workers bit-exactly")
 
         for argument in self.params:
             if ("name" in argument) and ("type" in argument or "action" in argument):
@@ -262,7 +274,7 @@ class savedata():
 
     SEED_ENVS_STEPS_G_F_RI_RV_RM_RCOM_RINR_RS_RD_RF_RAD_ROSC_QF_ST_QR_TINP_TOSC_FOR
 
-    SEED: generated seed of the simulation - int
+    SEED: generated seed of the simulation - int, suffixed with -env_offset for sharded campaigns
     ENVS: number of *valid* environments in the simulation - int
     STEPS: maximum number of steps in the simulation - int
     FREQS: master frequency - float
@@ -281,7 +293,7 @@ class savedata():
     QF: manual quarternion fix [IQ, NQ]
     ST: saturation inclusion [IS, NS] 
     QR: type of orientation resolution [3D,4D,6D]
-    TINP: type of input for imposed control [MS,CH,IMP,TRAPZ]
+    TINP: type of input for imposed control [MS,OMS,CH,IMP,TRAPZ]
     TOSC: type of input for OSC [VS,CS,CV]
     FOR: use of dataset [train,test,metatrain,metatest]
     """
@@ -385,7 +397,8 @@ class savedata():
         FOR = self.args.type_of_dataset
 
         if not self.args.no_save and not self.collision:
-            self.name_tensor = (str(self.seed) + '_' + str(self.valid_envs) + '_' + str(self.args.num_iters) + '_' + 
+            SEED = str(self.seed) if not self.args.env_offset else f'{self.seed}-{self.args.env_offset}'
+            self.name_tensor = (SEED + '_' + str(self.valid_envs) + '_' + str(self.args.num_iters) + '_' + 
                         str(self.args.frequency).replace('.','') + '_' + G + '_' + F + '_'  +
                         RI + '_' + RV + '_' + RM + '_' + RCOM + '_' + RINR + '_'  +
                         RS + '_' + RD + '_' + RF + '_' + RAD + '_' + ROSC + '_' + 
@@ -432,10 +445,15 @@ class postprocessor():
     """
     Custom postprocessor, used to generate plots of link torques and link position of selected
     environments in a given simulation. - refer to README.md
+
+    Plot methods only collect the data of each plot on the cpu, dispatch() hands the collected jobs
+    to plotworker which renders them headless in a detached process - refer to plotworker.py
     """
     label_coordinates4D = ['x','y','z','$X$','$Y$','$Z$','$W$',
                             '$q_0$','$q_1$','$q_2$','$q_3$','$q_4$','$q_5$','$q_6$']
-    label_coordinates6D = ['x','y','z','$e_{11}$','$e_{12}$','$e_{13}$','$e_{22}$','$e_{23}$','$e_{33}$',
+    label_coordinates6D = ['x','y','z','$e_{11}$','$e_{12}$','$e_{13}$','$e_{21}$','$e_{22}$','$e_{23}$',
+                            '$q_0$','$q_1$','$q_2$','$q_3$','$q_4$','$q_5$','$q_6$']
+    label_coordinates3D = ['x','y','z','$\\phi$','$\\theta$','$\\psi$',
                             '$q_0$','$q_1$','$q_2$','$q_3$','$q_4$','$q_5$','$q_6$']
     def __init__(self,
                  joints,
@@ -459,6 +477,8 @@ class postprocessor():
         self.tr = target
         self.di = dynamical_inclusion
         self.path = f'{path}/plots/{self.args.name_of_dataset}'
+        self.jobs = []
+        Path(self.path).mkdir(parents=True, exist_ok=True)
         print("\n Ready to Post-Process")
 
     def __str__(self):
@@ -470,136 +490,62 @@ class postprocessor():
     def setdata(self,args_):
         self.args = args_
 
+    def tonumpy(self,x):
+        return x.detach().to("cpu").numpy()
+
+    def dispatch(self, wait=False):
+        """
+        Renders the collected plots in the background, generation is not blocked
+        """
+        if not self.jobs:
+            return None
+        proc = submit(self.jobs, self.path, wait=wait)
+        self.jobs = []
+        return proc
+
     def plot_linkmassdist(self):
         """
-        Plots link mass distribution as a function of iteration steps - BUT WHY?
-        """
-        fig, axs = plt.subplots(self.di.shape[2], figsize=(20,20))  
-        fig.suptitle(f'Masses of Each Link, {self.joints+2} Links') 
-        for i in range(self.di.shape[2]):  
-            temporary=self.di[:,:,i].to("cpu").numpy()    
-            axs[i].grid()
-            axs[i].set(xlabel='Iteration Steps')
-            axs[i].set(ylabel='Mass [kg]', title='Link'+str(i)+'')
-            axs[i].plot(temporary)
-        fig.tight_layout(pad=3) 
-        fig.subplots_adjust(top = .96)
-        plt.draw()
-        fig.savefig(f'{self.path}/linkmass_dist.png',bbox_inches='tight')        
-        plt.show()  
+        Plots link mass distribution over environments
+        """
+        self.jobs.append(("linkmassdist", {"path" : self.path,
+                                           "joints" : self.joints,
+                                           "mass" : self.tonumpy(self.di)}))
 
     def plot_control(self):
         """
         Plots the generated control trajectory for a given number of randomized envs for all
         joints and all envs
         """
-        fig, axs = plt.subplots(self.joints, figsize=(20,20))
-        fig.suptitle(f'Control Action Among Dofs, {self.joints} Joints')
-        for i in range(self.joints):
-            temporary=self.ct[1:,:,i].to("cpu").numpy()   
-            if i <=self.joints-1:
-                axs[i].set(ylabel='Control Action [Nm, deg, deg/s]', title='Joint'+str(i)+'')
-                axs[i].plot(temporary)
-            axs[i].grid()
-            axs[i].set(xlabel='Iteration Steps')
-        fig.tight_layout(pad=3)
-        fig.subplots_adjust(top = .96)
-        plt.draw()
-        fig.savefig(f'{self.path}/buffer_control.png',bbox_inches='tight')
-        plt.show()
+        self.jobs.append(("control", {"path" : self.path,
+                                      "joints" : self.joints,
+                                      "control" : self.tonumpy(self.ct)}))
         
     def plot_trajectory(self):
         """
         Plots the end effector pose and joint variables in 13/14/16 dims for randomized envs for all envs
         """
-        if self.args.orientation_dimension=='4D':
-            fig, axs = plt.subplots(int(self.coords/2),2,figsize=(20,20)) 
-            fig.suptitle('Output: Full Pose and Joint Positions')
-            k = 0
-            for j in range(2):
-                for i in range(int(self.coords/2)): 
-                    if k <=2:
-                        axs[i,j].plot(self.ps[:,:,k].to("cpu").numpy())
-                        axs[i,j].set(ylabel='m', title=self.label_coordinates4D[k])
-                        axs[i,j].grid()
-                        if self.tr != []:
-                            axs[i,j].plot(self.tr[:,:,k].to("cpu").numpy(),'r-',label='target') 
-                    elif k>2 and k<=6:
-                        
-                        axs[i,j].plot(self.ps[:,:,k].to("cpu").numpy())
-                        axs[i,j].set(ylabel='[-]', title=self.label_coordinates4D[k])
-                        axs[i,j].grid()
-                    else:
-                        axs[i,j].plot(np.rad2deg(self.ps[:,:,k].to("cpu").numpy()))
-                        axs[i,j].set(ylabel='deg', title=self.label_coordinates4D[k])
-                        axs[i,j].grid()
-                    k = k+1
-                    axs[i,0].set(xlabel='Iteration Steps')
-                    axs[i,1].set(xlabel='Iteration Steps')
-            fig.subplots_adjust(top = .96)
-            fig.tight_layout(pad=3)
-            plt.draw()
-            fig.savefig(f'{self.path}/buffer_pose.png',bbox_inches='tight')
-            plt.show()
-
-        elif self.args.orientation_dimension=='6D' or self.args.orientation_dimension=='3D':
-            fig = plt.figure(figsize=(20,20))
-            gs = grid.GridSpec(9,2, figure=fig)
-            fig.suptitle('Output: Full Pose and Joint Positions')
-            k = 0
-            for i1 in range(9):
-                axs = fig.add_subplot(gs[i1,0])
-                if k <=2:
-                    axs.plot(self.ps[:,:,k].to("cpu").numpy())
-                    axs.set(ylabel='m', title=self.label_coordinates6D[k])
-                    axs.grid()
-                    if self.tr != []:
-                        axs.plot(self.tr[:,:,k].to("cpu").numpy(),'r-',label='target') 
-                elif k>2 and k<=8:
-                    axs.plot(self.ps[:,:,k].to("cpu").numpy())
-                    axs.set(ylabel='[-]', title=self.label_coordinates6D[k])
-                    axs.grid()
-                k=k+1
-                axs.set(xlabel='Iteration Steps')
-            
-            for i2 in range(7):
-                axs = fig.add_subplot(gs[i2,1])
-                axs.plot(np.rad2deg(self.ps[:,:,k].to("cpu").numpy()))
-                axs.set(ylabel='deg', title=self.label_coordinates6D[k])
-                axs.grid()
-                k=k+1
-                axs.set(xlabel='Iteration Steps')
-
-            fig.subplots_adjust(top = .96)
-            fig.tight_layout(pad=3)
-            plt.draw()
-            fig.savefig(f'{self.path}/buffer_pose.png',bbox_inches='tight')
-            plt.show()
+        labels = {'3D' : self.label_coordinates3D,
+                  '4D' : self.label_coordinates4D,
+                  '6D' : self.label_coordinates6D}[self.args.orientation_dimension]
+        target = self.tonumpy(self.tr) if torch.is_tensor(self.tr) and self.tr.numel() != 0 else None
+        self.jobs.append(("trajectory", {"path" : self.path,
+                                         "pose" : self.tonumpy(self.ps),
+                                         "target" : target,
+                                         "labels" : labels,
+                                         "norient" : ORIENTATION_DIMS[self.args.orientation_dimension]}))
         
     def plot_saturation_histogram(self,pose,limits):
         """
         Plots the distribution of max positional reach of the end effector in each environment,
         used for probabilistic assessment of max pose distribution
         """
-        if self.args.orientation_dimension=='4D':
-            pose = pose[:,:,7:]
-        else:
-            pose = pose[:,:,9:]
+        pose = pose[:,:,3+ORIENTATION_DIMS[self.args.orientation_dimension]:]
         diffl = pose - limits[0].repeat(pose.size()[0],1,1)
         diffu = pose - limits[1].repeat(pose.size()[0],1,1)
-        diff = torch.abs(torch.maximum(diffl,diffu)).mean(dim=0).to("cpu").numpy()
-        fig, axs = plt.subplots(self.joints, figsize=(20,20))
-        fig.suptitle(f'Joint Saturation Probability, {self.joints} Total Joints')
-        for i in range(self.joints):
-            axs[i].set(ylabel=f'Saturation', title='Joint'+str(i)+'')
-            axs[i].hist(diff[:,i:7], bins=40)
-            axs[i].grid()
-            axs[i].set(xlabel='Iteration Steps')
-        fig.tight_layout(pad=3)
-        fig.subplots_adjust(top = .96)
-        plt.draw()
-        fig.savefig(f'{self.path}/saturation_dist.png',bbox_inches='tight')
-        plt.show()
+        diff = torch.abs(torch.maximum(diffl,diffu)).mean(dim=0)
+        self.jobs.append(("saturation_histogram", {"path" : self.path,
+                                                   "joints" : self.joints,
+                                                   "diff" : self.tonumpy(diff)}))
         
     def plot_collision_histogram(self,pose):
         """
@@ -608,164 +554,527 @@ class postprocessor():
 
                                              WORK IN PROGRESS
         """
-        diff = torch.abs(pose[:,:,2]).mean(dim=0).to("cpu").numpy()
-        fig, axs = plt.subplots(figsize=(20,20))
-        fig.suptitle(f'Joint Saturation Probability, {self.joints} Total Joints')
-        axs.set(ylabel=f'Saturation', title='Collision Plot')
-        axs.hist(diff[:], bins=10)
-        axs.grid()
-        axs.set(xlabel='Iteration Steps')
-        fig.tight_layout(pad=3)
-        fig.subplots_adjust(top = .96)
-        plt.draw()
-        fig.savefig(f'{self.path}/collision_dist.png',bbox_inches='tight')
-        plt.show()
+        diff = torch.abs(pose[:,:,2]).mean(dim=0)
+        self.jobs.append(("collision_histogram", {"path" : self.path,
+                                                  "joints" : self.joints,
+                                                  "diff" : self.tonumpy(diff)}))
         
     def plot_secondary_var(self,var,varname):
         """
         Plots a secondary variable other than control and trajectory, possible candidates are:
         friction, gravity, etc. var size = (num envs, num joints, num iters)
         """
-        b = [-10, -10, -5, -10, -5, -5, -2.5, -2,5, -2.5]
-        t = [10, 10, 5, 10, 5, 5, 2.5, 2,5, 2.5]
-        varp = var.to("cpu").numpy()
-        fig, axs = plt.subplots(self.joints, figsize=(20,20))
-        fig.suptitle(f'Joint {varname} Variation, {self.joints} Total Joints')
-        for i in range(self.joints):
-            for j in range(self.valid_envs):
-                axs[i].set(ylabel=f'{varname}', title='Joint'+str(i)+'')
-                axs[i].plot(varp[j,i,1:])
-            axs[i].grid()
-            axs[i].set(xlabel='Iteration Steps')
-            if varname=="benchmark_control_error":
-                axs[i].set_ylim(b[i],t[i])
-        fig.tight_layout(pad=3)
-        fig.subplots_adjust(top = .96)
-        plt.draw()
-        fig.savefig(f'{self.path}/{varname}.png',bbox_inches='tight')
-        plt.show()
-     
-def normalize_vector(x):
-    return torch.linalg.vector_norm(x)
-
-def cross_product(x,y):
-    return torch.linalg.cross(x,y)
-
-def standardize_quaternion(quaternions):
-    return torch.where(quaternions[..., 0:1] < 0, -quaternions, quaternions)
-
-def _sqrt_positive_part(x): 
-    ret = torch.zeros_like(x)
-    positive_mask = x > 0
-    if torch.is_grad_enabled():
-        ret[positive_mask] = torch.sqrt(x[positive_mask])
-    else:
-        ret = torch.where(positive_mask, torch.sqrt(x), ret)
-    return ret
-
-def ortho6d_to_matrix(orn):
-    x_raw = orn[:,0:3]
-    y_raw = orn[:,3:6]
-
-    x = normalize_vector(x_raw)
-    z = cross_product(x,y_raw)
-    z = normalize_vector(z)
-    y = cross_product(z,x)
-        
-    x = x.view(-1,3,1)
-    y = y.view(-1,3,1)
-    z = z.view(-1,3,1)
-    matrix = torch.cat((x,y,z), 2)
-    return matrix
-
-def quarternion_to_matrix(orn):
-    r, i, j, k = torch.unbind(orn, -1)
-    two_s = 2.0 / (orn * orn).sum(-1)
-    o = torch.stack(
-        (
-            1 -two_s * (j * j + k * k),
-            two_s * (i * j - k * r),
-            two_s * (i * k + j * r),
-            two_s * (i * j + k * r),
-            1 -two_s * (i * i + k * k),
-            two_s * (j * k - i * r),
-            two_s * (j * k - j * r),    
-            two_s * (j * k + i * r),
-            1 -two_s * (i * i + j * j)
-        ),
-        -1,
-    )
-    return o.reshape(orn.shape[:-1] + (3,3))
-    
-def decide_orientation(orn,dim):
-    if dim=='4D':
-        return orn
-    
-    elif dim=='3D':
-        return torch_utils.get_euler_xyz(orn)
-    
-    elif dim=='6D':
-        mat = quarternion_to_matrix(orn)
-        bath_dim = mat.size()[:-2]
-        return mat[..., :2, :].clone().reshape(bath_dim + (6,))
-
-def resolve_orientation(orn,dim):
-    if dim=='6D':
-        return orn
-    
-    elif dim=='3D':
-        mat = ortho6d_to_matrix(orn)
-        batch = mat.shape[0]
-        R = mat
-        sy = torch.sqrt(R[:,0,0]*R[:,0,0]+R[:,1,0]*R[:,1,0])
-        singular = sy<1e-6
-        singular = singular.float()
-            
-        x = torch.atan2(R[:,2,1], R[:,2,2])
-        y = torch.atan2(-R[:,2,0], sy)
-        z = torch.atan2(R[:,1,0],R[:,0,0])
-        
-        xs = torch.atan2(-R[:,1,2], R[:,1,1])
-        ys = torch.atan2(-R[:,2,0], sy)
-        zs = R[:,1,0]*0
-
-        out_euler = torch.FloatTensor(batch,3)
-        out_euler[:,0] = x*(1-singular)+xs*singular
-        out_euler[:,1] = y*(1-singular)+ys*singular
-        out_euler[:,2] = z*(1-singular)+zs*singular      
-        return out_euler
-
-    elif dim=='4D':
-        mat = ortho6d_to_matrix(orn)
-        batch_dim = mat.shape[:-2]
-        m00, m01, m02, m10, m11, m12, m20, m21, m22 = torch.unbind(
-            mat.reshape(batch_dim + (9,)), dim=-1
-        )
-        q_abs = _sqrt_positive_part(
-            torch.stack(
-                [
-                    1.0 + m00 + m11 + m22,
-                    1.0 + m00 - m11 - m22,
-                    1.0 - m00 + m11 - m22,
-                    1.0 - m00 - m11 + m22,
-                ],
-                dim=-1,
-            )
-        )
-        quat_by_rijk = torch.stack(
-            [
-                torch.stack([q_abs[..., 0] ** 2, m21 - m12, m02 - m20, m10 - m01], dim=-1),
-                torch.stack([m21 - m12, q_abs[..., 1] ** 2, m10 + m01, m02 + m20], dim=-1),
-                torch.stack([m02 - m20, m10 + m01, q_abs[..., 2] ** 2, m12 + m21], dim=-1),
-                torch.stack([m10 - m01, m20 + m02, m21 + m12, q_abs[..., 3] ** 2], dim=-1),
-            ],
-            dim=-2,
-        )
-
-        flr = torch.tensor(0.1).to(dtype=q_abs.dtype, device=q_abs.device)
-        quat_candidates = quat_by_rijk / (2.0 * q_abs[..., None].max(flr))
-
-        out = quat_candidates[
-            F.one_hot(q_abs.argmax(dim=-1), num_classes=4) > 0.5, :
-        ].reshape(batch_dim + (4,))
-        return standardize_quaternion(out)
+        self.jobs.append(("secondary_var", {"path" : self.path,
+                                            "joints" : self.joints,
+                                            "var" : self.tonumpy(var),
+                                            "varname" : varname}))
+
+
+class campaign():
+    """
+    Generation campaign shared by the genfranka scripts. The sim, the asset and the env handles are
+    created once, every run re-samples the randomization from the streams of seed + run, resets the
+    dof states through the tensor API and regenerates the excitation. A finished run is saved by a
+    single saver thread while the next one simulates. The scripts only differ in
+
+    actuate: applies the input of a step, called as actuate(gym, sim, u) with the unwrapped tensor
+    limits: bounds of the imposed excitation - refer to controllers.action
+    control: buffer stored as the control trajectory, "bca" for the applied input or "mt" for the
+             measured joint torques of the position and velocity controlled arms
+    """
+    def __init__(self,
+                 args,
+                 data,
+                 actuate,
+                 limits,
+                 control="bca"):
+        self.args = args
+        self.data = data
+        self.actuate = actuate
+        self.limits = limits
+        self.control = control
+
+        self.total_coords = data["TOTAL_COORDS"]
+        self.total_joints = data["TOTAL_JOINTS"]
+        self.total_links = data["TOTAL_LINKS"]
+        self.pos_end = np.array(data["POS_END"])
+        self.vel_end = np.array(data["VEL_END"])
+        self.tor_end = np.array(data["TOR_END"])
+        self.solver_time = data["SOLVER_TIME"]/60
+
+        if args.orientation_dimension != '4D':
+            print(f"Raw quaternions are stored, {args.orientation_dimension} orientations are resolved at load time (-hdo in training)")
+            args.orientation_dimension = '4D'
+
+        complementary_dataset = 'train' if args.type_of_dataset == 'test' else 'test'
+        Path("./data_tensors/").mkdir(exist_ok=True)
+        self.current_folder = Path(f"./data_tensors/{args.type_of_dataset}/{args.name_of_dataset}")
+        self.current_folder.mkdir(exist_ok=True)
+        self.complementary_folder = Path(f"./data_tensors/{complementary_dataset}/{args.name_of_dataset}")
+        self.complementary_folder.mkdir(exist_ok=True)
+
+        self.mesh = gymapi.MESH_VISUAL_AND_COLLISION
+        self.color = gymapi.Vec3(.9,.25,.15)
+
+    def __str__(self):
+        return f'Campaign Object instantiated'
+
+    def used_seeds(self):
+        """
+        Seeds of the stored runs of the dataset in the train and test folders, the file names start
+        with the seed of the run (seed-offset for sharded campaigns)
+        """
+        names = os.listdir(self.current_folder) + os.listdir(self.complementary_folder)
+        return {int(name.split('_')[0].split('-')[0]) for name in names if name.split('_')[0].split('-')[0].isdigit()}
+
+    def seed(self):
+        """
+        Campaign seed, every run of the campaign uses seed + run and none of them may collide with a
+        stored run
+        """
+        taken = self.used_seeds()
+        if not self.args.seed:
+            generated_seed = np.random.randint(0,999999)
+            while any(generated_seed + run in taken for run in range(self.args.num_runs)):
+                print("\nCurrent Folder: "+self.args.type_of_dataset+" --> Found a run seed of "+str(generated_seed)+" in the stored runs")
+                generated_seed = np.random.randint(0,999999)
+        else:
+            generated_seed = int(self.args.seed)
+            collisions = [generated_seed + run for run in range(self.args.num_runs) if generated_seed + run in taken]
+            if collisions:
+                print(f"\nWarning --> run seeds {collisions} are already used by stored runs of {self.args.name_of_dataset}")
+        print("\nGenerated Seed: "+str(generated_seed))
+        return generated_seed
+
+    def createsim(self, rng):
+        """
+        Creates the sim, the envs and the tensor views of the campaign
+        """
+        args, data = self.args, self.data
+        self.gym = gymapi.acquire_gym()
+
+        sim_params = gymapi.SimParams()
+        sim_params.up_axis = gymapi.UP_AXIS_Z
+        sim_params.gravity = gymapi.Vec3(0.0, 0.0, -9.8)
+        sim_params.dt = self.solver_time
+        sim_params.substeps = data["SUBSTEPS"]
+        if gymapi.SIM_PHYSX == args.physics_engine:
+            sim_params.physx.solver_type = data["SOLVER_TYPE"]
+            sim_params.physx.num_position_iterations = data["NUM_POS_ITER"]
+            sim_params.physx.num_velocity_iterations = data["NUM_VEL_ITER"]
+            sim_params.physx.num_threads = args.num_threads
+            sim_params.physx.use_gpu = args.use_gpu
+            sim_params.physx.contact_collection = gymapi.ContactCollection.CC_LAST_SUBSTEP
+        else:
+            raise Exception("Only PhysX is available")
+        sim_params.use_gpu_pipeline = args.use_gpu_pipeline
+        self.sim = self.gym.create_sim(args.compute_device_id, args.graphics_device_id, args.physics_engine, sim_params)
+        if self.sim is None:
+            raise Exception("Failed to create sim")
+
+        plane_params = gymapi.PlaneParams()
+        plane_params.normal = gymapi.Vec3(0, 0, 1)
+        self.gym.add_ground(self.sim, plane_params)
+
+        self.num_per_row = int(math.sqrt(args.num_envs))
+        spacing = 1.0
+        env_lower = gymapi.Vec3(-spacing, -spacing, 0.0)
+        env_upper = gymapi.Vec3(spacing, spacing, spacing)
+
+        pose = gymapi.Transform()
+        pose.p = gymapi.Vec3(0, 0, 0)
+        pose.r = gymapi.Quat(0, 0, 0, 1)
+
+        self.ienv = envinit(args,
+                            self.gym, self.sim,
+                            env_lower, env_upper, self.num_per_row, pose,
+                            self.total_links, self.total_joints,
+                            data["FIX_BASE_LINK"], data["FLIP_VISUAL_ATTACHMENTS"], data["ARMATURE"], args.disable_gravity,
+                            float(data["ANGDAMP_NOM"]), np.array(data["MASS_NOM"]), np.array(data["COM_NOM"]),
+                            np.array(data["INERTIA_NOM"]), np.array(data["STIFFNESS_NOM"]), np.array(data["DAMPING_NOM"]),
+                            np.array(data["COULOMB_NOM"]),
+                            self.pos_end, self.vel_end,
+                            rng=rng
+                            )
+        self.envdict = self.ienv.create_envs()
+
+        self.gym.prepare_sim(self.sim)
+
+        self.init_pos = torch.Tensor(self.envdict["ipos"]).view(args.num_envs, 3).to(device=args.graphics_device_id)
+        self.init_orn = torch.Tensor(self.envdict["iorn"]).view(args.num_envs, 4).to(device=args.graphics_device_id)
+        if args.use_gpu_pipeline:
+            self.init_pos = self.init_pos.to('cuda:0')
+            self.init_orn = self.init_orn.to('cuda:0')
+
+        self.jacobian = gymtorch.wrap_tensor(self.gym.acquire_jacobian_tensor(self.sim, "franka"))
+        hand_index = self.gym.get_asset_rigid_body_dict(self.envdict["fass"])["panda_hand"]
+        self.j_eef = self.jacobian[:, hand_index - 1, :]
+        self.mm = gymtorch.wrap_tensor(self.gym.acquire_mass_matrix_tensor(self.sim, "franka"))
+        self.rb_states = gymtorch.wrap_tensor(self.gym.acquire_rigid_body_state_tensor(self.sim))
+        if args.measure_force:
+            self._simtorques = self.gym.acquire_dof_force_tensor(self.sim)
+        self.contact_forces = gymtorch.wrap_tensor(self.gym.acquire_net_contact_force_tensor(self.sim))
+        self._dof_states = self.gym.acquire_dof_state_tensor(self.sim)
+        self.tl = torch.tensor(self.tor_end[:7]).repeat(args.num_envs,1).to(device=args.graphics_device_id)
+
+        if not args.disable_friction or not args.disable_gravity:
+            self.comp = compensate(args=args,
+                                   gravity=data["GRAVITY"],
+                                   friction_params=np.array(data["FRICTION"]),
+                                   num_joints=self.total_joints)
+
+        self.viewer = None
+        self.condition_window = 0
+        if args.visualize:
+            self.viewer = self.gym.create_viewer(self.sim, gymapi.CameraProperties())
+            if self.viewer is None:
+                raise Exception("Failed to create viewer")
+            cam_pos = gymapi.Vec3(4, 4, 4)
+            cam_target = gymapi.Vec3(-4, -3, -2)
+            middle_env = self.envdict["envs"][args.num_envs // 2 + self.num_per_row // 2]
+            self.gym.viewer_camera_look_at(self.viewer, middle_env, cam_pos, cam_target)
+            self.condition_window = self.gym.query_viewer_has_closed(self.viewer)
+
+    def reset(self, rng):
+        """
+        Re-samples the randomization of the envs from the streams of a new run and sets the drawn
+        dof states. No step is simulated, the tensors are refreshed so that the first recorded sample
+        of the run is the reset state.
+        """
+        dof_reset, self.envdict["mv"] = self.ienv.rerandomize(rng)
+        dof_states = gymtorch.wrap_tensor(self._dof_states)
+        dof_states.copy_(dof_reset.to(dof_states.device))
+        self.gym.set_dof_state_tensor(self.sim, self._dof_states)
+        self.gym.refresh_dof_state_tensor(self.sim)
+        self.gym.refresh_rigid_body_state_tensor(self.sim)
+        self.gym.refresh_jacobian_tensors(self.sim)
+        self.gym.refresh_mass_matrix_tensors(self.sim)
+
+    def excitation(self, rng):
+        """
+        Control object of a run, the imposed excitation or the osc task
+        """
+        args = self.args
+        if args.control_imposed:
+            ct = action(num_envs=args.num_envs,
+                        num_iter=args.num_iters+1,
+                        num_joints=self.total_joints,
+                        num_coords=self.total_coords,
+                        frequency=args.frequency,
+                        input_type=args.type_of_input,
+                        mass_vector=self.envdict["mv"],
+                        args=args,
+                        rng=rng,
+                        limits=self.limits,
+                        dt=self.solver_time)
+            return ct
+        elif args.osc_task:
+            cosc = osc(num_envs=args.num_envs,
+                       num_iter=args.num_iters+1,
+                       num_joints=self.total_joints,
+                       num_coords=self.total_coords,
+                       frequency=args.frequency,
+                       input_type=args.type_of_input,
+                       mass_vector=self.envdict["mv"],
+                       args=args,
+                       rng=rng)
+            return cosc
+
+    def simulate(self, rng):
+        """
+        Simulates a run, returns the buffers of the run and the environments to be rejected
+        """
+        args, gym, sim, envdict = self.args, self.gym, self.sim, self.envdict
+        NUM_ENVS = args.num_envs
+        pos_des = self.init_pos.clone()
+        orn_des = self.init_orn.clone()
+
+        dof_states = gymtorch.wrap_tensor(self._dof_states)
+        dof_vel = dof_states[:, 1].view(NUM_ENVS, 9, 1)
+        dof_pos = dof_states[:, 0].view(NUM_ENVS, 9, 1)
+        ll = torch.tensor(self.pos_end[:7,0]).repeat(NUM_ENVS,1).to(device=args.graphics_device_id)
+        ul = torch.tensor(self.pos_end[:7,1]).repeat(NUM_ENVS,1).to(device=args.graphics_device_id)
+
+        controller = self.excitation(rng)
+        cdict = controller.getcontrol()
+
+        black_list = []
+        out_of_range_quaternion = []
+        saturated_ll_idxs = []
+        saturated_ul_idxs = []
+
+        itr = 0
+        while not self.condition_window  and itr <= args.num_iters-1:
+            itr += 1
+
+            gym.refresh_rigid_body_state_tensor(sim)
+            gym.refresh_dof_state_tensor(sim)
+            gym.refresh_jacobian_tensors(sim)
+            if args.measure_force:
+                gym.refresh_dof_force_tensor(sim)
+            gym.refresh_mass_matrix_tensors(sim)
+            gym.refresh_net_contact_force_tensor(sim)
+
+            pos_cur = self.rb_states[envdict["hidx"], :3]
+            orn_cur = self.rb_states[envdict["hidx"], 3:7]
+
+            if args.osc_task:
+                u = controller.step_osc(pos_des,orn_des,pos_cur,dof_vel,orn_cur,self.init_pos,self.j_eef,self.mm,itr)
+                cdict["bt"] = torch.cat((cdict["bt"], pos_des.to("cpu").view( 1,NUM_ENVS, 3)), 0)
+            elif args.control_imposed:
+                u = cdict["ac"][:,:,itr].unsqueeze(-1)
+
+            if not args.disable_gravity:
+                gtorque = self.comp.gravity(self.jacobian,envdict["mv"])
+                u = u + gtorque
+            if not args.disable_friction:
+                ftorque = self.comp.friction(dof_vel)
+                u = u + ftorque
+            if args.measure_gravity_friction:
+                cdict["bg"] = torch.cat((cdict["bg"],gtorque),dim=2)
+                cdict["bf"] = torch.cat((cdict["bf"],ftorque),dim=2)
+
+            # -------------------------------------- Application of u ---------------------------------------------
+            self.actuate(gym, sim, gymtorch.unwrap_tensor(u))
+
+            # -------------------------------------- Step the physics ---------------------------------------------
+            gym.simulate(sim)
+            gym.fetch_results(sim, True)
+            if args.visualize:
+                gym.step_graphics(sim)
+                gym.draw_viewer(self.viewer, sim, False)
+                gym.sync_frame_time(sim)
+
+            # --------------------------------------- Buffer Stack ------------------------------------------------
+            uaug = u.view(1,NUM_ENVS,9)[:,:,:self.total_joints]
+            cdict["bca"] = torch.cat((cdict["bca"], uaug), 0)
+
+            dof_states = gymtorch.wrap_tensor(self._dof_states)
+            dof_pos = dof_states[:, 0]
+            dof_vel = dof_states[:, 1]
+
+            dof_pos = dof_pos.view(1,NUM_ENVS,9)
+            dof_pos = dof_pos[:,:,:7]
+            dof_vel = dof_vel.view(1,NUM_ENVS,9)
+
+            pos_cur = pos_cur.view(1,NUM_ENVS,3)
+            orn_cur = orn_cur.view(1,NUM_ENVS,4)
+
+            # -------------------------- Including dof_pos for 7 - dimension state space ---------------------------
+            full_pose = torch.cat((pos_cur,orn_cur,dof_pos),dim = 2)
+            cdict["bp"] = torch.cat((cdict["bp"], full_pose), 0)
+
+            # ------------------------------------- Contact Collection ---------------------------------------------
+            body_contact = torch.nonzero(abs(self.contact_forces)>0.01)
+
+            for j in range(body_contact.shape[0]):
+                _body_contact = body_contact[j]
+                env_idx_collision = torch.ceil(_body_contact[0]/self.total_links)-1
+                if  not env_idx_collision in black_list :
+                    black_list.append(env_idx_collision)
+                    env_handlec = gym.get_env(sim,env_idx_collision)
+                    if args.visualize:
+                        for k in range(self.total_links):
+                            gym.set_rigid_body_color(env_handlec, envdict["hdls"][0], k , self.mesh ,self.color)
+
+            # ---------------------------------- Abnormal change in quaternion -------------------------------------
+            if itr > 2:
+                increment = abs(cdict["bp"][itr-1,:,3:7] - cdict["bp"][itr-2,:,3:7])
+                out_of_range = torch.nonzero(increment > .1)
+                if out_of_range.numel()!=0:
+                    for x in out_of_range:
+                        out_of_range_quaternion.append(x[0])
+                        if args.fix_quarternions:
+                            cdict["bp"][itr-1,x[0],x[1]+3] = cdict["bp"][itr-1,x[0],x[1]+3]*-1
+                            self.rb_states[envdict["hidx"][x[0]], x[1]+3] = -1*self.rb_states[envdict["hidx"][x[0]], x[1]+3]
+
+            # ---------------------------------- Saturation check | Position ---------------------------------------
+            if args.control_imposed and not args.include_saturation:
+                saturation_ll = torch.nonzero(abs(dof_pos-ll) < 0.01)
+                saturation_ul = torch.nonzero(abs(dof_pos-ul) < 0.01)
+
+                if saturation_ll.shape[0] != 0:
+                    for j in range(saturation_ll.shape[0]):
+                        saturated_ll_idxs.append(saturation_ll[j,1])
+
+                if saturation_ul.shape[0] != 0:
+                    for j in range(saturation_ul.shape[0]):
+                        saturated_ul_idxs.append(saturation_ul[j,1])
+
+            # ---------------------------------- Saturation check | Torque -----------------------------------------
+            if args.osc_task and not args.include_saturation:
+                saturation_torques = torch.nonzero( (self.tl - abs(u.squeeze(-1)[:,:7]) ) < 1)
+                if saturation_torques.shape[0] != 0:
+                    for j in range(saturation_torques.shape[0]):
+                        saturated_ul_idxs.append(saturation_torques[j,0])
+                        env_handlet = gym.get_env(sim,saturated_ul_idxs[j])
+                        if args.visualize:
+                            for k in range(self.total_links):
+                                gym.set_rigid_body_color(env_handlet, envdict["hdls"][0], k , self.mesh ,self.color)
+
+            # -------------------------------- Sensor Measurement - Ground Truth -----------------------------------
+            if args.measure_force:
+                simtorques = gymtorch.wrap_tensor(self._simtorques).view(1,NUM_ENVS,9)
+                cdict["mt"] = torch.cat((cdict["mt"],simtorques),0)
+
+        return cdict, black_list, out_of_range_quaternion, saturated_ll_idxs + saturated_ul_idxs, [ll,ul]
+
+    def reject(self, cdict, black_list, out_of_range_quaternion, saturated_idxs, limits):
+        """
+        Removes the colliding, saturated and abnormal-quaternion environments from the buffers of a
+        run, returns the masses and the limits of the valid environments and their number
+        """
+        args = self.args
+        NUM_ENVS = args.num_envs
+        if not args.include_saturation:
+            saturation_idxs = list(set([int(s.to("cpu").numpy()) for s in saturated_idxs]))
+            print("\n---- Number of saturated simulations: ",len(saturation_idxs),"/", NUM_ENVS,"----\n" )
+        else:
+            saturation_idxs = []
+            print("Saturated environments are included in the final dataset\n")
+
+        if not args.fix_quarternions:
+            out_of_range_quaternion = list(set([int(q.to("cpu").numpy()) for q in out_of_range_quaternion]))
+            print("---- Number of simulations with abnormal changes in quaternions: ",len(out_of_range_quaternion),"/", NUM_ENVS,"----\n" )
+        else:
+            out_of_range_quaternion = []
+            print("Quarternion error is compensated\n")
+
+        print("---- Number of the colliding simulations: ",len(black_list),"/", NUM_ENVS,"----\n" )
+
+        black_list = list(set([int(b.to("cpu").numpy()) for b in black_list] + out_of_range_quaternion + saturation_idxs))
+        white_list = set([i for i in range(NUM_ENVS)]) - set(black_list)
+        failed_percentage = len(black_list)/NUM_ENVS*100
+        print("\n---- Number of rejectable simulations: ",len(black_list),"/", NUM_ENVS,"----\n" )
+        print("Percentage of total rejectable simulations:", round(failed_percentage,2), "%")
+
+        non_valid_envs = len(black_list)
+        num_valid_envs = NUM_ENVS - non_valid_envs
+
+        black_list.sort(reverse=True)
+        ll, ul = limits
+        ll = ll[list(white_list),:]
+        ul = ul[list(white_list),:]
+
+        masses = self.envdict["mv"][:,list(white_list),:]
+
+        for i in range(non_valid_envs):
+            row_exclude = black_list[i]
+
+            if args.control_imposed:
+                cdict["bca"] = torch.cat((cdict["bca"] [:,:row_exclude,:],
+                                    cdict["bca"] [:,row_exclude+1:,:]),1)
+                cdict["bp"] = torch.cat((cdict["bp"] [:,:row_exclude,:],
+                                    cdict["bp"] [:,row_exclude+1:,:]),1)
+                if args.measure_force:
+                    cdict["mt"] = torch.cat((cdict["mt"] [:,:row_exclude,:],
+                                    cdict["mt"] [:,row_exclude+1:,:]),1)
+            elif args.osc_task:
+                cdict["bca"] = torch.cat((cdict["bca"] [:row_exclude,:,:],
+                                    cdict["bca"] [row_exclude+1:,:,:]),0)
+                cdict["bt"] = torch.cat((cdict["bp"] [:,:row_exclude,:],
+                                    cdict["bp"] [:,row_exclude+1:,:]),1)
+
+                cdict["bp"] = torch.cat((cdict["bp"] [:,:row_exclude,:],
+                                    cdict["bp"] [:,row_exclude+1:,:]),1)
+                if args.measure_force:
+                    cdict["mt"] = torch.cat((cdict["mt"] [:,:row_exclude,:],
+                                    cdict["mt"] [:,row_exclude+1:,:]),1)
+
+        return masses, num_valid_envs, [ll,ul]
+
+    def store(self, cdict, masses, seed, num_valid_envs, gentime, limits):
+        """
+        Saves and plots the buffers of a finished run, called from the saver thread while the
+        next run simulates
+        """
+        args = self.args
+        if args.measure_force:
+            cdiff = cdict["bca"][:,:,:9] + cdict["mt"]
+
+        if not args.no_save:
+            tensormgmt = savedata(args,
+                                control_trajectory=cdict[self.control],
+                                pose=cdict["bp"],
+                                seed=seed,
+                                valid_envs=num_valid_envs,
+                                target=cdict["bt"],
+                                dynamical_inclusion=masses,
+                                collision=None,
+                                gentime=gentime,
+                                path='.')
+            tensormgmt.save_tensors()
+            tensormgmt.save_metadata()
+        else:
+            print("Input/Output Tensors are not saved")
+
+        if not args.no_plot:
+            dataprocessor = postprocessor(self.total_joints,
+                                        self.total_coords,
+                                        args,
+                                        control_trajectory=cdict["bca"],
+                                        pose=cdict["bp"],
+                                        seed=seed,
+                                        valid_envs=num_valid_envs,
+                                        target=cdict["bt"],
+                                        dynamical_inclusion=masses
+                                        )
+            if args.dynamical_inclusion:
+                dataprocessor.plot_linkmassdist()
+            if args.measure_force:
+                dataprocessor.plot_secondary_var(var=torch.permute(cdict["mt"],(1,2,0)),varname="ground_truth_control")
+                dataprocessor.plot_secondary_var(var=torch.permute(cdiff,(1,2,0)),varname="benchmark_control_error")
+            if args.measure_gravity_friction:
+                dataprocessor.plot_secondary_var(var=cdict["bg"],varname="gravity")
+                dataprocessor.plot_secondary_var(var=cdict["bf"],varname="friction")
+            if args.include_saturation:
+                dataprocessor.plot_saturation_histogram(pose=cdict["bp"],limits=limits)
+            dataprocessor.plot_control()
+            dataprocessor.plot_trajectory()
+            dataprocessor.dispatch()
+        else:
+            print("Input/Output Plots are not generated")
+
+    def run(self):
+        """
+        Runs the --num-runs runs of the campaign
+        """
+        torch.cuda.empty_cache()
+        generated_seed = self.seed()
+        torch.manual_seed(generated_seed)
+        self.createsim(streams(generated_seed, self.args.env_offset))
+
+        saver = ThreadPoolExecutor(max_workers=1)
+        pending = None
+        for run in range(self.args.num_runs):
+            run_seed = generated_seed + run
+            rng = streams(run_seed, self.args.env_offset)
+            if run > 0:
+                print(f"\n---- Run {run+1}/{self.args.num_runs}, seed {run_seed} ----\n")
+                torch.manual_seed(run_seed)
+                self.reset(rng)
+
+            ts = time.perf_counter()
+            cdict, black_list, out_of_range_quaternion, saturated_idxs, limits = self.simulate(rng)
+            dt = time.perf_counter()-ts
+            print(f"Time taken for simulation is {dt}")
+
+            masses, num_valid_envs, limits = self.reject(cdict, black_list, out_of_range_quaternion, saturated_idxs, limits)
+            if pending is not None:
+                pending.result()
+            pending = saver.submit(self.store, cdict, masses, run_seed, num_valid_envs, dt, limits)
+
+        if pending is not None:
+            pending.result()
+        saver.shutdown()
+
+        if self.viewer is not None:
+            self.gym.destroy_viewer(self.viewer)
+        self.gym.destroy_sim(self.sim)
+
+        print(torch.cuda.max_memory_allocated()/8/1e6)
+        print(torch.cuda.max_memory_reserved()/8/1e6)
+        print(torch.cuda.memory_usage())
+        print(torch.cuda.memory_summary())
+
+        torch.cuda.empty_cache()
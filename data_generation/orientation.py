@@ -0,0 +1,270 @@
+"""
+Orientation representations of the end effector pose, shared by the generation and the training
+modules. Quaternions follow the Isaac Gym (x, y, z, w) convention, 6D orientations are the first two
+rows of the rotation matrix and 3D orientations are xyz Euler angles (R = Rz Ry Rx). The Euler
+angles are in (-pi, pi], unlike the [0, 2pi) range of Isaac Gym's get_euler_xyz, so 3D datasets
+generated before the shared module are not directly comparable.
+
+Every conversion works on arbitrary leading dimensions (T, envs, ...) through ellipsis indexing and
+computes each output entry in a single elementwise expression, quaternions are turned into 6D or 3D
+orientations without materializing the rotation matrix. Only torch is required, the module is
+importable without isaacgym.
+
+Running the module directly checks the round trips and prints a micro-benchmark:
+python orientation.py
+"""
+import time
+import torch
+
+ORIENTATION_DIMS = {"3D" : 3, "4D" : 4, "6D" : 6}
+
+def normalize_vector(x):
+    return x / torch.linalg.vector_norm(x, dim=-1, keepdim=True).clamp_min(1e-8)
+
+def cross_product(x,y):
+    return torch.linalg.cross(x,y,dim=-1)
+
+def standardize_quaternion(quaternions):
+    return torch.where(quaternions[..., 3:4] < 0, -quaternions, quaternions)
+
+def _sqrt_positive_part(x):
+    ret = torch.zeros_like(x)
+    positive_mask = x > 0
+    if torch.is_grad_enabled():
+        ret[positive_mask] = torch.sqrt(x[positive_mask])
+    else:
+        ret = torch.where(positive_mask, torch.sqrt(x), ret)
+    return ret
+
+def _matrix_entries(orn):
+    """
+    Unnormalized quaternion products shared by every quaternion conversion
+    """
+    i, j, k, r = torch.unbind(orn, -1)
+    two_s = 2.0 / (orn * orn).sum(-1)
+    return i, j, k, r, two_s
+
+def ortho6d_to_matrix(orn):
+    """
+    Gram-Schmidt of the two stored rows, (..., 6) --> (..., 3, 3)
+    """
+    x = normalize_vector(orn[..., 0:3])
+    z = normalize_vector(cross_product(x,orn[..., 3:6]))
+    y = cross_product(z,x)
+    return torch.stack((x,y,z), -2)
+
+def quarternion_to_matrix(orn):
+    """
+    Rotation matrix of (x, y, z, w) quaternions, (..., 4) --> (..., 3, 3)
+    """
+    i, j, k, r, two_s = _matrix_entries(orn)
+    o = torch.stack(
+        (
+            1 -two_s * (j * j + k * k),
+            two_s * (i * j - k * r),
+            two_s * (i * k + j * r),
+            two_s * (i * j + k * r),
+            1 -two_s * (i * i + k * k),
+            two_s * (j * k - i * r),
+            two_s * (i * k - j * r),
+            two_s * (j * k + i * r),
+            1 -two_s * (i * i + j * j)
+        ),
+        -1,
+    )
+    return o.unflatten(-1, (3,3))
+
+def quarternion_to_ortho6d(orn):
+    """
+    First two rows of the rotation matrix of (x, y, z, w) quaternions, (..., 4) --> (..., 6)
+    """
+    i, j, k, r, two_s = _matrix_entries(orn)
+    return torch.stack(
+        (
+            1 -two_s * (j * j + k * k),
+            two_s * (i * j - k * r),
+            two_s * (i * k + j * r),
+            two_s * (i * j + k * r),
+            1 -two_s * (i * i + k * k),
+            two_s * (j * k - i * r)
+        ),
+        -1,
+    )
+
+def _euler_from_entries(m00, m10, m11, m12, m20, m21, m22):
+    """
+    xyz Euler angles from the needed rotation matrix entries, the singular branch is
+    selected per element
+    """
+    sy = torch.sqrt(m00*m00 + m10*m10)
+    singular = sy<1e-6
+    x = torch.where(singular, torch.atan2(-m12, m11), torch.atan2(m21, m22))
+    y = torch.atan2(-m20, sy)
+    z = torch.where(singular, torch.zeros_like(m10), torch.atan2(m10, m00))
+    return torch.stack((x,y,z), -1)
+
+def quarternion_to_euler(orn):
+    """
+    xyz Euler angles in (-pi, pi] of (x, y, z, w) quaternions, (..., 4) --> (..., 3)
+    """
+    i, j, k, r, two_s = _matrix_entries(orn)
+    return _euler_from_entries(1 -two_s * (j * j + k * k),
+                               two_s * (i * j + k * r),
+                               1 -two_s * (i * i + k * k),
+                               two_s * (j * k - i * r),
+                               two_s * (i * k - j * r),
+                               two_s * (j * k + i * r),
+                               1 -two_s * (i * i + j * j))
+
+def matrix_to_euler(mat):
+    """
+    xyz Euler angles of rotation matrices, (..., 3, 3) --> (..., 3)
+    """
+    return _euler_from_entries(mat[..., 0, 0], mat[..., 1, 0], mat[..., 1, 1], mat[..., 1, 2],
+                               mat[..., 2, 0], mat[..., 2, 1], mat[..., 2, 2])
+
+def euler_to_matrix(euler):
+    """
+    Rotation matrix of xyz Euler angles composed from the elemental rotations Rz Ry Rx,
+    (..., 3) --> (..., 3, 3)
+    """
+    def elemental(angle, axis):
+        c, s = torch.cos(angle), torch.sin(angle)
+        one, zero = torch.ones_like(angle), torch.zeros_like(angle)
+        rows = {0: ((one, zero, zero), (zero, c, -s), (zero, s, c)),
+                1: ((c, zero, s), (zero, one, zero), (-s, zero, c)),
+                2: ((c, -s, zero), (s, c, zero), (zero, zero, one))}[axis]
+        return torch.stack([torch.stack(row, -1) for row in rows], -2)
+    x, y, z = torch.unbind(euler, -1)
+    return elemental(z, 2) @ elemental(y, 1) @ elemental(x, 0)
+
+def matrix_to_quarternion(mat):
+    """
+    (x, y, z, w) quaternion of rotation matrices with a positive real part, (..., 3, 3) --> (..., 4)
+    The best conditioned of the four candidates is gathered per element.
+    """
+    m00, m01, m02 = torch.unbind(mat[..., 0, :], -1)
+    m10, m11, m12 = torch.unbind(mat[..., 1, :], -1)
+    m20, m21, m22 = torch.unbind(mat[..., 2, :], -1)
+    q_abs = _sqrt_positive_part(
+        torch.stack(
+            [
+                1.0 + m00 - m11 - m22,
+                1.0 - m00 + m11 - m22,
+                1.0 - m00 - m11 + m22,
+                1.0 + m00 + m11 + m22,
+            ],
+            dim=-1,
+        )
+    )
+    quat_by_ijkr = torch.stack(
+        [
+            torch.stack([q_abs[..., 0] ** 2, m10 + m01, m02 + m20, m21 - m12], dim=-1),
+            torch.stack([m10 + m01, q_abs[..., 1] ** 2, m12 + m21, m02 - m20], dim=-1),
+            torch.stack([m20 + m02, m21 + m12, q_abs[..., 2] ** 2, m10 - m01], dim=-1),
+            torch.stack([m21 - m12, m02 - m20, m10 - m01, q_abs[..., 3] ** 2], dim=-1),
+        ],
+        dim=-2,
+    )
+    quat_candidates = quat_by_ijkr / (2.0 * q_abs[..., None].clamp_min(0.1))
+
+    best = q_abs.argmax(dim=-1)[..., None, None].expand(mat.shape[:-2] + (1,4))
+    out = torch.gather(quat_candidates, -2, best).squeeze(-2)
+    return standardize_quaternion(out)
+
+def decide_orientation(orn,dim):
+    """
+    Converts raw (x, y, z, w) quaternions to the requested representation [3D,4D,6D]
+    """
+    if dim=='4D':
+        return orn
+
+    elif dim=='3D':
+        return quarternion_to_euler(orn)
+
+    elif dim=='6D':
+        return quarternion_to_ortho6d(orn)
+
+def resolve_orientation(orn,dim):
+    """
+    Converts 6D orientations back to the requested representation [3D,4D,6D]
+    """
+    if dim=='6D':
+        return orn
+
+    elif dim=='3D':
+        return matrix_to_euler(ortho6d_to_matrix(orn))
+
+    elif dim=='4D':
+        return matrix_to_quarternion(ortho6d_to_matrix(orn))
+
+def convert_pose(pose,dim,offset=3):
+    """
+    Replaces the raw quaternion stored at pose[..., offset:offset+4] with the requested
+    representation, position and joint coordinates are left untouched
+    """
+    if dim=='4D':
+        return pose
+    orn = decide_orientation(pose[..., offset:offset+4],dim)
+    return torch.cat((pose[..., :offset],orn,pose[..., offset+4:]),dim=-1)
+
+def check_roundtrips(shape=(100,16), atol=1e-5):
+    """
+    Round trips over random unit quaternions and Euler angles, raises on the first mismatch. The
+    Euler angles are checked against matrices composed from the elemental rotations, which do not
+    share the atan2 extraction of the conversions
+    """
+    q = standardize_quaternion(normalize_vector(torch.randn(shape + (4,), dtype=torch.float64)))
+    mat = quarternion_to_matrix(q)
+    eye = torch.eye(3, dtype=q.dtype).expand_as(mat)
+    # pitch away from the gimbal lock so that the angles are unique
+    euler = (torch.rand(shape + (3,), dtype=q.dtype)*2 - 1)*torch.tensor([torch.pi, 0.49*torch.pi, torch.pi], dtype=q.dtype)
+
+    checks = {
+        "orthonormal" : (mat @ mat.transpose(-1,-2), eye),
+        "determinant" : (torch.linalg.det(mat), torch.ones(shape, dtype=q.dtype)),
+        "4D-->matrix-->4D" : (matrix_to_quarternion(mat), q),
+        "4D-->6D-->4D" : (resolve_orientation(decide_orientation(q,'6D'),'4D'), q),
+        "4D-->6D-->matrix" : (ortho6d_to_matrix(decide_orientation(q,'6D')), mat),
+        "4D-->3D-->matrix" : (euler_to_matrix(decide_orientation(q,'3D')), mat),
+        "3D-->matrix-->3D" : (matrix_to_euler(euler_to_matrix(euler)), euler),
+        "3D-->4D-->3D" : (decide_orientation(matrix_to_quarternion(euler_to_matrix(euler)),'3D'), euler),
+        "4D-->6D-->3D" : (resolve_orientation(decide_orientation(q,'6D'),'3D'), decide_orientation(q,'3D')),
+    }
+    for name, (out, ref) in checks.items():
+        if not torch.allclose(out, ref, atol=atol):
+            raise AssertionError(f'Orientation round trip failed: {name}, '
+                                 f'max error {(out - ref).abs().max().item():.3e}')
+        print(f'{name:<20} ok')
+
+def benchmark(shape=(1000,1024), repeats=10, device='cpu'):
+    """
+    Micro-benchmark of the trajectory-level conversions, reports poses per second
+    """
+    q = normalize_vector(torch.randn(shape + (4,), device=device))
+    o6 = decide_orientation(q,'6D')
+    cases = {
+        "4D-->6D" : lambda: decide_orientation(q,'6D'),
+        "4D-->3D" : lambda: decide_orientation(q,'3D'),
+        "6D-->4D" : lambda: resolve_orientation(o6,'4D'),
+        "6D-->3D" : lambda: resolve_orientation(o6,'3D'),
+    }
+    results = {}
+    with torch.inference_mode():
+        for name, fn in cases.items():
+            fn()
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            ts = time.perf_counter()
+            for _ in range(repeats):
+                fn()
+            if device != 'cpu':
+                torch.cuda.synchronize()
+            dt = (time.perf_counter() - ts)/repeats
+            results[name] = q[..., 0].numel()/dt
+            print(f'{name:<10} {results[name]/1e6:8.2f} M poses/s')
+    return results
+
+if __name__ == '__main__':
+    check_roundtrips()
+    benchmark()
@@ -0,0 +1,197 @@
+"""
+Background plot renderer of the generation postprocessor. The postprocessor collects plot jobs as
+numpy arrays, dumps them once to a pickle and launches this module as a detached process, so a
+generation run returns as soon as its tensors are saved.
+
+Rendering is headless (Agg) and bounded in cost: every series is decimated to at most MAXPOINTS
+samples and, above MAXLINES environments, the individual lines are replaced by the median and the
+25-75 / 5-95 percentile bands over environments.
+
+python plotworker.py <payload.pkl>
+"""
+import os
+import sys
+import pickle
+import subprocess
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.gridspec as grid
+from matplotlib import pyplot as plt
+
+MAXPOINTS = 1000
+MAXLINES = 16
+BANDS = ((5,95),(25,75))
+
+def decimate(x, maxpoints=MAXPOINTS):
+    """
+    Strided decimation over the first (time) axis, returns the kept steps and samples
+    """
+    stride = max(1, int(np.ceil(x.shape[0]/maxpoints)))
+    steps = np.arange(0, x.shape[0], stride)
+    return steps, x[::stride]
+
+def plot_series(ax, x, style=None, label=None):
+    """
+    Plots a (T, envs) series, individual environments below MAXLINES, percentile bands above
+    """
+    steps, x = decimate(np.asarray(x))
+    if x.ndim == 1 or x.shape[1] <= MAXLINES:
+        if style is None:
+            ax.plot(steps, x, linewidth=0.8)
+        else:
+            ax.plot(steps, x, style, label=label)
+        return
+    for alpha, (lo, hi) in zip((0.2, 0.4), BANDS):
+        ax.fill_between(steps, np.percentile(x, lo, axis=1), np.percentile(x, hi, axis=1),
+                        color='tab:blue', alpha=alpha, linewidth=0, label=f'p{lo}-p{hi}')
+    ax.plot(steps, np.median(x, axis=1), color='tab:blue' if style is None else 'r',
+            linewidth=1.0, label='median' if label is None else label)
+
+def savefig(fig, path, name):
+    fig.tight_layout(pad=3)
+    fig.subplots_adjust(top = .96)
+    fig.savefig(f'{path}/{name}.png',bbox_inches='tight')
+    plt.close(fig)
+
+def render_linkmassdist(path, joints, mass):
+    """
+    Distribution of link masses over environments, mass size = (1, num envs, num links)
+    """
+    fig, axs = plt.subplots(mass.shape[2], figsize=(20,20))
+    fig.suptitle(f'Masses of Each Link, {joints+2} Links')
+    for i in range(mass.shape[2]):
+        axs[i].grid()
+        axs[i].set(xlabel='Mass [kg]')
+        axs[i].set(ylabel='Envs', title='Link'+str(i)+'')
+        axs[i].hist(mass[:,:,i].ravel(), bins=40)
+    savefig(fig, path, 'linkmass_dist')
+
+def render_control(path, joints, control):
+    """
+    Control trajectory among dofs, control size = (num iters, num envs, num joints)
+    """
+    fig, axs = plt.subplots(joints, figsize=(20,20))
+    fig.suptitle(f'Control Action Among Dofs, {joints} Joints')
+    for i in range(joints):
+        axs[i].set(ylabel='Control Action [Nm, deg, deg/s]', title='Joint'+str(i)+'')
+        plot_series(axs[i], control[1:,:,i])
+        axs[i].grid()
+        axs[i].set(xlabel='Iteration Steps')
+    savefig(fig, path, 'buffer_control')
+
+def render_trajectory(path, pose, target, labels, norient):
+    """
+    End effector pose and joint positions, pose size = (num iters, num envs, num coords), the
+    first three coordinates are positions followed by norient orientation coordinates
+    """
+    ncoords = pose.shape[2]
+    nrows = int(np.ceil(ncoords/2))
+    fig = plt.figure(figsize=(20,20))
+    gs = grid.GridSpec(nrows,2, figure=fig)
+    fig.suptitle('Output: Full Pose and Joint Positions')
+    for k in range(ncoords):
+        axs = fig.add_subplot(gs[k % nrows, k // nrows])
+        if k <= 2:
+            plot_series(axs, pose[:,:,k])
+            axs.set(ylabel='m', title=labels[k])
+            if target is not None:
+                plot_series(axs, target[:,:,k], 'r-', label='target')
+        elif k <= 2 + norient:
+            plot_series(axs, pose[:,:,k])
+            axs.set(ylabel='[-]', title=labels[k])
+        else:
+            plot_series(axs, np.rad2deg(pose[:,:,k]))
+            axs.set(ylabel='deg', title=labels[k])
+        axs.grid()
+        axs.set(xlabel='Iteration Steps')
+    savefig(fig, path, 'buffer_pose')
+
+def render_saturation_histogram(path, joints, diff):
+    """
+    Joint saturation distribution, diff size = (num envs, num joints)
+    """
+    fig, axs = plt.subplots(joints, figsize=(20,20))
+    fig.suptitle(f'Joint Saturation Probability, {joints} Total Joints')
+    for i in range(joints):
+        axs[i].set(ylabel=f'Saturation', title='Joint'+str(i)+'')
+        axs[i].hist(diff[:,i], bins=40)
+        axs[i].grid()
+        axs[i].set(xlabel='Iteration Steps')
+    savefig(fig, path, 'saturation_dist')
+
+def render_collision_histogram(path, joints, diff):
+    """
+    End effector height distribution, diff size = (num envs,)
+    """
+    fig, axs = plt.subplots(figsize=(20,20))
+    fig.suptitle(f'Joint Saturation Probability, {joints} Total Joints')
+    axs.set(ylabel=f'Saturation', title='Collision Plot')
+    axs.hist(diff, bins=10)
+    axs.grid()
+    axs.set(xlabel='Iteration Steps')
+    savefig(fig, path, 'collision_dist')
+
+def render_secondary_var(path, joints, var, varname):
+    """
+    Secondary variable other than control and trajectory, var size = (num envs, num joints, num iters)
+    """
+    b = [-10, -10, -5, -10, -5, -5, -2.5, -2,5, -2.5]
+    t = [10, 10, 5, 10, 5, 5, 2.5, 2,5, 2.5]
+    fig, axs = plt.subplots(joints, figsize=(20,20))
+    fig.suptitle(f'Joint {varname} Variation, {joints} Total Joints')
+    for i in range(joints):
+        axs[i].set(ylabel=f'{varname}', title='Joint'+str(i)+'')
+        plot_series(axs[i], var[:,i,1:].T)
+        axs[i].grid()
+        axs[i].set(xlabel='Iteration Steps')
+        if varname=="benchmark_control_error":
+            axs[i].set_ylim(b[i],t[i])
+    savefig(fig, path, varname)
+
+RENDERERS = {
+    "linkmassdist" : render_linkmassdist,
+    "control" : render_control,
+    "trajectory" : render_trajectory,
+    "saturation_histogram" : render_saturation_histogram,
+    "collision_histogram" : render_collision_histogram,
+    "secondary_var" : render_secondary_var,
+}
+
+def render(jobs):
+    """
+    Renders a list of (name, kwargs) plot jobs, a failing job does not stop the others
+    """
+    for name, kwargs in jobs:
+        ts = time.perf_counter()
+        try:
+            RENDERERS[name](**kwargs)
+            print(f'Rendered {name} in {time.perf_counter()-ts:.2f}s')
+        except Exception as e:
+            print(f'Failed to render {name}: {e!r}')
+
+def submit(jobs, path, wait=False):
+    """
+    Dumps the plot jobs next to the plots and renders them in a detached process, the
+    returned process handle may be waited on but does not need to be
+    """
+    payload = f'{path}/plotjobs_{os.getpid()}_{time.time_ns()}.pkl'
+    with open(payload, 'wb') as f:
+        pickle.dump(jobs, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(f'{path}/plotworker.log', 'a') as log:
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), payload],
+                                stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+    print(f'Plots are rendered in the background (pid {proc.pid}) to:\n{path}')
+    if wait:
+        proc.wait()
+    return proc
+
+if __name__ == '__main__':
+    payload = sys.argv[1]
+    with open(payload, 'rb') as f:
+        jobs = pickle.load(f)
+    os.remove(payload)
+    render(jobs)
@@ -2,6 +2,7 @@ import torch
 from matplotlib import pyplot as plt
 import numpy as np
 from isaacgym import gymapi
+from rng import CAMPAIGN
 
 class randomize():
     """
@@ -214,7 +215,8 @@ class randomize():
 class envinit(randomize):
     """
     Creates the environments and situates the assets according to the args provided by the user, randomization
-    is also handled if required by args
+    is also handled if required by args. rng holds the streams of the campaign seed drawn and logged by
+    the generation script, there is no fallback seed
     """
     def __init__(self,
                  args,
@@ -238,10 +240,12 @@ class envinit(randomize):
                  damping_nom,
                  coulomb_nom,
                  pos_end,
-                 vel_end
+                 vel_end,
+                 rng
                  ):
         
         super().__init__(args)
+        self.rng = rng
         self.gym = gym
         self.sim = sim
         self.envl = env_lower
@@ -277,7 +281,7 @@ class envinit(randomize):
         _asset_options.disable_gravity = disable_gravity    
             
         if self.args.random_angular_damping: 
-            _asset_options.angular_damping = np.random.uniform(self.dict["adb"][0],self.dict["adb"][1])
+            _asset_options.angular_damping = self.rng.uniform(CAMPAIGN,"asset",self.dict["adb"][0],self.dict["adb"][1])
         else:
             _asset_options.angular_damping = angdamp_nom
 
@@ -313,9 +317,102 @@ class envinit(randomize):
         self.sim = sim_
         self.gym = gym_
         
+    def randomize_actor(self, i, env, handle):
+        """
+        Draws the initial state and the dynamics of env i from its init and dynamics streams and
+        applies the dof and rigid body properties to its actor, the drawn initial state is left in
+        self.dof_state. Returns the link masses of the env.
+        """
+        rigid_body_prop = self.gym.get_actor_rigid_body_properties(env, handle)
+        link_mass_tensor = torch.zeros(self.tlinks,dtype=torch.float32,device=self.args.graphics_device_id)
+        ginit = self.rng.generator(i,"init")
+        gdyn = self.rng.generator(i,"dynamics")
+        
+        if self.args.random_initial_positions:
+            magnitude = ginit.uniform(0.2,0.8)
+            self.dof_state["pos"][0] =  magnitude * np.sign(ginit.uniform(-1,1)) * \
+                        ginit.uniform(self.flower_limits[0],self.fupper_limits[0]) 
+            self.dof_state["pos"][1:7] = self.fmid[1:7] + np.sign(ginit.uniform(-1,1)) * \
+                        0.25 * ginit.uniform(0,1,6)
+            
+        if self.args.random_initial_velocities:
+            magnitude = ginit.uniform(0.2,0.8)
+            self.dof_state["vel"][0] =  magnitude * np.sign(ginit.uniform(-1,1)) * \
+                        ginit.uniform(0,0.5) 
+            self.dof_state["vel"][1:7] = magnitude * np.sign(ginit.uniform(-1,1)) * \
+                        ginit.uniform(0,2,6) 
+
+        if self.args.random_stiffness:
+            self.dof_prop["stiffness"] = gdyn.uniform(self.dict["sb"][0],self.dict["sb"][1],9) 
+
+        if self.args.random_damping:
+            self.dof_prop["damping"] = gdyn.uniform(self.dict["db"][0],self.dict["db"][1],9) 
+
+        if self.args.random_coulomb_friction:
+            self.dof_prop["friction"] = gdyn.uniform(self.dict["cb"][0],self.dict["cb"][1],9)     
+
+        for l,link_props in enumerate(rigid_body_prop):
+            if self.args.random_masses:
+                link_props.mass = gdyn.uniform(self.dict["mb"][0][l],self.dict["mb"][1][l])
+            else:
+                link_props.mass = self.dict["mb"][l]
+            link_mass_tensor[l] = link_props.mass
+
+            if self.args.random_coms:
+                link_props.com.x = gdyn.uniform(self.dict["comb"][0][l][0],self.dict["comb"][1][l][0])
+                link_props.com.y = gdyn.uniform(self.dict["comb"][0][l][1],self.dict["comb"][1][l][1])     
+                link_props.com.z = gdyn.uniform(self.dict["comb"][0][l][2],self.dict["comb"][1][l][2])   
+            else:
+                link_props.com.x = self.dict["comb"][l][0]
+                link_props.com.y = self.dict["comb"][l][1]     
+                link_props.com.z = self.dict["comb"][l][2]  
+
+            if self.args.random_inertias:
+                link_props.inertia.x.x = gdyn.uniform(self.dict["ib"][0][l][0],self.dict["ib"][1][l][0])
+                link_props.inertia.x.y = gdyn.uniform(self.dict["ib"][0][l][1],self.dict["ib"][1][l][1]) 
+                link_props.inertia.x.z = gdyn.uniform(self.dict["ib"][0][l][2],self.dict["ib"][1][l][2]) 
+                link_props.inertia.y.x = gdyn.uniform(self.dict["ib"][0][l][1],self.dict["ib"][1][l][1]) 
+                link_props.inertia.y.y = gdyn.uniform(self.dict["ib"][0][l][3],self.dict["ib"][1][l][3]) 
+                link_props.inertia.y.z = gdyn.uniform(self.dict["ib"][0][l][4],self.dict["ib"][1][l][4])
+                link_props.inertia.z.x = gdyn.uniform(self.dict["ib"][0][l][2],self.dict["ib"][1][l][2]) 
+                link_props.inertia.z.y = gdyn.uniform(self.dict["ib"][0][l][4],self.dict["ib"][1][l][4]) 
+                link_props.inertia.z.z = gdyn.uniform(self.dict["ib"][0][l][5],self.dict["ib"][1][l][5])
+            else:
+                link_props.inertia.x.x = self.dict["ib"][l][0]
+                link_props.inertia.x.y = self.dict["ib"][l][1]
+                link_props.inertia.x.z = self.dict["ib"][l][2]
+                link_props.inertia.y.x = self.dict["ib"][l][1]
+                link_props.inertia.y.y = self.dict["ib"][l][3] 
+                link_props.inertia.y.z = self.dict["ib"][l][4]
+                link_props.inertia.z.x = self.dict["ib"][l][2] 
+                link_props.inertia.z.y = self.dict["ib"][l][4]
+                link_props.inertia.z.z = self.dict["ib"][l][5]
+        self.gym.set_actor_dof_properties(env, handle, self.dof_prop)
+        self.gym.set_actor_rigid_body_properties(env, handle, rigid_body_prop,0)
+        self.rigid_body_prop = rigid_body_prop
+        return link_mass_tensor
+
+    def rerandomize(self, rng):
+        """
+        Re-samples the randomization of the already created envs from the streams of a new run,
+        the sim, the asset and the actor handles are reused. Asset options such as the angular
+        damping are fixed at load time and are kept.
+        Returns the initial dof states as a (num envs * num dofs, 2) tensor to be written with
+        gym.set_dof_state_tensor and the new link masses (1, num envs, num links).
+        """
+        self.rng = rng
+        self.dynamical_inclusion = torch.zeros(0,self.tlinks,dtype=torch.float32,device=self.args.graphics_device_id)
+        dof_states = []
+        for i,(env,handle) in enumerate(zip(self.envs,self.handles)):
+            link_mass_tensor = self.randomize_actor(i, env, handle)
+            dof_states.append(np.stack((self.dof_state["pos"],self.dof_state["vel"]),-1))
+            self.dynamical_inclusion = torch.cat((self.dynamical_inclusion,link_mass_tensor.unsqueeze(0)) , dim = 0)
+        return torch.tensor(np.concatenate(dof_states),dtype=torch.float32), self.dynamical_inclusion.unsqueeze(0)
+
     def create_envs(self):
         """
-        Creates and randomizes envs and assets
+        Creates and randomizes envs and assets, every env draws from its own init and dynamics
+        streams so that its parameters do not depend on the other envs
         """
         print("Creating %d environments\n" % self.args.num_envs)
 
@@ -326,72 +423,8 @@ class envinit(randomize):
             self.handles.append(franka_handle)
             if self.args.measure_force:
                 self.gym.enable_actor_dof_force_sensors(env, franka_handle)
-            rigid_body_prop = self.gym.get_actor_rigid_body_properties(env, franka_handle)
-            link_mass_tensor = torch.zeros(self.tlinks,dtype=torch.float32,device=self.args.graphics_device_id)
-            
-            if self.args.random_initial_positions:
-                magnitude = torch.rand(1).uniform_(0.2,0.8).numpy()
-                self.dof_state["pos"][0] =  magnitude * np.sign(torch.rand(1).uniform_(-1,1).numpy()) * \
-                            torch.rand(1).uniform_(self.flower_limits[0],self.fupper_limits[0]).numpy() 
-                self.dof_state["pos"][1:7] = self.fmid[1:7] + np.sign(torch.rand(1).uniform_(-1,1).numpy()) * \
-                            0.25 * torch.rand(6).numpy()
-                
-            if self.args.random_initial_velocities:
-                magnitude = torch.rand(1).uniform_(0.2,0.8).numpy()
-                self.dof_state["vel"][0] =  magnitude * np.sign(torch.rand(1).uniform_(-1,1).numpy()) * \
-                            torch.rand(1).uniform_(0,0.5).numpy() 
-                self.dof_state["vel"][1:7] = magnitude * np.sign(torch.rand(1).uniform_(-1,1).numpy()) * \
-                            torch.rand(6).uniform_(0,2).numpy() 
-
-            if self.args.random_stiffness:
-                self.dof_prop["stiffness"] = np.random.uniform(self.dict["sb"][0],self.dict["sb"][1],9) 
-
-            if self.args.random_damping:
-                self.dof_prop["damping"] = np.random.uniform(self.dict["db"][0],self.dict["db"][1],9) 
-
-            if self.args.random_coulomb_friction:
-                self.dof_prop["friction"] = np.random.uniform(self.dict["cb"][0],self.dict["cb"][1],9)     
-
-            for i,link_props in enumerate(rigid_body_prop):
-                if self.args.random_masses:
-                    link_props.mass = np.random.uniform(self.dict["mb"][0][i],self.dict["mb"][1][i])
-                else:
-                    link_props.mass = self.dict["mb"][i]
-                link_mass_tensor[i] = link_props.mass
-
-                if self.args.random_coms:
-                    link_props.com.x = np.random.uniform(self.dict["comb"][0][i][0],self.dict["comb"][1][i][0])
-                    link_props.com.y = np.random.uniform(self.dict["comb"][0][i][1],self.dict["comb"][1][i][1])     
-                    link_props.com.z = np.random.uniform(self.dict["comb"][0][i][2],self.dict["comb"][1][i][2])   
-                else:
-                    link_props.com.x = self.dict["comb"][i][0]
-                    link_props.com.y = self.dict["comb"][i][1]     
-                    link_props.com.z = self.dict["comb"][i][2]  
-
-                if self.args.random_inertias:
-                    link_props.inertia.x.x = np.random.uniform(self.dict["ib"][0][i][0],self.dict["ib"][1][i][0])
-                    link_props.inertia.x.y = np.random.uniform(self.dict["ib"][0][i][1],self.dict["ib"][1][i][1]) 
-                    link_props.inertia.x.z = np.random.uniform(self.dict["ib"][0][i][2],self.dict["ib"][1][i][2]) 
-                    link_props.inertia.y.x = np.random.uniform(self.dict["ib"][0][i][1],self.dict["ib"][1][i][1]) 
-                    link_props.inertia.y.y = np.random.uniform(self.dict["ib"][0][i][3],self.dict["ib"][1][i][3]) 
-                    link_props.inertia.y.z = np.random.uniform(self.dict["ib"][0][i][4],self.dict["ib"][1][i][4])
-                    link_props.inertia.z.x = np.random.uniform(self.dict["ib"][0][i][2],self.dict["ib"][1][i][2]) 
-                    link_props.inertia.z.y = np.random.uniform(self.dict["ib"][0][i][4],self.dict["ib"][1][i][4]) 
-                    link_props.inertia.z.z = np.random.uniform(self.dict["ib"][0][i][5],self.dict["ib"][1][i][5])
-                else:
-                    link_props.inertia.x.x = self.dict["ib"][i][0]
-                    link_props.inertia.x.y = self.dict["ib"][i][1]
-                    link_props.inertia.x.z = self.dict["ib"][i][2]
-                    link_props.inertia.y.x = self.dict["ib"][i][1]
-                    link_props.inertia.y.y = self.dict["ib"][i][3] 
-                    link_props.inertia.y.z = self.dict["ib"][i][4]
-                    link_props.inertia.z.x = self.dict["ib"][i][2] 
-                    link_props.inertia.z.y = self.dict["ib"][i][4]
-                    link_props.inertia.z.z = self.dict["ib"][i][5]   
-
+            link_mass_tensor = self.randomize_actor(i, env, franka_handle)
             self.gym.set_actor_dof_states(env, franka_handle, self.dof_state , gymapi.STATE_ALL)
-            self.gym.set_actor_dof_properties(env, franka_handle, self.dof_prop)
-            self.gym.set_actor_rigid_body_properties(env, franka_handle, rigid_body_prop,0)
             self.dynamical_inclusion = torch.cat((self.dynamical_inclusion,link_mass_tensor.unsqueeze(0)) , dim = 0)
                 
             hand_handle = self.gym.find_actor_rigid_body_handle(env, franka_handle, "panda_hand")
@@ -404,11 +437,11 @@ class envinit(randomize):
             
         print(f"Exerpt dof_state of a single env:\n{self.dof_state}\n")
         print(f"Exerpt dof_props of a single env:\n{self.dof_prop}\n")
-        print(f"Exerpt rigid_props of a single env:\nMass of link1: {rigid_body_prop[1].mass}\n"
-              f"CoM of link1: {rigid_body_prop[1].com}\n"
-              f"Inertia x of link1: {rigid_body_prop[1].inertia.x}\n"
-              f"Inertia y of link1: {rigid_body_prop[1].inertia.y}\n"
-              f"Inertia z of link1: {rigid_body_prop[1].inertia.z}")
+        print(f"Exerpt rigid_props of a single env:\nMass of link1: {self.rigid_body_prop[1].mass}\n"
+              f"CoM of link1: {self.rigid_body_prop[1].com}\n"
+              f"Inertia x of link1: {self.rigid_body_prop[1].inertia.x}\n"
+              f"Inertia y of link1: {self.rigid_body_prop[1].inertia.y}\n"
+              f"Inertia z of link1: {self.rigid_body_prop[1].inertia.z}")
               
         print("\n--- Succesfully Created %d environments ----" % self.args.num_envs)  
         return {
@@ -0,0 +1,54 @@
+"""
+Counter-based random number streams for the generation campaign. Every draw comes from a Philox
+generator keyed by (campaign seed, env id, stream), so the randomization and the excitation of an
+environment do not depend on how many environments are simulated, on their order or on the other
+draws of the run. Any subset of environments can be regenerated bit-exactly, or a campaign can be
+sharded over workers with --env-offset.
+
+Streams:
+asset: asset options shared by every environment - campaign env id
+init: initial joint positions and velocities
+dynamics: link masses, coms, inertias, dof stiffness, damping and coulomb friction
+excitation: imposed control trajectories
+osc: osc task parameters
+osc_gains: osc gains, kept apart from osc so that the gains do not reuse the deviates of the task
+"""
+import numpy as np
+import torch
+
+STREAMS = {"asset" : 0,
+           "init" : 1,
+           "dynamics" : 2,
+           "excitation" : 3,
+           "osc" : 4,
+           "osc_gains" : 5}
+
+CAMPAIGN = 2**32 - 1
+
+class streams():
+    """
+    Philox stream factory of a campaign, env ids are global ids, the local env index of a worker
+    is shifted by its offset
+    """
+    def __init__(self, seed, offset=0):
+        self.seed = int(seed)
+        self.offset = int(offset)
+
+    def __str__(self):
+        return f'Counter-based RNG of campaign seed {self.seed}'
+
+    def key(self, env, stream):
+        env = CAMPAIGN if env == CAMPAIGN else self.offset + int(env)
+        return np.array([self.seed, (env << 32) | STREAMS[stream]], dtype=np.uint64)
+
+    def generator(self, env, stream):
+        """
+        Fresh generator of a (env, stream) pair, the counter always starts at zero
+        """
+        return np.random.Generator(np.random.Philox(key=self.key(env, stream)))
+
+    def uniform(self, env, stream, low=0.0, high=1.0, size=None):
+        return self.generator(env, stream).uniform(low, high, size)
+
+    def tensor(self, values, device='cpu'):
+        return torch.as_tensor(np.asarray(values), dtype=torch.float32, device=device)
@@ -0,0 +1,32 @@
+"""
+Round trips of the orientation conversions, run from the repository root: python -m pytest
+"""
+import pytest
+import torch
+from data_generation.orientation import (ORIENTATION_DIMS, check_roundtrips, convert_pose, decide_orientation,
+                                         resolve_orientation, normalize_vector, standardize_quaternion)
+
+@pytest.mark.parametrize("shape", [(7,), (20,16), (3,4,5)])
+def test_roundtrips(shape):
+    torch.manual_seed(0)
+    check_roundtrips(shape)
+
+@pytest.mark.parametrize("dim", ["3D", "4D", "6D"])
+def test_resolve_inverts_decide(dim):
+    torch.manual_seed(0)
+    q = standardize_quaternion(normalize_vector(torch.randn(50, 4, dtype=torch.float64)))
+    orn = decide_orientation(q, dim)
+    assert orn.shape[-1] == ORIENTATION_DIMS[dim]
+    assert torch.allclose(resolve_orientation(decide_orientation(q, '6D'), dim), orn, atol=1e-8)
+
+@pytest.mark.parametrize("dim", ["3D", "4D", "6D"])
+def test_convert_pose_keeps_coordinates(dim):
+    torch.manual_seed(0)
+    pose = torch.randn(10, 3, 14, dtype=torch.float64)
+    pose[..., 3:7] = normalize_vector(pose[..., 3:7])
+    out = convert_pose(pose, dim)
+    n = ORIENTATION_DIMS[dim]
+    assert out.shape[-1] == 14 - 4 + n
+    assert torch.equal(out[..., :3], pose[..., :3])
+    assert torch.equal(out[..., 3+n:], pose[..., 7:])
+    assert torch.allclose(out[..., 3:3+n], decide_orientation(pose[..., 3:7], dim))
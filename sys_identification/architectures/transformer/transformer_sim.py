@@ -7,6 +7,7 @@ from dataclasses import dataclass
 import torch.nn as nn
 import torch
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 import math
 
 @dataclass
@@ -48,7 +49,7 @@ class SelfAttention(nn.Module):
     def forward(self, x):
         if self.causal:
             seq_len = x.shape[1]
-            mask = nn.Transformer.generate_square_subsequent_mask(seq_len, device=x.device)
+            mask = torch.ones(seq_len, seq_len, dtype=torch.bool, device=x.device).triu(1) # dtype agnostic under autocast
             x = self.mha(x, x, x, attn_mask=mask, is_causal=True)[0]
         else:
             x = self.mha(x, x, x, is_causal=False)[0]
@@ -133,10 +134,14 @@ class TransformerEncoder(nn.Module):
             [TransformerEncoderLayer(d_model, n_heads, dropout, bias) for _ in range(n_layers)]
         )
         self.ln_f = LayerNorm(d_model, bias)
+        self.checkpoint = False
 
     def forward(self, x):
         for block in self.blocks:
-            x = block(x)
+            if self.checkpoint and torch.is_grad_enabled():
+                x = checkpoint(block, x, use_reentrant=False)  # activations recomputed in backward
+            else:
+                x = block(x)
         x = self.ln_f(x)  # final layer normalization
         return x
 
@@ -148,10 +153,14 @@ class TransformerDecoder(nn.Module):
             [TransformerDecoderLayer(d_model, n_heads, dropout, bias) for _ in range(n_layers)]
         )
         self.ln_f = LayerNorm(d_model, bias)
+        self.checkpoint = False
 
     def forward(self, x, mem):
         for block in self.blocks:
-            x = block(x, mem)
+            if self.checkpoint and torch.is_grad_enabled():
+                x = checkpoint(block, x, mem, use_reentrant=False)  # activations recomputed in backward
+            else:
+                x = block(x, mem)
         x = self.ln_f(x)  # final layer normalization
         return x
 
@@ -193,11 +202,41 @@ class TSTransformer(nn.Module):
         tgt = tok_emb_new + pos_emb_new
         return tgt
 
-    def forward(self, y, u, u_new):
+    def set_checkpointing(self, enabled):
+        """
+        Per-block activation checkpointing of the encoder and the decoder, only the block inputs are
+        stored in the forward pass and the blocks are recomputed in the backward pass
+        """
+        self.encoder.checkpoint = enabled
+        self.decoder.checkpoint = enabled
+
+    def chunked_loss(self, output, y_new, lossfn, chunk):
+        """
+        lm_head and loss over the horizon in chunks of chunk steps, each chunk is recomputed in the
+        backward pass so that the predictions of a single chunk are alive at a time. lossfn receives
+        the position of the chunk within the horizon and returns the contribution of the chunk to the
+        loss of the whole horizon, the contributions are summed - refer to losses.getloss
+        """
+        seq_len = output.shape[1]
+        loss = 0.0
+        for i in range(0, seq_len, chunk):
+            h, y_chunk = output[:, i:i+chunk], y_new[:, i:i+chunk]
+            head = lambda h, y_chunk, i=i: lossfn(self.lm_head(h).float(), y_chunk, i, seq_len)
+            if torch.is_grad_enabled():
+                chunk_loss = checkpoint(head, h, y_chunk, use_reentrant=False)
+            else:
+                chunk_loss = head(h, y_chunk)
+            loss = loss + chunk_loss
+        return loss
+
+    def forward(self, y, u, u_new, y_new=None, lossfn=None, chunk=0):
         src = self.embed_ctx(y, u)  # perhaps dropout of this?
         tgt = self.embed_new(u_new)  # perhaps dropout of this?
         mem = self.encoder(src)
         output = self.decoder(tgt, mem)
+        if lossfn is not None:
+            # loss computed inside forward so that DDP hooks see the chunked path
+            return self.chunked_loss(output, y_new, lossfn, chunk or output.shape[1])
         y_new_sim = self.lm_head(output)
         return y_new_sim
 
@@ -0,0 +1,167 @@
+"""
+Training throughput benchmark, runs a fixed number of steps of the training loop for every point
+of a grid of n_layer, n_embd, n_head, context percentage and batch size, on synthetic windows or
+on the cached windows of the first training file. A step is the micro-batch training step of
+train.py (dataset.trainstep). Reports samples/s, timesteps/s (samples times the window length),
+the peak memory and the time split between data wait, forward and backward with the optimizer
+step, and saves the results to benchmarks/<hostname>_<time>.json. Arguments after -- are the
+usual train.py arguments of the base config, e.g.
+
+python benchmark.py --n-layer 4 12 --batch-size 8 32 -- -dn MG1 transformer
+
+The phases are synchronized on cuda so that the split is attributable, which slightly lowers the
+reported throughput compared to an unsynchronized run.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import socket
+import argparse
+import datetime
+import itertools
+import subprocess
+import torch
+from pathlib import Path
+from torch.utils.data import DataLoader, TensorDataset
+
+from datasets import dataset
+from utils import arguments
+from prefetch import prefetcher
+from memory import resetpeak, peakmemory
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def run(args, windows, warmup, steps):
+    """
+    Benchmarks a single config, returns the throughput, the peak memory and the time split
+    """
+    datasets = dataset(args=args)
+    datasets.initialize_model()
+    modelargs, model, optimizer, scheduler = datasets.getmodel()
+    device = datasets.device
+
+    forward = datasets.gettrainforward(model)
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return time.perf_counter()
+
+    loader = DataLoader(datasets.preprocess(windows, train=True), batch_size=args.training_batch_size,
+                        shuffle=True, drop_last=True, pin_memory=device.type=='cuda', num_workers=args.num_workers)
+    if len(loader) == 0:
+        raise ValueError(f'{len(windows)} windows do not fill a batch of {args.training_batch_size}')
+    batches = iter(prefetcher(itertools.chain.from_iterable(itertools.repeat(loader)), device))
+
+    def timedforward(*batch):
+        t = sync()
+        loss = forward(*batch)
+        split["forward"] += sync() - t
+        return loss
+
+    # the steps are the training step of train.py, the forward is timed from within it
+    model.train()
+    split = {"data": 0.0, "forward": 0.0, "backward": 0.0}
+    for step in range(warmup + steps):
+        if step == warmup:
+            resetpeak(device)
+            split = dict.fromkeys(split, 0.0)
+            start = sync()
+        t0 = sync()
+        yctx, uctx, unew, ynew, scale = next(batches)
+        t1 = sync()
+        forwardtime = split["forward"]
+        training_loss, stepped = datasets.trainstep(timedforward, model, yctx, uctx, unew, ynew)
+        if stepped:
+            scheduler.step()
+        t2 = sync()
+        split["data"] += t1 - t0
+        split["backward"] += t2 - t1 - (split["forward"] - forwardtime)
+    elapsed = sync() - start
+
+    samples = steps*args.training_batch_size
+    return {
+        "samples_per_s" : round(samples/elapsed, 2),
+        "timesteps_per_s" : round(samples*datasets.sql/elapsed, 1),
+        "step_ms" : round(1000*elapsed/steps, 3),
+        "peak_memory_mb" : round(peakmemory(device)/2**20, 1),
+        "time_split" : {k: round(v/elapsed, 4) for k, v in split.items()},
+        "parameters" : sum(p.numel() for p in model.parameters())
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="FrankaSysId benchmark")
+    parser.add_argument('--n-layer', type=int, nargs='+', default=[12], help='transformer layers')
+    parser.add_argument('--n-embd', type=int, nargs='+', default=[192], help='embedding dimensions')
+    parser.add_argument('--n-head', type=int, nargs='+', default=[8], help='transformer heads')
+    parser.add_argument('--context', type=int, nargs='+', default=[20], help='percent of provided context')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[8], help='training batch sizes')
+    parser.add_argument('--data', type=str, default='synthetic', choices=['synthetic', 'cached'],
+                        help='random windows or the windows of the first training file')
+    parser.add_argument('--windows', type=int, default=512, help='number of synthetic windows')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed steps per config')
+    parser.add_argument('--steps', type=int, default=20, help='timed steps per config')
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    benchargs = parser.parse_args(argv[:split])
+    sys.argv = [sys.argv[0]] + argv[split+1:]
+    baseargs = arguments().parse_arguments()
+    baseargs.subcommand = baseargs.subcommand or 'transformer'
+
+    base = dataset(args=baseargs)
+    if benchargs.data == 'cached':
+        base.resolve_datasets()
+        base.load(sorted(base.traindatalist)[0])
+        windows = TensorDataset(base.gendict['control'], base.gendict['position'])
+    else:
+        windows = TensorDataset(torch.randn(benchargs.windows, baseargs.total_sim_iterations, baseargs.num_of_joints),
+                                torch.randn(benchargs.windows, baseargs.total_sim_iterations, base.ny))
+
+    results = []
+    for n_layer, n_embd, n_head, context, batch_size in itertools.product(benchargs.n_layer, benchargs.n_embd,
+                                                                          benchargs.n_head, benchargs.context,
+                                                                          benchargs.batch_size):
+        if n_embd % n_head:
+            continue
+        config = dict(n_layer=n_layer, n_embd=n_embd, n_head=n_head, context=context, training_batch_size=batch_size)
+        args = copy.copy(baseargs)
+        for key, value in config.items():
+            setattr(args, key, value)
+        try:
+            result = run(args, windows, benchargs.warmup, benchargs.steps)
+        except (torch.cuda.OutOfMemoryError, MemoryError) as e:
+            result = {"error": repr(e)}
+        results.append({**config, **result})
+        print(f'{config} --> {result}')
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    report = {
+        "host" : socket.gethostname(),
+        "time" : datetime.datetime.now().isoformat(timespec='seconds'),
+        "commit" : commit(),
+        "torch" : torch.__version__,
+        "device" : str(base.device),
+        "threads" : torch.get_num_threads(),
+        "data" : benchargs.data,
+        "steps" : benchargs.steps,
+        "base" : {k: v for k, v in vars(baseargs).items() if isinstance(v, (int, float, str, bool))},
+        "results" : results
+    }
+    benchpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks')
+    Path(benchpath).mkdir(exist_ok=True)
+    path = os.path.join(benchpath, f'{socket.gethostname()}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, sort_keys=True, indent=4)
+    print(f'\nBenchmark written to:\n{path}\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Checkpoint service, checkpoints are snapshotted to cpu memory on the training thread and serialized
+by a background thread. Files are written to a temporary path, synced and renamed into place so a
+crash mid-write never corrupts an existing checkpoint.
+"""
+
+import os
+import re
+import json
+import shutil
+import collections
+import torch
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+class checkpointer():
+    """
+    Background checkpoint writer with retention policies:
+    keep-last --> the last K checkpoints of the run are kept under models/checkpoints/<data name>,
+                  the newest one is also linked to models/<data name>/<model name>
+    keep-best --> the K checkpoints of lowest validation loss are kept as <model name>_best<iter>
+    One write is in flight at a time, a new save waits for the previous one so at most two
+    snapshots are held in memory. The retained checkpoints of a model are rebuilt from the files of
+    earlier runs on its first save, the loss of a best checkpoint is kept in a <file>.json sidecar.
+    """
+    def __init__(self, modelpath, dataname, keeplast=1, keepbest=1):
+        self.modelpath = modelpath
+        self.historypath = os.path.join(os.path.dirname(modelpath), 'checkpoints', dataname)
+        Path(self.historypath).mkdir(parents=True, exist_ok=True)
+        self.keeplast = keeplast
+        self.keepbest = keepbest
+        self.last = collections.deque()
+        self.best = []
+        self.restored = set()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def __str__(self):
+        return 'Checkpointer Object Instantiated'
+
+    def snapshot(self, obj):
+        """
+        Detached cpu copy of every tensor of a checkpoint, device tensors are copied into pinned
+        memory asynchronously and synchronized once
+        """
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type == 'cuda':
+                out = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+                return out.copy_(obj.detach(), non_blocking=True)
+            return obj.detach().clone()
+        if isinstance(obj, dict):
+            return {k: self.snapshot(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v) for v in obj)
+        return obj
+
+    def save(self, checkpoint, modelname, iter, loss=None):
+        """
+        Snapshots the checkpoint and queues the write, loss marks a best-model checkpoint
+        """
+        state = self.snapshot(checkpoint)
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        self.wait()
+        self.pending = self.executor.submit(self.persist, state, modelname, iter, loss)
+
+    def wait(self):
+        """
+        Waits for the write in flight, errors of the background thread are raised here
+        """
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def write(self, state, path):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return path
+
+    def link(self, src, dst):
+        """
+        Atomically points dst to the contents of src, hard link when possible, copy otherwise
+        """
+        tmp = f'{dst}.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    def bestloss(self, path):
+        """
+        Validation loss of a best checkpoint from its sidecar, from the checkpoint itself otherwise
+        """
+        try:
+            with open(f'{path}.json', 'r') as f:
+                return float(json.load(f)['loss'])
+        except (OSError, ValueError, KeyError):
+            pass
+        try:
+            return float(torch.load(path, map_location='cpu', mmap=True, weights_only=False)['bvalloss'][1])
+        except Exception:
+            return None
+
+    def restore(self, modelname):
+        """
+        Adds the checkpoints of earlier runs of a model to the retention lists, oldest first
+        """
+        if modelname in self.restored:
+            return
+        self.restored.add(modelname)
+        pattern = re.compile(rf'{re.escape(modelname)}_(best)?(\d{{8}})')
+        found = sorted((int(m.group(2)), m.group(1) is not None, os.path.join(self.historypath, name))
+                       for name in os.listdir(self.historypath) if (m := pattern.fullmatch(name)))
+        for _, isbest, path in found:
+            if not isbest:
+                if path not in self.last:
+                    self.last.append(path)
+            elif all(b[1] != path for b in self.best):
+                loss = self.bestloss(path)
+                if loss is not None:
+                    self.best.append((loss, path))
+        self.best.sort()
+
+    def persist(self, state, modelname, iter, loss):
+        self.restore(modelname)
+        if loss is None:
+            path = self.write(state, os.path.join(self.historypath, f'{modelname}_{iter:08d}'))
+            self.link(path, os.path.join(self.modelpath, modelname))
+            if path not in self.last:
+                self.last.append(path)
+            while len(self.last) > self.keeplast:
+                os.remove(self.last.popleft())
+        else:
+            path = self.write(state, os.path.join(self.historypath, f'{modelname}_best{iter:08d}'))
+            with open(f'{path}.json.tmp', 'w') as f:
+                json.dump({"loss": float(loss), "iter": iter}, f)
+            os.replace(f'{path}.json.tmp', f'{path}.json')
+            self.best = [b for b in self.best if b[1] != path] + [(loss, path)]
+            self.best.sort()
+            while len(self.best) > self.keepbest:
+                worst = self.best.pop()[1]
+                os.remove(worst)
+                if os.path.exists(f'{worst}.json'):
+                    os.remove(f'{worst}.json')
@@ -0,0 +1,8 @@
+"""
+The modules of sys_identification import each other by name, as when the scripts are run from this
+directory
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -14,18 +14,32 @@ import math
 import numpy as np
 from matplotlib import pyplot as plt
 from functools import partial
-from torch.utils.data import random_split, DataLoader, TensorDataset
-from torch.utils.tensorboard import SummaryWriter
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import random_split, DataLoader, TensorDataset, Sampler, Subset
 from torch.optim.lr_scheduler import ConstantLR, CosineAnnealingWarmRestarts, ExponentialLR, StepLR
 
 import datetime
+import time
 import os
+import contextlib
+import random
+import zlib
+import sys
 import json
 from pathlib import Path
 
 from architectures.transformer.transformer_sim import Config, TSTransformer
+from checkpoints import checkpointer
+from events import eventlog, export
+from ema import ema
+from losses import getloss
+from pipeline import pipeline, standardize, derivatives, context, augment
 from toydataset import *
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from data_generation.orientation import ORIENTATION_DIMS, convert_pose
+
 import wandb
 
 class cfg():
@@ -40,7 +54,187 @@ class cfg():
     WARMUP_ITERATIONS=200
 
     TOTAL_ITERATIONS=2000
+
+    SPLIT_RATIO=0.8
     
+class compiled():
+    """
+    torch.compile wrapper with an eager fallback when compilation fails, compilation happens lazily
+    on the first call. A failure of the first call or a dynamo/inductor error of a later
+    recompilation is reported once and the eager function is used from then on, any other error of
+    the step (out of memory, shapes, asserts) is raised.
+    """
+    def __init__(self, fn, **options):
+        self.eager = fn
+        self.fn = torch.compile(fn, **options)
+        self.first = True
+
+    def __call__(self, *args, **kwargs):
+        if self.fn is self.eager:
+            return self.eager(*args, **kwargs)
+        try:
+            out = self.fn(*args, **kwargs)
+        except Exception as e:
+            if not self.first and not isinstance(e, compileerrors()):
+                raise
+            print(f'\ntorch.compile failed, falling back to eager execution:\n{e!r}\n')
+            self.fn = self.eager
+            return self.eager(*args, **kwargs)
+        self.first = False
+        return out
+
+def compileerrors():
+    """
+    Exception types raised by the dynamo frontend and the inductor backend of torch.compile
+    """
+    errors = []
+    try:
+        from torch._dynamo.exc import TorchDynamoException
+        errors.append(TorchDynamoException)
+    except ImportError:
+        pass
+    try:
+        import torch._inductor.exc as inductor
+        errors.extend(getattr(inductor, name) for name in ('InductorError', 'LoweringException',
+                                                           'CppCompileError', 'CUDACompileError')
+                      if hasattr(inductor, name))
+    except ImportError:
+        pass
+    return tuple(errors)
+
+class resumablesampler(Sampler):
+    """
+    Shuffled sampler whose permutation is drawn from (seed, epoch) alone, iteration starts at
+    offset so that a resumed run continues at the exact window it stopped at without loading the
+    skipped batches. With world_size > 1 the permutation is truncated to a multiple of the world
+    size and strided over the ranks, as DistributedSampler does with drop_last.
+    """
+    def __init__(self, data_source, seed, epoch, rank=0, world_size=1):
+        self.numsamples = len(data_source)
+        self.seed = seed
+        self.epoch = epoch
+        self.rank = rank
+        self.world_size = world_size
+        self.offset = 0
+
+    def setoffset(self, offset):
+        self.offset = offset
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.numsamples, generator=generator).tolist()
+        indices = indices[:self.numsamples - self.numsamples % self.world_size]
+        return iter(indices[self.rank::self.world_size][self.offset:])
+
+    def __len__(self):
+        return max(self.numsamples//self.world_size - self.offset, 0)
+
+class mixturesampler(Sampler):
+    """
+    Batch sampler over the windows of several datasets loaded together, every batch is drawn from a
+    single source picked with probability proportional to its weight. The windows of a source are
+    visited in a shuffled order and reshuffled once exhausted, so small sources are upsampled to
+    their weight. The plan of a round is drawn from (seed, epoch) alone, sources holds the source
+    of every batch for the per-source metrics and offset skips batches on resume. With
+    world_size > 1 the ranks stride over the batches of the plan.
+    """
+    def __init__(self, windowsources, weights, batch_size, seed, epoch, rank=0, world_size=1):
+        generator = torch.Generator().manual_seed(seed + epoch)
+        pools = [torch.nonzero(windowsources == source).flatten() for source in range(len(weights))]
+        weights = torch.tensor([w if len(pool) else 0.0 for w, pool in zip(weights, pools)], dtype=torch.float64)
+        numbatches = len(windowsources)//batch_size//world_size*world_size
+        if weights.sum() <= 0:
+            numbatches = 0
+
+        order = torch.multinomial(weights, numbatches, replacement=True, generator=generator).tolist() if numbatches else []
+        perms = [pool[torch.randperm(len(pool), generator=generator)] for pool in pools]
+        positions = [0]*len(pools)
+        self.plan = []
+        for source in order:
+            batch = []
+            while len(batch) < batch_size:
+                if positions[source] == len(perms[source]):
+                    perms[source] = pools[source][torch.randperm(len(pools[source]), generator=generator)]
+                    positions[source] = 0
+                take = min(batch_size - len(batch), len(perms[source]) - positions[source])
+                batch.extend(perms[source][positions[source]:positions[source]+take].tolist())
+                positions[source] += take
+            self.plan.append(batch)
+        self.plan = self.plan[rank::world_size]
+        self.sources = order[rank::world_size]
+        self.offset = 0
+
+    def setoffset(self, offset):
+        self.offset = offset
+
+    def __iter__(self):
+        return iter(self.plan[self.offset:])
+
+    def __len__(self):
+        return max(len(self.plan) - self.offset, 0)
+
+class losstracker():
+    """
+    Training losses kept on the device, the step losses of a window of flushat steps are copied to
+    the host in one transfer so that the step loop does not synchronize on .item(). Prints go
+    through a rate limited log of at most one message per interval seconds.
+    """
+    def __init__(self, device, flushat, interval):
+        self.flushat = max(flushat, 1)
+        self.window = torch.zeros(self.flushat, device=device)
+        self.steps = 0
+        self.interval = interval
+        self.lastprint = -math.inf
+
+    def update(self, loss):
+        """
+        Stores a step loss, returns the step losses of the window as floats on a flush and None
+        otherwise
+        """
+        self.window[self.steps % self.flushat] = loss.detach()
+        self.steps += 1
+        if self.steps % self.flushat:
+            return None
+        return self.window.tolist()
+
+    def log(self, message):
+        now = time.perf_counter()
+        if now - self.lastprint >= self.interval:
+            self.lastprint = now
+            print(message)
+
+class sourcetracker():
+    """
+    Training loss and throughput of every source of a dataset mixture, the losses are summed on
+    the device and read when the losstracker flushes. Throughput is the number of windows drawn
+    from a source per second of training since the last flush.
+    """
+    def __init__(self, names, device):
+        self.names = names
+        self.total = torch.zeros(len(names), device=device)
+        self.batches = [0]*len(names)
+        self.windows = [0]*len(names)
+        self.start = time.perf_counter()
+
+    def update(self, source, loss, windows):
+        self.total[source] += loss.detach()
+        self.batches[source] += 1
+        self.windows[source] += windows
+
+    def flush(self):
+        """
+        Mean loss and windows/s of every source since the last flush as {name: (loss, rate)}
+        """
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        total = self.total.tolist()
+        summary = {name: (total[i]/self.batches[i] if self.batches[i] else math.nan, self.windows[i]/elapsed)
+                   for i, name in enumerate(self.names)}
+        self.total.zero_()
+        self.batches = [0]*len(self.names)
+        self.windows = [0]*len(self.names)
+        self.start = time.perf_counter()
+        return summary
+
 class dataset(cfg):
     """
     Dataset object that utilizes any custom dataset with the prescribed data format to be imposed
@@ -72,6 +266,19 @@ class dataset(cfg):
             self.device = torch.device('cpu')
         self.starttime = None
 
+        self.rank = 0
+        self.world_size = 1
+        self.shardwindows = False
+        self.epoch = 0
+        if args.distributed:
+            self.configure_distributed()
+
+        self.sources = args.data_sources
+        weights = args.data_weights or [1.0]*len(self.sources)
+        self.mixweights = [w/sum(weights) for w in weights]
+        self.windowsources = None
+        self.batchsources = None
+
         self.modelpath = ''
         self.traindatapath = ''
         self.testdatapath = ''
@@ -92,8 +299,8 @@ class dataset(cfg):
             "mass" : self.mass
         }
 
-        self.ny = args.num_of_coordinates
-        self.nu = args.num_of_joints
+        self.ny = args.num_of_coordinates - ORIENTATION_DIMS['4D'] + ORIENTATION_DIMS[args.orientation_dimension]
+        self.nu = args.num_of_joints * (2 if args.include_control_diffs else 1)
         self.sql = args.total_sim_iterations
         self.sqlctx = int(self.args.context/100 * self.sql)
         self.sqlpar = self.sql - self.sqlctx
@@ -110,8 +317,16 @@ class dataset(cfg):
         }
         self.datadict = {}
         self.checkpoint = {}
+        self.checkpointer = None
+        self.events = eventlog()
         self.modelname = ''
         self.dataname = ''
+        self.currentdata = ''
+        self.currentholdout = []
+        self.fileindex = 0
+        self.fileepoch = 0
+        self.batchoffset = 0
+        self.cursor = {'file': 0, 'batch': 0, 'epoch': 0}
 
         self.training_dataset = torch.empty(0)
         self.current_training_loss = np.inf
@@ -123,12 +338,21 @@ class dataset(cfg):
         self.best_validation_loss = [np.inf, np.inf]
 
         self.test_dataset = torch.empty(0)
+        self.val_indices = []
+        self.metadata = {}
+        self.holdout = {}
+        self.fixed_validation = None
 
         self.iter = 0
         self.learning_rate = args.learning_rate 
         self.model = None
         self.optimizer = None
         self.scheduler = None
+        self.scaler = None
+        self.amp_dtype = None
+        self.ema = None
+        self.warm = not args.compile
+        self.micro = 0
 
     def __str__(self):
         return 'Dataset Object Instantiated'
@@ -146,6 +370,17 @@ class dataset(cfg):
         return self.datadict["datalist"][index]
     
 
+    def getsourcetracker(self):
+        """
+        Per-source metrics of a dataset mixture, None when training on a single dataset
+        """
+        if len(self.sources) == 1:
+            return None
+        return sourcetracker(self.sources, self.device)
+
+    def gettracker(self):
+        return losstracker(self.device, self.args.log_at, self.args.print_interval)
+
     def settime(self, time):
         self.starttime = time
 
@@ -231,6 +466,14 @@ class dataset(cfg):
             self.best_validation_loss[1] = best_validation_loss
 
 
+    def getvalidation(self):
+        """
+        Validation windows of the current file as (control, position) tensors
+        """
+        if self.fixed_validation is not None:
+            return self.fixed_validation.dataset.base.tensors
+        return self.gendict['control'][self.val_indices], self.gendict['position'][self.val_indices]
+
     def reset(self):
         torch.cuda.empty_cache()
         self.gendict = {}
@@ -247,23 +490,45 @@ class dataset(cfg):
             self.seed = torch.randint(low=0,high=99999,size=(1,))
         else:
             self.seed = self.args.seed
+        if self.world_size > 1:
+            seed = torch.tensor([int(self.seed)])
+            dist.broadcast(seed, src=0)
+            self.seed = int(seed)
         torch.manual_seed(seed=self.seed)
 
         parentpath = os.path.abspath(os.path.join(os.getcwd(), os.pardir))
 
-        traindatadir = f'data_generation/data_tensors/train/{self.args.data_name}'
+        # files are named relative to the train folder as <data name>/<file> so that datasets can be mixed
+        traindatadir = f'data_generation/data_tensors/train'
         self.traindatapath = os.path.join(parentpath,traindatadir)
-        self.traindatalist = os.listdir(self.traindatapath)
-        print(f'Training data is acquired from:\n{self.traindatapath}\n')
+        sourcelists = [sorted(f'{source}/{data}' for data in os.listdir(os.path.join(self.traindatapath, source)))
+                       for source in self.sources]
+        self.traindatalist = [data for datalist in sourcelists for data in datalist]
+        metadata = {}
+        for source in self.sources:
+            metadir = f'data_generation/data_objects/{source}.json'
+            self.metapath = os.path.join(parentpath,metadir)
+            with open(self.metapath, 'r') as f:
+                for key, value in json.load(f).items():
+                    metadata.setdefault(key, []).extend(value)
+            print(f'Metadata is acquired from:\n{self.metapath}\n')
+        self.metadata = metadata
+        if eval==False:
+            if self.args.validation_budget:
+                self.stratify(self.traindatalist)
+            if len(self.sources) > 1:
+                # a mixture is streamed in rounds of one file per dataset, shorter datasets wrap around
+                numrounds = max(len(datalist) for datalist in sourcelists)
+                self.traindatalist = [tuple(datalist[r % len(datalist)] for datalist in sourcelists)
+                                      for r in range(numrounds)]
+                print(f'Mixing {len(self.sources)} datasets with weights '
+                      f'{dict(zip(self.sources, [round(w, 3) for w in self.mixweights]))} over {numrounds} rounds')
+            self.traindatalist = self.shard(self.traindatalist)
+        print(f'Training data is acquired from:\n{self.traindatapath}\n{self.sources}\n')
 
-        metadir = f'data_generation/data_objects/{self.args.data_name}.json'
-        self.metapath = os.path.join(parentpath,metadir)
-        with open(self.metapath, 'r') as f:
-            metadata  = json.load(f)
         totalsims = len(metadata["dataname"])
         totalenvs = sum(metadata["genenvs"])
         timetaken = datetime.timedelta(seconds=round(sum(metadata["gentime"])))
-        print(f'Metadata is acquired from:\n{self.metapath}\n')
 
         if eval==False:
             modeldir = f'sys_identification/models'
@@ -272,6 +537,9 @@ class dataset(cfg):
             modelspecific = f'{modeldir}/{self.args.data_name}'
             self.modelpath = os.path.join(parentpath,modelspecific)
             Path(self.modelpath).mkdir(exist_ok=True)
+            if self.rank == 0:
+                self.checkpointer = checkpointer(self.modelpath, self.args.data_name,
+                                                 keeplast=self.args.keep_last, keepbest=self.args.keep_best)
             print(f'Trained model is to be saved to:\n{self.modelpath}\n')
         
         elif eval==True:
@@ -282,9 +550,10 @@ class dataset(cfg):
             print(f'Test models are acquired from to:\n{self.modelpath}\n')
             self.modellist = os.listdir(self.modelpath)
 
-            testdatadir = f'data_generation/data_tensors/test/{self.args.data_name}'
+            testdatadir = f'data_generation/data_tensors/test'
             self.testdatapath = os.path.join(parentpath,testdatadir)
-            self.testdatalist = os.listdir(self.testdatapath)
+            self.testdatalist = [f'{source}/{data}' for source in self.sources
+                                 for data in os.listdir(os.path.join(self.testdatapath, source))]
             print(f'Test data is acquired from:\n{self.testdatapath}\n')
 
             print(f'Over {len(self.modellist)} different models trained on {self.args.data_name}')
@@ -305,11 +574,14 @@ class dataset(cfg):
 
         print(f'Will use {self.device} for the training/testing\n')   
     
-    def initialize_model(self, modelname=None):
+    def initialize_model(self, modelname=None, eval=False):
         """
         Defines the model that is to be loaded, used and saved at the end of training procedure
         Modelname --> scratch/resume/finetune/test
+        Eval --> training/testing, the EMA weights of a checkpoint replace the trained weights with
+        --use-ema in testing only, training continues from the trained weights and the EMA state
         """
+        self.configure_precision()
         gptconf = Config(**self.modelargs)
         self.model = TSTransformer(gptconf)
         self.optimizer = self.model.configure_optimizers(self.args.weight_decay, 
@@ -332,21 +604,44 @@ class dataset(cfg):
             print(f'Loading statedict of existing model:\n{self.modelpath}\n')
             print(f'Dataset Use --> {self.args.init_type} on an existing model\noriginally trained with dataset {self.dataname}')
 
-            exsdataset = torch.load(f'{self.modelpath}/{modelname}', map_location=self.device)
-            gptconf = Config(**exsdataset["modelargs"])
+            exsdataset = torch.load(f'{self.modelpath}/{modelname}', map_location=self.device, weights_only=False)
+            self.modelargs = exsdataset['modelargs']
+            gptconf = Config(**self.modelargs)
             self.model = TSTransformer(gptconf)
+            if eval and self.args.use_ema and exsdataset.get('ema') is not None:
+                print('Using the EMA weights of the checkpoint')
+                self.model.load_state_dict(exsdataset['ema'])
+            else:
+                if self.args.use_ema and not eval:
+                    print('--use-ema only applies to testing, training continues from the trained weights')
+                self.model.load_state_dict(exsdataset['model'])
+            self.model.to(self.device)
+            # the optimizer is rebuilt on the loaded model, its states then follow the device of the parameters
+            self.optimizer = self.model.configure_optimizers(self.args.weight_decay, 
+                                            self.args.learning_rate, 
+                                            (self.args.beta1, self.args.beta2), 
+                                            self.device)
+            self.configure_learning_rate()
             self.optimizer.load_state_dict(exsdataset['optimizer'])
             self.scheduler.load_state_dict(exsdataset['scheduler'])
-            self.model.load_state_dict(exsdataset['model'])
-            self.modelargs = exsdataset['modelargs']
             self.iter = exsdataset['iternum']
             self.settime(exsdataset['traintime'])
             self.training_loss_list = exsdataset['trloss']
             self.validation_loss_list = exsdataset['valloss']
             self.best_validation_loss = exsdataset['bvalloss']
+            if self.scaler is not None and exsdataset.get('scaler') is not None:
+                self.scaler.load_state_dict(exsdataset['scaler'])
+            if self.args.init_type=='resume' and exsdataset.get('cursor') is not None:
+                self.loadcursor(exsdataset['cursor'])
             print(f'\nModel initialized from checkpoint')
 
         self.model.to(self.device)
+        self.model.set_checkpointing(self.args.activation_checkpointing)
+        if self.args.ema_decay > 0:
+            self.ema = ema(self.model, self.args.ema_decay, self.args.ema_every)
+            if modelname is not None and exsdataset.get('ema') is not None:
+                self.ema.load_state_dict(exsdataset['ema'])
+            print(f'EMA of the weights with decay {self.args.ema_decay} every {self.args.ema_every} steps')
         print(f'Using {self.optimizer.__class__.__name__} optimizer with {self.scheduler.__class__.__name__} scheduling')
 
     def configure_dataset(self, eval=False):
@@ -358,26 +653,58 @@ class dataset(cfg):
         """
 
         if eval==False:
-            train_dataset = TensorDataset(self.gendict['control'],self.gendict['position']) 
-            split_ratio = 0.8
-            train_size = int(split_ratio * len(train_dataset))
-            valid_size = len(train_dataset) - train_size
-            train_ds, val_ds = random_split(train_dataset, [train_size, valid_size])
-
-            self.training_dataset = DataLoader(train_ds, 
-                                    batch_size=self.args.training_batch_size, 
-                                    shuffle=True,
-                                    pin_memory=True, num_workers=10)
-            self.validation_dataset = DataLoader(val_ds, 
-                                    batch_size=self.args.validation_batch_size, 
-                                    shuffle=True,
-                                    pin_memory=True, num_workers=10)
+            train_dataset = TensorDataset(self.gendict['control'],self.gendict['position'])
+            # the split and the shuffles only depend on (seed, epoch) so that a resumed run sees the same batches
+            generator = torch.Generator().manual_seed(int(self.seed) + self.epoch)
+            if self.fixed_validation is not None:
+                holdout = set(self.currentholdout)
+                train_ds = Subset(train_dataset, [i for i in range(len(train_dataset)) if i not in holdout])
+            else:
+                train_size = int(self.SPLIT_RATIO * len(train_dataset))
+                valid_size = len(train_dataset) - train_size
+                train_ds, val_ds = random_split(train_dataset, [train_size, valid_size], generator=generator)
+                self.val_indices = val_ds.indices
+
+            world_size = self.world_size if self.shardwindows else 1
+            self.batchoffset = self.cursor['batch'] if self.fileindex == self.cursor['file'] else 0
+            if self.windowsources is not None:
+                trainsampler = mixturesampler(self.windowsources[torch.as_tensor(train_ds.indices)], self.mixweights,
+                                              self.args.training_batch_size, int(self.seed), self.epoch,
+                                              self.rank, world_size)
+                trainsampler.setoffset(self.batchoffset)
+                self.batchsources = trainsampler.sources
+                self.training_dataset = DataLoader(self.preprocess(train_ds, train=True),
+                                        batch_sampler=trainsampler,
+                                        generator=generator,
+                                        pin_memory=self.device.type=='cuda', num_workers=self.args.num_workers)
+            else:
+                trainsampler = resumablesampler(train_ds, int(self.seed), self.epoch, self.rank, world_size)
+                trainsampler.setoffset(self.batchoffset*self.args.training_batch_size)
+                self.batchsources = None
+                self.training_dataset = DataLoader(self.preprocess(train_ds, train=True), 
+                                        batch_size=self.args.training_batch_size, 
+                                        sampler=trainsampler,
+                                        drop_last=self.args.compile,
+                                        generator=generator,
+                                        pin_memory=self.device.type=='cuda', num_workers=self.args.num_workers)
+            self.fileepoch = self.epoch
+            self.epoch += 1
+            if self.fixed_validation is not None:
+                self.validation_dataset = self.fixed_validation
+            else:
+                valsampler = resumablesampler(val_ds, int(self.seed), self.fileepoch, self.rank, world_size)
+                self.validation_dataset = DataLoader(self.preprocess(val_ds), 
+                                        batch_size=self.args.validation_batch_size, 
+                                        sampler=valsampler,
+                                        drop_last=self.args.compile,
+                                        generator=generator,
+                                        pin_memory=self.device.type=='cuda', num_workers=self.args.num_workers)
         elif eval==True:
             test_dataset = TensorDataset(self.gendict['control'],self.gendict['position'])
             self.test_dataset = DataLoader(test_dataset,
                                            batch_size=1,
                                            shuffle=False,
-                                           pin_memory=True, num_workers=10) 
+                                           pin_memory=self.device.type=='cuda', num_workers=self.args.num_workers) 
             
     def load(self, data, eval=False):
         """
@@ -386,21 +713,39 @@ class dataset(cfg):
         action may then be augmented with the action derrivative or the link mass vector depending on 
         the proposed system identification methodology.
         *
-        Derivatives are either computed through finite difference or autodiff on loaded dataset
+        Derivatives are computed through finite difference in the preprocessing pipeline
         Mass Vectors are obtained from loaded dataset
         Control Actions are obtained from loaded dataset
-        End Effector Trajectories are obtained from loaded dataset
+        End Effector Trajectories are obtained from loaded dataset, the stored quaternions are
+        resolved to the requested orientation dimension over the whole file in one pass
+        *
+        A round of a dataset mixture (a tuple of files) is loaded as the concatenation of its files,
+        windowsources then holds the dataset index of every window
         """
         datapath = self.traindatapath if eval==False else self.testdatapath
-        actdict = torch.load(Path(f'{datapath}/{data}'))
-        
-        self.control = torch.movedim(actdict['control_action'][1:,:,:7],-2,-3).to('cpu').detach()
-        self.position = torch.movedim(actdict['position'],-2,-3).to('cpu').detach()
+        parts = data if isinstance(data, tuple) else (data,)
+        self.currentdata = data
+
+        controls, positions, masses, sources = [], [], [], []
+        self.currentholdout = []
+        for part in parts:
+            actdict = torch.load(Path(f'{datapath}/{part}'))
+            offset = sum(len(c) for c in controls)
+            controls.append(torch.movedim(actdict['control_action'][1:,:,:7],-2,-3).to('cpu').detach())
+            positions.append(convert_pose(torch.movedim(actdict['position'],-2,-3).to('cpu').detach(),
+                                          self.args.orientation_dimension))
+            if self.args.include_mass_vectors:
+                masses.append(torch.movedim(actdict['mass_vector'],-2,-3).to('cpu').detach())
+            self.currentholdout.extend(offset + i for i in self.holdout.get(part, []))
+            sources.append(torch.full((len(controls[-1]),), self.sources.index(Path(part).parent.name)))
+            del actdict
+
+        self.control = torch.cat(controls) if len(parts) > 1 else controls[0]
+        self.position = torch.cat(positions) if len(parts) > 1 else positions[0]
         if self.args.include_mass_vectors:
-            self.mass = torch.movedim(actdict['mass_vector'],-2,-3).to('cpu').detach()
-        if self.args.include_control_diffs:
-            self.diff = torch.movedim(actdict['control_diff'],-2,-3).to('cpu').detach()
-        
+            self.mass = torch.cat(masses) if len(parts) > 1 else masses[0]
+        self.windowsources = torch.cat(sources) if isinstance(data, tuple) else None
+
         self.gendict = {
             "control" : self.control,
             "position" : self.position,
@@ -408,6 +753,64 @@ class dataset(cfg):
             "mass" : self.mass
         }
     
+    def stratify(self, datalist):
+        """
+        Fixed-budget validation set --> validation-budget windows are held out once before training,
+        split evenly over the randomization settings of every dataset (the generation name without
+        seed and environment count) and within a setting evenly over its files. A file gives at most
+        the windows the 80/20 split would hold out, leftovers of capped files go to the others. Held
+        out windows are drawn from a generator seeded by the file name so the split is the same for
+        every run, seed and rank, they are excluded from training.
+        """
+        genenvs = dict(zip(self.metadata.get("genname", []), self.metadata.get("genenvs", [])))
+        strata = {}
+        for data in datalist:
+            name = Path(data).stem
+            fields = name.split('_')
+            numenvs = int(genenvs.get(name, fields[1]))
+            strata.setdefault(f"{Path(data).parent.name}/{'_'.join(fields[2:])}", []).append((data, numenvs))
+
+        def allocate(budget, capacities):
+            share = [0]*len(capacities)
+            remaining = budget
+            available = [i for i, c in enumerate(capacities) if c > 0]
+            while remaining > 0 and available:
+                per, extra = divmod(remaining, len(available))
+                for k, i in enumerate(available):
+                    take = min(per + (k < extra), capacities[i] - share[i])
+                    share[i] += take
+                    remaining -= take
+                available = [i for i in available if share[i] < capacities[i]]
+            return share
+
+        keys = sorted(strata)
+        capacities = [[n - int(self.SPLIT_RATIO*n) for _, n in strata[k]] for k in keys]
+        stratumshare = allocate(self.args.validation_budget, [sum(c) for c in capacities])
+
+        controls, positions = [], []
+        for key, budget, capacity in zip(keys, stratumshare, capacities):
+            for (data, numenvs), take in zip(strata[key], allocate(budget, capacity)):
+                if take == 0:
+                    continue
+                generator = torch.Generator().manual_seed(zlib.crc32(Path(data).name.encode()))
+                index = torch.randperm(numenvs, generator=generator)[:take].sort().values
+                self.holdout[data] = index.tolist()
+
+                actdict = torch.load(Path(f'{self.traindatapath}/{data}'), map_location='cpu', mmap=True)
+                controls.append(torch.movedim(actdict['control_action'][1:,:,:7],-2,-3)[index].clone())
+                positions.append(convert_pose(torch.movedim(actdict['position'],-2,-3)[index].clone(),
+                                              self.args.orientation_dimension))
+                del actdict
+
+        control = torch.cat(controls)[self.rank::self.world_size]
+        position = torch.cat(positions)[self.rank::self.world_size]
+        self.fixed_validation = DataLoader(self.preprocess(TensorDataset(control, position)),
+                                           batch_size=self.args.validation_batch_size,
+                                           shuffle=False,
+                                           pin_memory=self.device.type=='cuda', num_workers=0)
+        print(f'Fixed validation set of {sum(stratumshare)} windows over {len(keys)} randomization settings '
+              f'and {len(self.holdout)} files, {len(control)} windows on this rank\n')
+
     def loadtoydataset(self):
         """
         Loads the toy linear, nonlinear datasets originally from
@@ -422,11 +825,71 @@ class dataset(cfg):
         self.validation_dataset = DataLoader(validation_dataset, batch_size=8, num_workers=10)
 
 
-    def setcheckpoint(self, iter, curtime):
+    def seek(self, fileindex):
+        """
+        Moves to the training file at fileindex, returns True when the file was already consumed
+        before the checkpoint the run resumed from
+        """
+        self.fileindex = fileindex
+        return fileindex < self.cursor['file']
+
+    def setcursor(self, fileindex, batch):
+        """
+        Data position of the next checkpoint --> the file index and the number of its batches consumed
+        """
+        epoch = self.fileepoch if fileindex == self.fileindex else self.epoch
+        self.cursor = {'file': fileindex, 'batch': batch, 'epoch': epoch}
+
+    def getcursor(self):
         """
-        Defines the checkpoint dictionary pertaining to every iteration
+        Data position together with the seed and the rng states of every generator in use
         """
-        self.checkpoint = {
+        return {**self.cursor,
+                'seed': int(self.seed),
+                'world_size': self.world_size,
+                'rng': {'torch': torch.get_rng_state(),
+                        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                        'numpy': np.random.get_state(),
+                        'random': random.getstate()}}
+
+    def loadcursor(self, cursor):
+        """
+        Restores a data position, training then fast-forwards to its file and batch
+        """
+        if cursor['world_size'] != self.world_size:
+            print(f'Checkpoint was written with {cursor["world_size"]} ranks, the data position is not restored')
+            return
+        self.cursor = {'file': cursor['file'], 'batch': cursor['batch'], 'epoch': cursor['epoch']}
+        self.epoch = cursor['epoch']
+        self.seed = cursor['seed']
+        torch.set_rng_state(cursor['rng']['torch'].cpu())
+        if cursor['rng']['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(cursor['rng']['cuda'])
+        np.random.set_state(cursor['rng']['numpy'])
+        random.setstate(cursor['rng']['random'])
+        print(f'Resuming at file {cursor["file"]} batch {cursor["batch"]}')
+
+    def setcheckpoint(self, iter, curtime, state=None):
+        """
+        Defines the checkpoint dictionary pertaining to every iteration, only rank 0 checkpoints
+        in data-parallel training. State replaces the current training state with a snapshot of
+        getstate() taken at iteration iter, e.g. the validated snapshot of the evaluator, so that
+        the weights, optimizer, scheduler, scaler, EMA and data cursor of the checkpoint match.
+        """
+        if state is None:
+            self.iter = iter
+        if self.rank != 0:
+            return
+        if state is not None:
+            self.checkpoint = {**state, 'bvalloss': list(self.best_validation_loss)}
+        else:
+            self.checkpoint = self.getstate(iter, curtime)
+
+    def getstate(self, iter, curtime):
+        """
+        Checkpoint dictionary of the current training state, the tensors are not copied
+        """
+        return {
             'model': self.model.state_dict(),
             'optimizer': self.optimizer.state_dict(),
             'scheduler': self.scheduler.state_dict(),
@@ -436,10 +899,266 @@ class dataset(cfg):
             'trloss': self.training_loss_list,
             'valloss': self.validation_loss_list,
             'bvalloss': self.best_validation_loss,
+            'scaler': self.scaler.state_dict() if self.scaler is not None else None,
+            'ema': self.ema.state_dict() if self.ema is not None else None,
+            'cursor': self.getcursor(),
             'args': self.args
             }
-        self.iter = iter
     
+    def openevents(self):
+        """
+        Opens the event log of the run under logs/<data name>/<model name>, only rank 0 logs
+        """
+        path = None
+        if self.rank == 0:
+            stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', self.args.data_name,
+                                self.modelname, f'events_{stamp}.bin')
+        self.events = eventlog(path)
+        return self.events
+
+    def writer(self):
+        """
+        Closes the event log and exports it to TensorBoard event files next to it
+        """
+        if self.events.path is None:
+            return
+        self.events.close()
+        logdir = os.path.join(os.path.dirname(self.events.path), 'tensorboard')
+        try:
+            export(self.events.path, logdir)
+            print(f'TensorBoard events written to:\n{logdir}\n')
+        except ImportError as e:
+            print(f'TensorBoard export skipped, {e}\nthe event log is kept at:\n{self.events.path}\n')
+
+    def logger(self):
+        """
+        Writes the summary of the run next to its event log
+        """
+        if self.events.path is None:
+            return
+        summary = {
+            "modelname" : self.modelname,
+            "dataname" : self.dataname,
+            "iterations" : self.iter,
+            "traintime" : self.checkpoint.get('traintime'),
+            "training_loss" : self.current_training_loss,
+            "best_validation_loss" : self.best_validation_loss[1],
+            "events" : self.events.path,
+            "args" : {k: v for k, v in vars(self.args).items() if isinstance(v, (int, float, str, bool))}
+        }
+        path = os.path.join(os.path.dirname(self.events.path), 'summary.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, sort_keys=True, indent=4)
+        print(f'Run summary written to:\n{path}\n')
+
+    def savecheckpoint(self, loss=None):
+        """
+        Hands the current checkpoint dictionary to the background checkpointer, loss marks a
+        best-model checkpoint, only rank 0 saves
+        """
+        if self.checkpointer is None:
+            return
+        self.checkpointer.save(self.checkpoint, self.modelname, self.checkpoint['iternum'], loss)
+
+    def configure_precision(self):
+        """
+        Defines the precision of the forward passes --> bf16 autocast on cpu, fp16 autocast with a
+        gradient scaler on cuda, fp32 when mixed precision is disabled. Weights and optimizer states
+        stay in fp32 so checkpoints are interchangeable between the modes.
+        """
+        self.scaler = None
+        self.amp_dtype = None
+        if self.args.mixed_precision:
+            if self.device.type == 'cuda':
+                self.amp_dtype = torch.float16
+                self.scaler = torch.amp.GradScaler('cuda')
+            else:
+                self.amp_dtype = torch.bfloat16
+            print(f'Mixed precision forward passes in {self.amp_dtype}')
+
+    def autocast(self):
+        """
+        Autocast context of the model forward passes, disabled in fp32
+        """
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype,
+                              enabled=self.amp_dtype is not None)
+
+    def backward(self, loss):
+        """
+        Backward pass of the fp32 loss, scaled when fp16 gradients may underflow
+        """
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def optimizerstep(self):
+        """
+        Optimizer step, unscales the gradients and skips the step on overflow when scaling. The EMA
+        update of the previous step is waited for before the parameters change and the next one is
+        queued after the step.
+        """
+        if self.ema is not None:
+            self.ema.wait()
+        if self.scaler is not None:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
+        if self.ema is not None:
+            self.ema.update()
+
+    def configure_distributed(self):
+        """
+        Joins the torchrun process group on the gloo backend, rank and world size are taken from
+        the environment set by torchrun
+        """
+        dist.init_process_group(backend='gloo')
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        if self.device.type == 'cuda':
+            self.device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)) % torch.cuda.device_count())
+        print(f'Rank {self.rank}/{self.world_size} joined the process group on {self.device}')
+
+    def shard(self, datalist):
+        """
+        Splits the training files over the ranks, the list is padded by wrapping around so every rank
+        sees the same number of files. With fewer files than ranks every rank keeps all files and the
+        windows of each file are sharded instead.
+        """
+        if self.world_size == 1:
+            return datalist
+        if len(datalist) < self.world_size:
+            self.shardwindows = True
+            return datalist
+        numfiles = math.ceil(len(datalist)/self.world_size)*self.world_size
+        padded = [datalist[i % len(datalist)] for i in range(numfiles)]
+        return padded[self.rank::self.world_size]
+
+    def distribute(self, model):
+        """
+        Wraps the model in DistributedDataParallel, the unwrapped model is kept in self.model so that
+        checkpoints hold plain state dicts
+        """
+        if self.world_size == 1:
+            return model
+        return DDP(model, device_ids=[self.device.index] if self.device.type == 'cuda' else None)
+
+    def gradsync(self, net, sync):
+        """
+        Skips the gradient all-reduce of the micro-batches that do not end an accumulation window
+        """
+        if self.world_size == 1 or sync:
+            return contextlib.nullcontext()
+        return net.no_sync()
+
+    def syncbatches(self, numbatches):
+        """
+        Number of batches every rank iterates over, the minimum over ranks so that collectives line up
+        """
+        if self.world_size == 1:
+            return numbatches
+        numbatches = torch.tensor([numbatches])
+        dist.all_reduce(numbatches, op=dist.ReduceOp.MIN)
+        return int(numbatches)
+
+    def allreducemean(self, total, count):
+        """
+        Mean over ranks of a per-rank (sum, count) pair, the shards differ in size so the sums and
+        counts are reduced together and divided once instead of averaging the per-rank means
+        """
+        if self.world_size > 1:
+            pair = torch.tensor([float(total), float(count)], dtype=torch.float64)
+            dist.all_reduce(pair, op=dist.ReduceOp.SUM)
+            total, count = pair.tolist()
+        return total/max(count, 1)
+
+    def cleanup(self):
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+        if self.world_size > 1:
+            dist.destroy_process_group()
+
+    def compile(self, fn):
+        """
+        Compiles a step function when --compile is given, shapes are specialized (dynamic=False) to
+        the fixed seq_len_ctx / seq_len_new and batch sizes. Compiled graphs are cached on disk
+        under models/compile_cache and reused by later runs.
+        """
+        if not self.args.compile:
+            return fn
+        cachedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'compile_cache')
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cachedir)
+        try:
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True
+        except (ImportError, AttributeError):
+            pass
+        return compiled(fn, mode=self.args.compile_mode, dynamic=False)
+
+    def gettrainforward(self, net):
+        """
+        Forward pass and fp32 loss of a training batch through net (the model or its DDP wrapper),
+        chunked over the horizon with --loss-chunk and compiled with --compile. Normalization and
+        context seperation are done by the preprocessing pipeline in the DataLoader workers
+        """
+        args = self.args
+        def trainforward(yctx, uctx, unew, ynew):
+            with self.autocast():
+                if args.loss_chunk:
+                    return net(yctx, uctx, unew, y_new=ynew, chunk=args.loss_chunk,
+                               lossfn=lambda ysim, yact, start, horizon: getloss(args, yact=yact, ysim=ysim,
+                                                                                 start=start, horizon=horizon))
+                ysim = net(yctx, uctx, unew)
+            return getloss(args, yact=ynew, ysim=ysim.float())
+        return self.compile(trainforward)
+
+    def trainstep(self, forward, net, yctx, uctx, unew, ynew):
+        """
+        Training step of a micro-batch, shared by train.py, benchmark.py, tune.py and sweep.py -->
+        warm-up of a compiled forward, forward and backward of the loss averaged over the
+        accumulation-steps micro-batches of an optimizer step, the gradient all-reduce only runs on
+        the last one, and the optimizer step at the end of the window. Returns the loss of the
+        micro-batch and whether the optimizer stepped, the scheduler is stepped by the caller.
+        """
+        if not self.warm:
+            self.warmup(forward, yctx, uctx, unew, ynew)
+        self.micro += 1
+        step = self.micro % self.args.accumulation_steps == 0
+        with self.gradsync(net, step):
+            loss = forward(yctx, uctx, unew, ynew)
+            self.backward(loss/self.args.accumulation_steps)
+        if step:
+            self.optimizerstep()
+            self.optimizer.zero_grad(set_to_none=True)
+        return loss, step
+
+    def warmup(self, fn, *batch):
+        """
+        Warm-up step of a compiled training step, compiles the forward and backward graphs on the
+        first batch without updating the model
+        """
+        ts = time.perf_counter()
+        loss = fn(*batch)
+        loss.backward()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.warm = True
+        print(f'Warm-up step compiled in {time.perf_counter()-ts:.2f}s')
+
+    def preprocess(self, base, train=False):
+        """
+        Wraps a dataset of (u, y) windows in the preprocessing pipeline run by the DataLoader workers
+        --> standardization, control derivatives, context seperation and noise augmentation in training
+        """
+        transforms = [standardize()]
+        if self.args.include_control_diffs:
+            transforms.append(derivatives())
+        transforms.append(context(self.sqlctx))
+        if train and self.args.augment_noise > 0:
+            transforms.append(augment(self.args.augment_noise))
+        return pipeline(base, transforms)
+
     def normalizestd(self, x):
         """
         Normalizes batch tensors by zero mean of a simulation to be fed into the training module
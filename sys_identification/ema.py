@@ -0,0 +1,66 @@
+"""
+Exponential moving average of the model weights, updated with a single multi-tensor lerp over all
+parameters every K optimizer steps. On cuda the update runs on a side stream, on cpu in a
+background thread, so it overlaps with the forward and backward passes of the next step.
+"""
+
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ema():
+    """
+    EMA tracker of the parameters of a model. With updates every K steps the decay of an update is
+    decay^K so that the averaging horizon does not depend on K. wait() has to be called before the
+    parameters are modified in place, datasets.optimizerstep() does so.
+    """
+    def __init__(self, model, decay, every=1):
+        self.decay = decay
+        self.every = max(every, 1)
+        self.names = [n for n, _ in model.named_parameters()]
+        self.params = [p for _, p in model.named_parameters()]
+        self.shadow = [p.detach().clone() for p in self.params]
+        self.steps = 0
+        self.stream = torch.cuda.Stream() if self.shadow and self.shadow[0].is_cuda else None
+        self.executor = ThreadPoolExecutor(max_workers=1) if self.stream is None else None
+        self.pending = None
+
+    def __str__(self):
+        return 'EMA Object Instantiated'
+
+    def lerp(self, weight):
+        with torch.no_grad():
+            torch._foreach_lerp_(self.shadow, self.params, weight)
+
+    def update(self):
+        self.steps += 1
+        if self.steps % self.every:
+            return
+        weight = 1.0 - self.decay**self.every
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.stream):
+                self.lerp(weight)
+        else:
+            self.wait()
+            self.pending = self.executor.submit(self.lerp, weight)
+
+    def wait(self):
+        """
+        Orders the pending update before any later work on the parameters
+        """
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        elif self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def state_dict(self):
+        self.wait()
+        return {n: s for n, s in zip(self.names, self.shadow)}
+
+    def load_state_dict(self, state):
+        self.wait()
+        with torch.no_grad():
+            for n, s in zip(self.names, self.shadow):
+                s.copy_(state[n])
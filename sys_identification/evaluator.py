@@ -0,0 +1,144 @@
+"""
+Asynchronous validation, the training process hands cpu snapshots of the weights to an evaluator
+process which computes the validation loss of the current file and reports back the best-model
+decision. Training keeps stepping while a snapshot is being validated.
+"""
+
+import copy
+import queue
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset
+
+from architectures.transformer.transformer_sim import Config, TSTransformer
+from datasets import dataset
+from losses import getloss
+
+
+def evaluate(args, inq, outq):
+    """
+    Evaluator process loop, messages are
+    ('model', (modelargs, best)) --> builds the model and sets the best validation loss so far
+    ('data', (u, y)) --> validation windows of the current training file or the fixed validation set
+    ('weights', (iter, state)) --> validates a snapshot and reports (iter, loss, isbest)
+    None --> exits
+    """
+    torch.set_num_threads(args.eval_threads)
+    args.disable_cuda = True
+    args.distributed = False
+    args.compile = False
+    datasets = dataset(args=args)
+    datasets.configure_precision()
+
+    model, best = None, float('inf')
+    u, y = None, None
+    while True:
+        msg = inq.get()
+        if msg is None:
+            break
+        kind, payload = msg
+        if kind == 'model':
+            modelargs, best = payload
+            model = TSTransformer(Config(**modelargs))
+            model.eval()
+            continue
+        if kind == 'data':
+            u, y = payload
+            continue
+
+        iter_num, state = payload
+        model.load_state_dict(state)
+        cum_validation_loss, validation_windows = 0.0, 0
+        with torch.inference_mode():
+            for yctxv, uctxv, unewv, ynewv, scalev in DataLoader(datasets.preprocess(TensorDataset(u, y)),
+                                                                 batch_size=args.validation_batch_size):
+                with datasets.autocast():
+                    ysimv = model(yctxv, uctxv, unewv)
+
+                ysimv = datasets.denormalizestd(ysimv.float(), scalev[:, 0], scalev[:, 1])
+                ynewv = datasets.denormalizestd(ynewv, scalev[:, 0], scalev[:, 1])
+                cum_validation_loss += getloss(args, yact=ynewv, ysim=ysimv).item()*len(ynewv)
+                validation_windows += len(ynewv)
+
+        validation_loss = cum_validation_loss/max(validation_windows, 1)
+        isbest = validation_loss < best
+        best = min(best, validation_loss)
+        outq.put((iter_num, validation_loss, isbest))
+
+
+class evaluator():
+    """
+    Handle of the evaluator process. The process is forked before any tensor work is done in the
+    training process so that it inherits neither a cuda context nor an OpenMP pool, spawn is not
+    used since it would re-execute the training script. Snapshots are kept until their result is
+    reported so that the best snapshot, not the current weights, is checkpointed. At most
+    maxpending snapshots are in flight, further snapshots are skipped while the evaluator is busy.
+    """
+    def __init__(self, args, maxpending=2):
+        ctx = mp.get_context('fork')
+        self.inq = ctx.Queue()
+        self.outq = ctx.Queue()
+        self.maxpending = maxpending
+        self.snapshots = {}
+        self.process = ctx.Process(target=evaluate, args=(copy.copy(args), self.inq, self.outq), daemon=True)
+        self.process.start()
+        print(f'Asynchronous validation on {args.eval_threads} threads, pid {self.process.pid}')
+
+    def __str__(self):
+        return 'Evaluator Object Instantiated'
+
+    def setmodel(self, modelargs, best):
+        self.inq.put(('model', (modelargs, float(best))))
+
+    def setdata(self, u, y):
+        self.inq.put(('data', (u.detach().to('cpu').contiguous(), y.detach().to('cpu').contiguous())))
+
+    def snapshot(self, obj):
+        """
+        Detached cpu copy of every tensor of a training state, containers are copied so that later
+        in-place updates of the optimizer and the loss lists do not leak into the snapshot
+        """
+        if isinstance(obj, torch.Tensor):
+            return obj.detach().to('cpu', copy=True)
+        if isinstance(obj, dict):
+            return {k: self.snapshot(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v) for v in obj)
+        return obj
+
+    def submit(self, iter_num, state):
+        """
+        Queues the weights of a training state (datasets.getstate()), a cpu copy of the whole state
+        is kept so that a best checkpoint pairs the weights with the optimizer, scheduler and data
+        position of the same iteration. Returns False when the snapshot is skipped
+        """
+        if len(self.snapshots) >= self.maxpending:
+            print(f'\nEvaluator busy, snapshot of {iter_num=} skipped\n')
+            return False
+        state = self.snapshot(state)
+        self.snapshots[iter_num] = state
+        self.inq.put(('weights', (iter_num, state['model'])))
+        return True
+
+    def poll(self, block=False):
+        """
+        Reported results as (iter, validation loss, isbest, snapshot) tuples, block waits for
+        every snapshot in flight
+        """
+        results = []
+        while self.snapshots:
+            try:
+                iter_num, validation_loss, isbest = self.outq.get(block=block)
+            except queue.Empty:
+                break
+            results.append((iter_num, validation_loss, isbest, self.snapshots.pop(iter_num)))
+        return results
+
+    def close(self):
+        """
+        Waits for the snapshots in flight and stops the process
+        """
+        results = self.poll(block=True)
+        self.inq.put(None)
+        self.process.join()
+        return results
@@ -0,0 +1,168 @@
+"""
+Local metrics, scalars, histograms and timings are appended to an in-memory queue in the training
+loop and written by a background thread to an append-only binary event log. Logging a value only
+costs a queue append, tensors are converted to host values by the flush thread. The log is read
+back with read() and exported to TensorBoard event files with export(), so dashboards can be built
+offline, e.g.
+
+python events.py logs/MG1/<model name>/events.bin logs/MG1/<model name>/tensorboard
+
+Record layout (little endian) --> kind u8, tag id u16, step i64, wall time f64, then
+TAG --> name length u16, utf-8 name
+SCALAR, TIMING --> value f64
+HISTOGRAM --> min, max, num, sum, sum of squares f64, bins u16, bin limits f64[bins], counts f64[bins]
+"""
+
+import os
+import sys
+import time
+import struct
+import threading
+import collections
+import torch
+
+MAGIC = b'SYSIDEV1'
+TAG, SCALAR, TIMING, HISTOGRAM = 0, 1, 2, 3
+HEADER = struct.Struct('<BHqd')
+NAME = struct.Struct('<H')
+VALUE = struct.Struct('<d')
+STATS = struct.Struct('<dddddH')
+
+
+class eventlog():
+    """
+    Append-only event log with a background flush thread, a log without a path is disabled and
+    every call returns immediately (non-zero ranks, tools that do not log)
+    """
+    def __init__(self, path=None, interval=2.0, bins=30):
+        self.path = path
+        self.enabled = path is not None
+        self.interval = interval
+        self.bins = bins
+        self.queue = collections.deque()
+        self.tags = {}
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __str__(self):
+        return 'Event Log Object Instantiated'
+
+    def scalar(self, tag, value, step):
+        if self.enabled:
+            self.queue.append((SCALAR, tag, step, time.time(), value))
+
+    def timing(self, tag, seconds, step):
+        if self.enabled:
+            self.queue.append((TIMING, tag, step, time.time(), seconds))
+
+    def histogram(self, tag, values, step):
+        """
+        Histogram of a tensor, the values are copied so that later in-place updates do not leak in
+        """
+        if self.enabled:
+            self.queue.append((HISTOGRAM, tag, step, time.time(), values.detach().flatten().clone()))
+
+    def encode(self, kind, tag, step, walltime, value):
+        records = []
+        if tag not in self.tags:
+            self.tags[tag] = len(self.tags)
+            name = tag.encode('utf-8')
+            records.append(HEADER.pack(TAG, self.tags[tag], 0, walltime) + NAME.pack(len(name)) + name)
+        header = HEADER.pack(kind, self.tags[tag], int(step), walltime)
+        if kind == HISTOGRAM:
+            values = value.float().cpu()
+            vmin, vmax = values.min().item(), values.max().item()
+            counts = torch.histc(values, bins=self.bins, min=vmin, max=vmax) if vmax > vmin else \
+                     torch.full((self.bins,), float(len(values))/self.bins)
+            limits = torch.linspace(vmin, vmax, self.bins + 1)[1:]
+            records.append(header + STATS.pack(vmin, vmax, float(len(values)), values.sum().item(),
+                                               values.square().sum().item(), self.bins)
+                           + struct.pack(f'<{self.bins}d', *limits.tolist())
+                           + struct.pack(f'<{self.bins}d', *counts.tolist()))
+        else:
+            records.append(header + VALUE.pack(float(value)))
+        return b''.join(records)
+
+    def flush(self):
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.encode(*self.queue.popleft()))
+            except IndexError:
+                break
+        if chunks:
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.stop.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        self.enabled = False
+
+
+def read(path):
+    """
+    Events of a log as dicts with kind, tag, step, time and value, histograms as a dict of stats
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not an event log')
+    tags = {}
+    offset = len(MAGIC)
+    while offset + HEADER.size <= len(data):
+        kind, tagid, step, walltime = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        if kind == TAG:
+            (length,) = NAME.unpack_from(data, offset)
+            offset += NAME.size
+            tags[tagid] = data[offset:offset+length].decode('utf-8')
+            offset += length
+            continue
+        if kind == HISTOGRAM:
+            vmin, vmax, num, total, squares, bins = STATS.unpack_from(data, offset)
+            offset += STATS.size
+            limits = struct.unpack_from(f'<{bins}d', data, offset)
+            offset += 8*bins
+            counts = struct.unpack_from(f'<{bins}d', data, offset)
+            offset += 8*bins
+            value = {"min": vmin, "max": vmax, "num": num, "sum": total, "sum_squares": squares,
+                     "bucket_limits": list(limits), "bucket_counts": list(counts)}
+        else:
+            (value,) = VALUE.unpack_from(data, offset)
+            offset += VALUE.size
+        yield {"kind": kind, "tag": tags[tagid], "step": step, "time": walltime, "value": value}
+
+
+def export(path, logdir):
+    """
+    Writes the events of a log to TensorBoard event files in logdir
+    """
+    from torch.utils.tensorboard import SummaryWriter
+    writer = SummaryWriter(log_dir=logdir)
+    for event in read(path):
+        if event["kind"] == HISTOGRAM:
+            writer.add_histogram_raw(event["tag"], global_step=event["step"], walltime=event["time"], **event["value"])
+        else:
+            writer.add_scalar(event["tag"], event["value"], global_step=event["step"], walltime=event["time"])
+    writer.close()
+    return logdir
+
+
+if __name__ == '__main__':
+    export(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(sys.argv[1]), 'tensorboard'))
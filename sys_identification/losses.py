@@ -1,109 +1,136 @@
+import math
 import torch
-from architectures.diffusion.diffuser_trial import TSDiffuser
+import torch.nn.functional as F
 
 class losses():
-    def __init__(self, weights=None):
-        self.weights = weights
-
-    def getlossweights(self, discount, action_weight=1.0, weights_dic={}):
+    """
+    Training and validation losses with optional per-timestep, per-dimension weights. The
+    (horizon, n_y) weight tensor is built once per horizon and device and reused by every call,
+    the weighted losses are elementwise products followed by a single reduction.
+    """
+    def __init__(self, discount=1.0, dim_weights=None):
+        self.discount = discount
+        self.dim_weights = dim_weights
+        self.weights = discount != 1.0 or bool(dim_weights)
+        self.buffers = {}
+
+    def __str__(self):
+        return 'Losses Object Instantiated'
+
+    def getlossweights(self, horizon, ny, device):
         '''
         sets loss coefficients for trajectory
 
-        action_weight   : float
-            coefficient on first action loss
         discount   : float
-            multiplies t^th timestep of trajectory loss by discount**t
-        weights_dict    : dict
-            { i: c } multiplies dimension i of observation loss by c
-
-                                    WIP***
+            multiplies t^th timestep of trajectory loss by discount**t, normalized to mean 1
+        dim_weights    : list
+            multiplies dimension i of the trajectory loss by dim_weights[i], a single value
+            applies to every dimension
         '''
-        self.action_weight = action_weight
-
-        dim_weights = torch.ones(self.transition_dim, dtype=torch.float32)
-
-        if weights_dict is None: weights_dict = {}
-        for ind, w in weights_dict.items():
-            dim_weights[self.action_dim + ind] *= w
-
-        discounts = discount ** torch.arange(self.horizon, dtype=torch.float)
-        discounts = discounts / discounts.mean()
-        self.loss_weights = torch.einsum('h,t->ht', discounts, dim_weights)
-
-        self.loss_weights[0, :self.action_dim] = action_weight
-        return self.loss_weights
+        key = (horizon, ny, str(device))
+        if key not in self.buffers:
+            dim_weights = torch.ones(ny, dtype=torch.float32)
+            if self.dim_weights:
+                if len(self.dim_weights) not in (1, ny):
+                    raise ValueError(f'{len(self.dim_weights)} loss dimension weights for {ny} output dimensions')
+                dim_weights *= torch.tensor(self.dim_weights, dtype=torch.float32)
+
+            discounts = self.discount ** torch.arange(horizon, dtype=torch.float32)
+            discounts = discounts / discounts.mean()
+            self.buffers[key] = torch.outer(discounts, dim_weights).to(device)
+        return self.buffers[key]
+
+    def weighted(self, ysim, start, horizon):
+        """
+        Weights of the steps start:start+len of a horizon, a view of the cached buffer
+        """
+        weights = self.getlossweights(horizon, ysim.shape[-1], ysim.device)
+        return weights[start:start + ysim.shape[-2]]
 
-    def mse_loss(self, ysim, yact):
+    def mse_loss(self, ysim, yact, start=0, horizon=None):
         """
         Implements torch.nn.Functional.mse_loss - mse loss:
         """
         if not self.weights:
-            return torch.nn.functional.mse_loss(yact, ysim)
+            return F.mse_loss(ysim, yact)
         else:
-            return torch.nn.functional.mse_loss(yact, ysim)*self.loss_weights
+            return torch.mean(self.weighted(ysim, start, horizon) * (ysim - yact).square())
 
-    def mae_loss(self, ysim, yact):
+    def mae_loss(self, ysim, yact, start=0, horizon=None):
         """
         Implements torch.nn.Functional.l1_loss - mae/l1 loss:
         """
         if not self.weights:
-            return torch.nn.functional.l1_loss(ysim, yact)
+            return F.l1_loss(ysim, yact)
         else:
-            return torch.nn.functional.l1_loss(yact, ysim)*self.loss_weights
+            return torch.mean(self.weighted(ysim, start, horizon) * (ysim - yact).abs())
 
-    def huber_loss(self, ysim, yact):
+    def huber_loss(self, ysim, yact, start=0, horizon=None):
         """
         Implements torch.nn.Functional.huber_loss - huber loss:
         """
         if not self.weights:
-            return torch.nn.functional.huber_loss(ysim, yact)
+            return F.huber_loss(ysim, yact)
         else:
-            return torch.nn.functional.huber_loss(yact, ysim)*self.loss_weights
+            return torch.mean(self.weighted(ysim, start, horizon) * F.huber_loss(ysim, yact, reduction='none'))
 
-    def rmse_loss(self, ysim, yact):
+    def rmse_loss(self, ysim, yact, start=0, horizon=None):
         """
         Implements l2 loss - l2 loss:
         """
-        if not self.weights:
-            n = len(yact)
-            mse_error = torch.nn.functional.mse_loss(ysim, yact)
-            return (mse_error*n)**0.5
-        else:
-            return (torch.nn.functional.mse_loss(yact, ysim)*self.loss_weights*n)**0.5
+        n = len(yact)
+        return (self.mse_loss(ysim, yact, start, horizon)*n)**0.5
 
-    def logcosh_loss(self, ysim, yact):
+    def logcosh_loss(self, ysim, yact, start=0, horizon=None):
         """
-        Implements logcosh loss - logcosh loss:
+        Implements logcosh loss - logcosh loss, log(cosh(x)) = x + softplus(-2x) - log(2) does not
+        overflow for large errors:
         """
+        diff = ysim - yact
+        logcosh = diff + F.softplus(-2.0*diff) - math.log(2.0)
         if not self.weights:
-            return torch.sum(torch.log(torch.cosh(ysim - yact)))
+            return torch.sum(logcosh)
         else:
-            return torch.sum(torch.log(torch.cosh(ysim - yact)))*self.loss_weights
+            return torch.sum(self.weighted(ysim, start, horizon) * logcosh)
 
-    def getloss(self, args, ysim, yact, architecture='transformer'):
+    def getloss(self, args, ysim, yact, start=0, horizon=None):
         """
         Determines the loss type to be used in training and validation according
-        to the user defined args
+        to the user defined args. Start and horizon place a chunk of the predictions within the
+        horizon, the whole horizon by default. The loss of a chunk is its contribution to the loss
+        of the horizon so that the chunk losses add up to it --> means are scaled by the share of
+        the chunk in the horizon, the log-cosh sum is kept, RMSE does not split over chunks
         """
-        if architecture=='transformer':
-            pass
-        elif architecture=='diffuser':
-            yact=TSDiffuser.sample_from_noisy_distribution()
-            ysim=TSDiffuser.sample_from_noisy_distribution()
+        horizon = horizon or start + ysim.shape[-2]
+        share = ysim.shape[-2]/horizon
 
         if args.loss_function =='MSE':
-            loss = self.mse_loss(ysim, yact)
+            loss = self.mse_loss(ysim, yact, start, horizon)*share
 
         elif args.loss_function =='MAE':
-            loss = self.mae_loss(ysim, yact)
+            loss = self.mae_loss(ysim, yact, start, horizon)*share
 
         elif args.loss_function =='RMSE':
-            loss = self.rmse_loss(ysim, yact)
+            loss = self.rmse_loss(ysim, yact, start, horizon)
 
         elif args.loss_function =='LC':
-            loss = self.logcosh_loss(ysim, yact)
+            loss = self.logcosh_loss(ysim, yact, start, horizon)
 
         elif args.loss_function =='Huber':
-            loss = self.huber_loss(ysim, yact)
-        
-        return loss
\ No newline at end of file
+            loss = self.huber_loss(ysim, yact, start, horizon)*share
+
+        return loss
+
+cache = {}
+
+def getloss(args, yact, ysim, start=0, horizon=None):
+    """
+    Loss of the predictions ysim against yact with the weighting of args, the losses object and
+    its weight buffers are shared by all calls with the same weighting
+    """
+    discount = getattr(args, 'loss_discount', 1.0)
+    dim_weights = tuple(getattr(args, 'loss_dim_weights', None) or ())
+    key = (discount, dim_weights)
+    if key not in cache:
+        cache[key] = losses(discount, list(dim_weights))
+    return cache[key].getloss(args, ysim, yact, start, horizon)
@@ -0,0 +1,39 @@
+"""
+Peak memory of a code section, shared by tune.py and benchmark.py. On cuda the allocator peak of
+the device is used, on cpu the peak resident set size (VmHWM) of the process, which is reset
+through /proc/self/clear_refs so that a section is not charged with an earlier, larger peak.
+"""
+
+import resource
+import torch
+
+
+def resetpeak(device):
+    """
+    Starts a new peak measurement, on cpu without /proc the lifetime peak of the process is kept
+    """
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peakmemory(device):
+    """
+    Peak memory in bytes since the last resetpeak, allocated device memory on cuda, peak resident
+    set size of the process on cpu
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
@@ -0,0 +1,79 @@
+"""
+Preprocessing pipeline, the per-window transforms of training and validation run inside the
+DataLoader workers so that batches reach the training loop ready to be fed to the model as
+(yctx, uctx, unew, ynew, scale) tuples. Transforms act on a single window of shape (T, C) and
+are composed in order over a dict of named tensors.
+"""
+
+import torch
+from torch.utils.data import Dataset
+
+
+class standardize():
+    """
+    Zero mean, unit std normalization of a window over time, the mean and std of y are kept as
+    scale to denormalize simulated trajectories
+    """
+    def __call__(self, sample):
+        u, y = sample['u'], sample['y']
+        umean, ustd = u.mean(dim=0, keepdim=True), u.std(dim=0, keepdim=True)
+        ymean, ystd = y.mean(dim=0, keepdim=True), y.std(dim=0, keepdim=True)
+        sample['u'] = (u - umean) / ustd
+        sample['y'] = (y - ymean) / ystd
+        sample['scale'] = torch.stack((ymean, ystd))
+        return sample
+
+
+class derivatives():
+    """
+    Appends the finite difference of the normalized control action as additional input channels
+    """
+    def __call__(self, sample):
+        u = sample['u']
+        sample['u'] = torch.cat((u, torch.diff(u, dim=0, prepend=u[:1])), dim=-1)
+        return sample
+
+
+class context():
+    """
+    Seperates a window into given (context) and estimated parts at seq_len_ctx
+    """
+    def __init__(self, sqlctx):
+        self.sqlctx = sqlctx
+
+    def __call__(self, sample):
+        sample['uctx'], sample['unew'] = sample['u'][:self.sqlctx], sample['u'][self.sqlctx:]
+        sample['yctx'], sample['ynew'] = sample['y'][:self.sqlctx], sample['y'][self.sqlctx:]
+        return sample
+
+
+class augment():
+    """
+    Gaussian noise on the normalized model inputs, the estimated outputs ynew stay clean
+    """
+    def __init__(self, noise):
+        self.noise = noise
+
+    def __call__(self, sample):
+        for key in ('uctx', 'unew', 'yctx'):
+            sample[key] = sample[key] + self.noise*torch.randn_like(sample[key])
+        return sample
+
+
+class pipeline(Dataset):
+    """
+    Wraps a dataset of (u, y) windows and applies the transforms to every window it returns
+    """
+    def __init__(self, base, transforms):
+        self.base = base
+        self.transforms = transforms
+
+    def __len__(self):
+        return len(self.base)
+
+    def __getitem__(self, index):
+        u, y = self.base[index]
+        sample = {'u': u.float(), 'y': y.float()}
+        for transform in self.transforms:
+            sample = transform(sample)
+        return sample['yctx'], sample['uctx'], sample['unew'], sample['ynew'], sample['scale']
@@ -0,0 +1,51 @@
+"""
+Prefetching of batches to the training device. On cuda the host to device copy of the next batch
+is issued on a side stream while the current batch is processed, on cpu the batches are passed
+through untouched and on other devices they are copied as they are requested.
+"""
+
+import torch
+
+
+class prefetcher():
+    """
+    Wraps any iterable of tensor batches (tuples or lists of tensors) and yields them on device
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+    def __str__(self):
+        return 'Prefetcher Object Instantiated'
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, batches):
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return [x.to(self.device, non_blocking=True) for x in batch]
+
+    def __iter__(self):
+        if self.device.type == 'cpu':
+            yield from self.loader
+            return
+        if self.stream is None:
+            for batch in self.loader:
+                yield [x.to(self.device, non_blocking=True) for x in batch]
+            return
+
+        batches = iter(self.loader)
+        batch = self.preload(batches)
+        while batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            for x in batch:
+                x.record_stream(current)  # the copy stream must not reuse the memory while it is in use
+            nextbatch = self.preload(batches)
+            yield batch
+            batch = nextbatch
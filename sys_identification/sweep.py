@@ -0,0 +1,242 @@
+"""
+Local hyperparameter sweep over n_embd, n_layer, n_head and the loss function. Trials run
+concurrently in a process pool, every worker is pinned to its own set of cores. Poor trials are
+stopped early by asynchronous successive halving (ASHA) on the validation loss: a trial is
+trained for min-iters, and only the best 1/eta of every rung are promoted to eta times more
+iterations up to max-iters. The training files are loaded once into shared memory and used by
+every trial, results are appended to sweeps/<name>/results.jsonl. Arguments after -- are the
+usual train.py arguments of the base config, e.g.
+
+python sweep.py --n-embd 128 192 --n-layer 4 8 12 --n-head 4 8 -- -dn MG1 transformer -ctx 20
+"""
+
+import os
+import math
+import sys
+import copy
+import json
+import time
+import argparse
+import itertools
+import datetime
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from torch.utils.data import DataLoader, TensorDataset, Subset
+
+from datasets import dataset
+from utils import arguments
+from losses import getloss
+
+shared = {}
+
+def initworker(control, position, trainindex, validindex, cores):
+    """
+    Pins the worker to a free core set and keeps the shared windows of the sweep
+    """
+    assigned = cores.get()
+    os.sched_setaffinity(0, assigned)
+    torch.set_num_threads(len(assigned))
+    shared['windows'] = TensorDataset(control, position)
+    shared['trainindex'] = trainindex
+    shared['validindex'] = validindex
+
+def runtrial(trialid, config, baseargs, iters, statepath, seed):
+    """
+    Trains a config up to iters iterations, continuing from the state of its previous rung, and
+    returns the denormalized RMSE of the fixed validation windows, which ranks the trials whatever
+    their loss function, together with the validation loss of the trial's own loss function
+    """
+    ts = time.perf_counter()
+    args = copy.copy(baseargs)
+    for key, value in config.items():
+        setattr(args, key, value)
+    args.disable_cuda = True
+    args.distributed = False
+    args.compile = False
+    datasets = dataset(args=args)
+    datasets.initialize_model()
+    modelargs, model, optimizer, scheduler = datasets.getmodel()
+
+    done = 0
+    if os.path.exists(statepath):
+        state = torch.load(statepath, weights_only=False)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        torch.set_rng_state(state['rng'])
+        if datasets.scaler is not None and state.get('scaler') is not None:
+            datasets.scaler.load_state_dict(state['scaler'])
+        done = state['iters']
+    else:
+        torch.manual_seed(seed + trialid)
+
+    training_dataset = DataLoader(datasets.preprocess(Subset(shared['windows'], shared['trainindex']), train=True),
+                                  batch_size=args.training_batch_size, shuffle=True, drop_last=True)
+    validation_dataset = DataLoader(datasets.preprocess(Subset(shared['windows'], shared['validindex'])),
+                                    batch_size=args.validation_batch_size)
+
+    if len(training_dataset) == 0:
+        raise ValueError(f'{len(shared["trainindex"])} training windows do not fill a batch of {args.training_batch_size}')
+    # iterations are optimizer steps of the training step of train.py, with its loss chunking,
+    # gradient accumulation and mixed precision
+    model.train()
+    trainforward = datasets.gettrainforward(model)
+    batches = itertools.chain.from_iterable(itertools.repeat(training_dataset))
+    while done < iters:
+        yctx, uctx, unew, ynew, scale = next(batches)
+        training_loss, stepped = datasets.trainstep(trainforward, model, yctx, uctx, unew, ynew)
+        if stepped:
+            scheduler.step()
+            done += 1
+
+    model.eval()
+    cum_validation_loss, validation_windows = 0.0, 0
+    squared_error, numel = 0.0, 0
+    with torch.inference_mode():
+        for yctxv, uctxv, unewv, ynewv, scalev in validation_dataset:
+            with datasets.autocast():
+                ysimv = model(yctxv, uctxv, unewv)
+            ysimv = datasets.denormalizestd(ysimv.float(), scalev[:, 0], scalev[:, 1])
+            ynewv = datasets.denormalizestd(ynewv, scalev[:, 0], scalev[:, 1])
+            cum_validation_loss += getloss(args, yact=ynewv, ysim=ysimv).item()*len(ynewv)
+            validation_windows += len(ynewv)
+            squared_error += (ysimv - ynewv).square().sum().item()
+            numel += ynewv.numel()
+
+    torch.save({'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'rng': torch.get_rng_state(),
+                'scaler': datasets.scaler.state_dict() if datasets.scaler is not None else None,
+                'iters': iters}, f'{statepath}.tmp')
+    os.replace(f'{statepath}.tmp', statepath)
+    rmse = math.sqrt(squared_error/max(numel, 1))
+    return trialid, iters, rmse, cum_validation_loss/max(validation_windows, 1), time.perf_counter() - ts
+
+class asha():
+    """
+    Asynchronous successive halving, rung k trains for min_iters*eta^k iterations. A free worker
+    promotes a trial from the highest rung where it is in the top 1/eta of the completed trials
+    and has not been promoted yet, otherwise it starts a new trial on rung 0. Trials are ranked by
+    the validation RMSE, losses of different loss functions are not comparable.
+    """
+    def __init__(self, configs, min_iters, max_iters, eta):
+        self.configs = configs
+        self.eta = eta
+        self.rungs = []
+        iters = min_iters
+        while iters < max_iters:
+            self.rungs.append(iters)
+            iters *= eta
+        self.rungs.append(max_iters)
+        self.results = [{} for _ in self.rungs]
+        self.promoted = [set() for _ in self.rungs]
+        self.started = 0
+
+    def next(self):
+        """
+        Next (trial id, rung) to run, None when nothing can be started now
+        """
+        for k in reversed(range(len(self.rungs) - 1)):
+            done = sorted(self.results[k].items(), key=lambda kv: kv[1])
+            for trialid, loss in done[:len(done)//self.eta]:
+                if trialid not in self.promoted[k]:
+                    self.promoted[k].add(trialid)
+                    return trialid, k + 1
+        if self.started < len(self.configs):
+            self.started += 1
+            return self.started - 1, 0
+        return None
+
+    def report(self, trialid, rung, loss):
+        self.results[rung][trialid] = loss
+
+def main():
+    parser = argparse.ArgumentParser(description="FrankaSysId sweep")
+    parser.add_argument('--name', type=str, default=datetime.datetime.now().strftime('%Y%m%d_%H%M%S'),
+                        help='name of the sweep, results are stored under sweeps/<name>')
+    parser.add_argument('--n-embd', type=int, nargs='+', default=[192], help='embedding dimensions')
+    parser.add_argument('--n-layer', type=int, nargs='+', default=[12], help='transformer layers')
+    parser.add_argument('--n-head', type=int, nargs='+', default=[8], help='transformer heads')
+    parser.add_argument('--loss-function', type=str, nargs='+', default=['MSE'], help='loss functions')
+    parser.add_argument('--files', type=int, default=4, help='training files loaded for the sweep')
+    parser.add_argument('--min-iters', type=int, default=100, help='iterations of the first rung')
+    parser.add_argument('--max-iters', type=int, default=2700, help='iterations of the last rung')
+    parser.add_argument('--eta', type=int, default=3, help='reduction factor between rungs')
+    parser.add_argument('--threads-per-trial', type=int, default=4, help='cores pinned to every trial')
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    sweepargs = parser.parse_args(argv[:split])
+    sys.argv = [sys.argv[0]] + argv[split+1:]
+    baseargs = arguments().parse_arguments()
+
+    configs = [dict(n_embd=e, n_layer=l, n_head=h, loss_function=f)
+               for e, l, h, f in itertools.product(sweepargs.n_embd, sweepargs.n_layer,
+                                                   sweepargs.n_head, sweepargs.loss_function)
+               if e % h == 0]
+    storepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sweeps', sweepargs.name)
+    Path(storepath).mkdir(parents=True, exist_ok=True)
+
+    # windows of the first files are loaded once and shared with every worker
+    datasets = dataset(args=baseargs)
+    datasets.resolve_datasets()
+    controls, positions = [], []
+    for data in sorted(datasets.traindatalist)[:sweepargs.files]:
+        datasets.load(data)
+        controls.append(datasets.gendict['control'])
+        positions.append(datasets.gendict['position'])
+    control, position = torch.cat(controls).share_memory_(), torch.cat(positions).share_memory_()
+    index = torch.randperm(len(control), generator=torch.Generator().manual_seed(0))
+    numtrain = int(datasets.SPLIT_RATIO*len(control))
+    trainindex, validindex = index[:numtrain].tolist(), index[numtrain:].tolist()
+
+    ctx = mp.get_context('spawn')
+    cores = sorted(os.sched_getaffinity(0))
+    numworkers = max(len(cores)//sweepargs.threads_per_trial, 1)
+    coresets = ctx.Queue()
+    for i in range(numworkers):
+        coresets.put(set(cores[i*sweepargs.threads_per_trial:(i+1)*sweepargs.threads_per_trial]) or set(cores))
+
+    scheduler = asha(configs, sweepargs.min_iters, sweepargs.max_iters, sweepargs.eta)
+    print(f'Sweep {sweepargs.name} --> {len(configs)} configs, rungs {scheduler.rungs}, '
+          f'{numworkers} workers with {sweepargs.threads_per_trial} cores each, {len(control)} windows\n')
+
+    running = {}
+    with ProcessPoolExecutor(max_workers=numworkers, mp_context=ctx, initializer=initworker,
+                             initargs=(control, position, trainindex, validindex, coresets)) as pool, \
+         open(os.path.join(storepath, 'results.jsonl'), 'a', encoding='utf-8') as store:
+        while True:
+            while len(running) < numworkers:
+                job = scheduler.next()
+                if job is None:
+                    break
+                trialid, rung = job
+                statepath = os.path.join(storepath, f'trial{trialid}.pt')
+                future = pool.submit(runtrial, trialid, configs[trialid], baseargs,
+                                     scheduler.rungs[rung], statepath, int(datasets.seed))
+                running[future] = (trialid, rung)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                trialid, rung = running.pop(future)
+                trialid, iters, rmse, loss, seconds = future.result()
+                scheduler.report(trialid, rung, rmse)
+                store.write(json.dumps({"trial": trialid, "rung": rung, "iters": iters,
+                                        "config": configs[trialid], "validation_rmse": rmse,
+                                        "validation_loss": loss,
+                                        "seconds": round(seconds, 2),
+                                        "time": datetime.datetime.now().isoformat(timespec='seconds')}) + '\n')
+                store.flush()
+                print(f'trial {trialid} rung {rung} ({iters} iters) {configs[trialid]} --> rmse {rmse:.4f} '
+                      f'{configs[trialid]["loss_function"]} {loss:.4f} in {seconds:.1f}s')
+
+    final = sorted(scheduler.results[-1].items(), key=lambda kv: kv[1])
+    print(f'\nBest configs after {scheduler.rungs[-1]} iterations:')
+    for trialid, rmse in final[:5]:
+        print(f'{configs[trialid]} --> rmse {rmse:.4f}')
+
+if __name__ == '__main__':
+    main()
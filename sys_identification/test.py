@@ -20,8 +20,9 @@ import tqdm
 torch.set_float32_matmul_precision("medium")
 torch.use_deterministic_algorithms(False)
 
-sys.argv = ['','--data-name=MG1','transformer','-ctx=20']
-args = arguments(description="FrankaSysId",params=[]).parse_arguments()
+# the fixed test configuration is used when no arguments are given, e.g.
+# python test.py -dn MG1 -uema -cmp transformer -ctx 20
+args = arguments(description="FrankaSysId",params=['--data-name=MG1','transformer','-ctx=20']).parse_arguments()
 
 pre = preprocess(args=args)
 
@@ -39,6 +40,7 @@ pre.configure_dataset(eval=True)
 
 training_dataset, validation_dataset, test_dataset = pre.getdataset()
 modelargs, model, optimizer, scheduler = pre.getmodel()
+forward = pre.compile(model)
 score = pre.check_distribution(pre.traindatalist,data)
 
 for model in pre.modellist:
@@ -53,6 +55,7 @@ for model in pre.modellist:
         pre.load(data)
         training_dataset, validation_dataset, validation_loss_list, training_loss_list, best_validation_loss = pre.getdataset()
         modelargs, model, optimizer = pre.getmodel()
+        forward = pre.compile(model)
         score = pre.check_distribution()
         
         model.eval()
@@ -67,7 +70,7 @@ for model in pre.modellist:
                 yctx,ynew = pre.seperate_context(ysingle)
 
                 ytrue = ynew
-                ysim = model(yctx, uctx, unew)
+                ysim = forward(yctx, uctx, unew)
                 yerr = ytrue - ysim
                 pre.cast2original(ytrue=ytrue,
                                   ysim=ysim,
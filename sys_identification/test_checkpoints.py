@@ -0,0 +1,72 @@
+"""
+Retention and resume of the checkpointer, run from the repository root: python -m pytest
+"""
+import os
+import torch
+from checkpoints import checkpointer
+
+def files(ckpt):
+    return sorted(os.listdir(ckpt.historypath))
+
+def make(tmp_path, keeplast=2, keepbest=2):
+    modelpath = tmp_path/'models'/'MG1'
+    modelpath.mkdir(parents=True, exist_ok=True)
+    return checkpointer(str(modelpath), 'MG1', keeplast, keepbest)
+
+def test_keeplast(tmp_path):
+    ckpt = make(tmp_path)
+    for it in range(1, 5):
+        ckpt.save({'model': {'w': torch.full((3,), float(it))}, 'iter': it}, 'model', it)
+    ckpt.close()
+    assert files(ckpt) == ['model_00000003', 'model_00000004']
+    # the canonical model file is the newest checkpoint
+    assert torch.load(os.path.join(ckpt.modelpath, 'model'))['iter'] == 4
+
+def test_keepbest(tmp_path):
+    ckpt = make(tmp_path)
+    for it, loss in [(1, 0.5), (2, 0.2), (3, 0.9), (4, 0.3)]:
+        ckpt.save({'iter': it}, 'model', it, loss=loss)
+    ckpt.close()
+    assert files(ckpt) == ['model_best00000002', 'model_best00000002.json',
+                           'model_best00000004', 'model_best00000004.json']
+    assert [loss for loss, _ in ckpt.best] == [0.2, 0.3]
+
+def test_snapshot_is_a_copy(tmp_path):
+    ckpt = make(tmp_path)
+    w = torch.zeros(3)
+    ckpt.save({'w': w}, 'model', 1)
+    w += 1
+    ckpt.close()
+    assert torch.equal(torch.load(os.path.join(ckpt.modelpath, 'model'))['w'], torch.zeros(3))
+
+def test_resume(tmp_path):
+    """
+    A second run of the same model picks up the checkpoints of the first one for its retention
+    """
+    first = make(tmp_path)
+    for it in range(1, 3):
+        first.save({'iter': it}, 'model', it)
+    first.save({'iter': 2}, 'model', 2, loss=0.4)
+    first.close()
+
+    second = make(tmp_path)
+    second.save({'iter': 3}, 'model', 3)
+    second.save({'iter': 3}, 'model', 3, loss=0.6)
+    second.save({'iter': 4}, 'model', 4, loss=0.1)
+    second.close()
+    assert files(second) == ['model_00000002', 'model_00000003',
+                             'model_best00000002', 'model_best00000002.json',
+                             'model_best00000004', 'model_best00000004.json']
+    assert second.best == [(0.1, os.path.join(second.historypath, 'model_best00000004')),
+                           (0.4, os.path.join(second.historypath, 'model_best00000002'))]
+
+def test_restore_reads_loss_without_sidecar(tmp_path):
+    first = make(tmp_path)
+    first.save({'iter': 1, 'bvalloss': [1, 0.7]}, 'model', 1, loss=0.7)
+    first.close()
+    os.remove(os.path.join(first.historypath, 'model_best00000001.json'))
+
+    second = make(tmp_path)
+    second.restore('model')
+    assert [loss for loss, _ in second.best] == [0.7]
+    second.close()
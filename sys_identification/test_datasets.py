@@ -0,0 +1,96 @@
+"""
+Resumable samplers and the data cursor, run from the repository root: python -m pytest
+"""
+import random
+import pytest
+import torch
+
+np = pytest.importorskip('numpy')
+datasets = pytest.importorskip('datasets')
+
+def test_sampler_permutation():
+    sampler = datasets.resumablesampler(range(100), seed=3, epoch=1)
+    indices = list(sampler)
+    assert sorted(indices) == list(range(100))
+    assert indices == list(datasets.resumablesampler(range(100), seed=3, epoch=1))
+    assert indices != list(datasets.resumablesampler(range(100), seed=3, epoch=2))
+
+def test_sampler_resume():
+    indices = list(datasets.resumablesampler(range(100), seed=3, epoch=1))
+    resumed = datasets.resumablesampler(range(100), seed=3, epoch=1)
+    resumed.setoffset(40)
+    assert len(resumed) == 60
+    assert list(resumed) == indices[40:]
+
+def test_sampler_ranks():
+    shards = [list(datasets.resumablesampler(range(101), seed=3, epoch=1, rank=rank, world_size=4)) for rank in range(4)]
+    assert all(len(shard) == 25 for shard in shards)
+    assert len(set(sum(shards, []))) == 100
+
+def mixture(weights=(3.0, 1.0), sizes=(50, 200), batch_size=4, **kwargs):
+    windowsources = torch.cat([torch.full((size,), source) for source, size in enumerate(sizes)])
+    return windowsources, datasets.mixturesampler(windowsources, list(weights), batch_size, seed=3, epoch=1, **kwargs)
+
+def test_mixture_batches():
+    windowsources, sampler = mixture()
+    assert len(sampler) == 250//4
+    for batch, source in zip(sampler, sampler.sources):
+        assert len(batch) == 4
+        assert all(windowsources[i] == source for i in batch)
+
+def test_mixture_proportions():
+    windowsources, sampler = mixture(sizes=(500, 20000))
+    share = sum(source == 0 for source in sampler.sources)/len(sampler.sources)
+    assert abs(share - 0.75) < 0.03
+
+def test_mixture_upsamples():
+    # the small source is drawn more often than it has windows, its windows are reshuffled once exhausted
+    windowsources, sampler = mixture(sizes=(20, 2000))
+    drawn = [i for batch, source in zip(sampler, sampler.sources) if source == 0 for i in batch]
+    assert len(drawn) > 20
+    assert sorted(drawn[:20]) == list(range(20))
+
+def test_mixture_empty_source():
+    windowsources, sampler = mixture(sizes=(0, 100))
+    assert set(sampler.sources) == {1}
+
+def test_mixture_resume_and_ranks():
+    _, sampler = mixture()
+    _, resumed = mixture()
+    resumed.setoffset(10)
+    assert list(resumed) == sampler.plan[10:]
+    shards = [mixture(rank=rank, world_size=2)[1].plan for rank in range(2)]
+    assert shards == [sampler.plan[0::2], sampler.plan[1::2]]
+
+def cursordataset():
+    data = datasets.dataset.__new__(datasets.dataset)
+    data.seed, data.epoch, data.fileepoch, data.fileindex, data.world_size = 3, 0, 0, 0, 1
+    data.cursor = {'file': 0, 'batch': 0, 'epoch': 0}
+    return data
+
+def test_cursor_resume():
+    data = cursordataset()
+    data.seek(1)
+    data.fileepoch = 2
+    data.setcursor(1, 17)
+    cursor = data.getcursor()
+    expected = (torch.rand(3), np.random.rand(3), random.random())
+
+    resumed = cursordataset()
+    resumed.loadcursor(cursor)
+    assert resumed.cursor == {'file': 1, 'batch': 17, 'epoch': 2}
+    assert resumed.epoch == 2 and resumed.seed == 3
+    assert resumed.seek(0) and not resumed.seek(1)
+    restored = (torch.rand(3), np.random.rand(3), random.random())
+    assert torch.equal(restored[0], expected[0])
+    assert np.array_equal(restored[1], expected[1])
+    assert restored[2] == expected[2]
+
+def test_cursor_world_size():
+    data = cursordataset()
+    data.setcursor(1, 17)
+    cursor = data.getcursor()
+    resumed = cursordataset()
+    resumed.world_size = 2
+    resumed.loadcursor(cursor)
+    assert resumed.cursor == {'file': 0, 'batch': 0, 'epoch': 0}
@@ -0,0 +1,79 @@
+"""
+Weighted losses and the chunked loss of the transformer, run from the repository root: python -m pytest
+"""
+import math
+import pytest
+import torch
+import torch.nn.functional as F
+from types import SimpleNamespace
+from losses import losses, getloss
+from architectures.transformer.transformer_sim import Config, TSTransformer
+
+LOSSES = ['MSE', 'MAE', 'Huber', 'LC']
+
+def arguments(loss_function, discount=1.0, dim_weights=None):
+    return SimpleNamespace(loss_function=loss_function, loss_discount=discount, loss_dim_weights=dim_weights)
+
+def test_unweighted_matches_functional():
+    torch.manual_seed(0)
+    ysim, yact = torch.randn(4, 6, 3), torch.randn(4, 6, 3)
+    assert torch.allclose(getloss(arguments('MSE'), yact, ysim), F.mse_loss(ysim, yact))
+    assert torch.allclose(getloss(arguments('MAE'), yact, ysim), F.l1_loss(ysim, yact))
+    assert torch.allclose(getloss(arguments('Huber'), yact, ysim), F.huber_loss(ysim, yact))
+    assert torch.allclose(getloss(arguments('RMSE'), yact, ysim), (F.mse_loss(ysim, yact)*4)**0.5)
+    diff = ysim - yact
+    assert torch.allclose(getloss(arguments('LC'), yact, ysim), torch.log(torch.cosh(diff)).sum(), rtol=1e-5)
+
+def test_logcosh_large_errors():
+    ysim, yact = torch.tensor([[[200.0]]]), torch.zeros(1, 1, 1)
+    assert torch.allclose(getloss(arguments('LC'), yact, ysim), torch.tensor(200.0 - math.log(2.0)))
+
+def test_weights():
+    weights = losses(discount=0.5, dim_weights=[1.0, 2.0, 3.0]).getlossweights(4, 3, 'cpu')
+    discounts = torch.tensor([1.0, 0.5, 0.25, 0.125])
+    assert torch.allclose(weights, torch.outer(discounts/discounts.mean(), torch.tensor([1.0, 2.0, 3.0])))
+    assert torch.allclose(losses(dim_weights=[2.0]).getlossweights(4, 3, 'cpu'), torch.full((4, 3), 2.0))
+    with pytest.raises(ValueError):
+        losses(dim_weights=[1.0, 2.0]).getlossweights(4, 3, 'cpu')
+
+def test_weighted_values():
+    torch.manual_seed(0)
+    ysim, yact = torch.randn(4, 6, 3), torch.randn(4, 6, 3)
+    weights = losses(0.9, [1.0, 0.5, 2.0]).getlossweights(6, 3, 'cpu')
+    args = arguments('MSE', 0.9, [1.0, 0.5, 2.0])
+    assert torch.allclose(getloss(args, yact, ysim), (weights*(ysim - yact)**2).mean())
+    args.loss_function = 'MAE'
+    assert torch.allclose(getloss(args, yact, ysim), (weights*(ysim - yact).abs()).mean())
+    # the weights are normalized to mean 1 over time, a uniform error keeps its value
+    assert torch.allclose(getloss(arguments('MSE', 0.9), yact, yact + 0.5), torch.tensor(0.25))
+
+@pytest.mark.parametrize("loss_function", LOSSES)
+@pytest.mark.parametrize("discount", [1.0, 0.9])
+def test_chunks_add_up(loss_function, discount):
+    torch.manual_seed(0)
+    ysim, yact = torch.randn(4, 12, 3), torch.randn(4, 12, 3)
+    args = arguments(loss_function, discount)
+    chunks = sum(getloss(args, yact[:, i:i+5], ysim[:, i:i+5], i, 12) for i in range(0, 12, 5))
+    assert torch.allclose(chunks, getloss(args, yact, ysim), rtol=1e-5)
+
+@pytest.mark.parametrize("loss_function", LOSSES)
+@pytest.mark.parametrize("chunk", [4, 5])
+def test_chunked_forward(loss_function, chunk):
+    """
+    Chunked loss and gradients of the transformer match those of the full horizon
+    """
+    torch.manual_seed(0)
+    model = TSTransformer(Config(n_layer=1, n_head=2, n_embd=8, n_y=3, n_u=2, seq_len_ctx=4, seq_len_new=12,
+                                 bias=True, dropout=0.0))
+    y, u, u_new, y_new = torch.randn(2, 4, 3), torch.randn(2, 4, 2), torch.randn(2, 12, 2), torch.randn(2, 12, 3)
+    args = arguments(loss_function, 0.9)
+    lossfn = lambda ysim, yact, start, horizon: getloss(args, yact, ysim, start, horizon)
+
+    full = getloss(args, y_new, model(y, u, u_new))
+    fullgrads = torch.autograd.grad(full, list(model.parameters()))
+    chunked = model(y, u, u_new, y_new, lossfn, chunk)
+    chunkedgrads = torch.autograd.grad(chunked, list(model.parameters()))
+
+    assert torch.allclose(chunked, full, rtol=1e-5)
+    for g, ref in zip(chunkedgrads, fullgrads):
+        assert torch.allclose(g, ref, rtol=1e-4, atol=1e-6)
@@ -10,13 +10,17 @@ checks
 utils - process ???
 """
 
+import os
 import time
 import torch
 import wandb
 import sys
+from itertools import islice
 from datasets import *
 from utils import arguments
 from losses import getloss
+from evaluator import evaluator
+from prefetch import prefetcher
 from tqdm import tqdm
 from rich.progress import track
 
@@ -26,6 +30,11 @@ torch.cuda.empty_cache()
 
 args = arguments().parse_arguments()
 
+# the evaluator is forked before any tensor work, only rank 0 validates asynchronously
+evaluation = None
+if args.async_validation and int(os.environ.get('RANK', 0)) == 0:
+    evaluation = evaluator(args)
+
 if args.log_wandb:
     wandb.init(
     group='Ds_1',
@@ -39,7 +48,7 @@ print(datasets)
 torch.set_float32_matmul_precision("high")
 
 datasets.resolve_datasets()
-datasets.initialize_model()
+datasets.initialize_model(modelname=None if args.init_type=='scratch' else args.model_name)
 
 datasetdict = datasets.getgeneration()
 datadict = datasets.getmetadata()
@@ -47,75 +56,152 @@ datasets.getdataset()
 datasets.getmodel()
 
 datasets.settime(time.perf_counter())
-cum_validation_loss = 0
 modelargs, model, optimizer, scheduler = datasets.getmodel()
-
-for data in datadict['traindatalist']:
+net = datasets.distribute(model)
+events = datasets.openevents()
+if evaluation is not None:
+    evaluation.setmodel(modelargs, datasets.best_validation_loss[1])
+
+def validforward(yctxv, uctxv, unewv, ynewv, scalev):
+    """
+    Validation counterpart of dataset.gettrainforward, the loss is computed on denormalized trajectories
+    """
+    with datasets.autocast():
+        ysimv = model(yctxv, uctxv, unewv)
+
+    ysimv = datasets.denormalizestd(ysimv.float(), scalev[:, 0], scalev[:, 1])
+    ynewv = datasets.denormalizestd(ynewv, scalev[:, 0], scalev[:, 1])
+    return getloss(args, yact=ynewv, ysim=ysimv)
+
+def report(results):
+    """
+    Logs the results of the evaluator and checkpoints the best validated snapshot
+    """
+    for it, validation_loss_interval, isbest, state in results:
+        datasets.setlosslist(validation_loss=validation_loss_interval)
+        events.scalar('validation/loss', validation_loss_interval, it)
+        print(f"\n{it=} {validation_loss_interval=:.4f}\n")
+        if isbest:
+            datasets.setlosslist(best_validation_loss=validation_loss_interval)
+            datasets.setcheckpoint(iter=it, curtime=time.perf_counter(), state=state)
+            datasets.savecheckpoint(loss=validation_loss_interval)
+
+trainforward = datasets.gettrainforward(net)
+validforward = datasets.compile(validforward)
+
+# iter_num counts optimizer steps, every step accumulates the gradients of accumulation-steps micro-batches
+iter_num = datasets.iter
+accumulated_loss = 0
+tracker = datasets.gettracker()
+mixture = datasets.getsourcetracker()
+optimizer.zero_grad()
+laststep = time.perf_counter()
+print(f"Effective batch size {args.accumulation_steps*args.training_batch_size} = "
+      f"{args.accumulation_steps} micro-batches x {args.training_batch_size}\n")
+
+for fileindex, data in enumerate(datadict['traindatalist']):
+    if datasets.seek(fileindex):
+        continue
     datasets.load(data)
     datasets.configure_dataset()
 
     training_dataset, validation_dataset, test_dataset = datasets.getdataset()
+    if evaluation is not None:
+        evaluation.setdata(*datasets.getvalidation())
 
     model.train()
     
-    for iter_num, (ubatch,ybatch) in tqdm(enumerate(training_dataset, start=datasets.iter)):
-        ubatch, ybatch = ubatch.cuda(non_blocking=True), ybatch.cuda(non_blocking=True)
-        ubatch, umean, ustd = datasets.normalizestd(ubatch)
-        ybatch, ymean, ystd = datasets.normalizestd(ybatch)
-
-        uctx,unew = datasets.seperate_context(ubatch)
-        yctx,ynew = datasets.seperate_context(ybatch)
-
-        optimizer.zero_grad()
-        ysim = model(yctx, uctx, unew)
-        training_loss = getloss(args, yact=ynew, ysim=ysim)
-        datasets.setlosslist(training_loss=training_loss.item())
-        training_loss.backward()
-        optimizer.step()
-
-        if ((iter_num % args.validate_at) == 0) and iter_num>0:
+    nbatches = datasets.syncbatches(len(training_dataset))
+    sources = datasets.batchsources
+    # batchindex counts the batches of the file consumed so far, including those skipped on resume
+    for batchindex, (yctx, uctx, unew, ynew, scale) in enumerate(tqdm(prefetcher(islice(training_dataset, nbatches), datasets.device),
+                                                                      total=nbatches, disable=datasets.rank!=0,
+                                                                      miniters=args.log_at, mininterval=args.print_interval),
+                                                                 start=datasets.batchoffset+1):
+        training_loss, stepped = datasets.trainstep(trainforward, net, yctx, uctx, unew, ynew)
+        accumulated_loss += training_loss.detach()
+        if mixture is not None:
+            mixture.update(sources[batchindex-1], training_loss, len(ynew))
+        if not stepped:
+            continue
+
+        iter_num += 1
+        datasets.setcursor(fileindex, batchindex)
+        # the losses stay on the device, the host reads the step losses once every log-at steps
+        step_losses = tracker.update(accumulated_loss/args.accumulation_steps)
+        accumulated_loss = 0
+        events.scalar('train/lr', scheduler.get_last_lr()[0], iter_num)
+        events.timing('time/step', time.perf_counter() - laststep, iter_num)
+        laststep = time.perf_counter()
+        flushed_loss = None
+        if step_losses is not None:
+            for step, step_loss in enumerate(step_losses, start=iter_num - len(step_losses) + 1):
+                events.scalar('train/loss', step_loss, step)
+            flushed_loss = sum(step_losses)/len(step_losses)
+            datasets.setlosslist(training_loss=flushed_loss)
+            if mixture is not None:
+                persource = mixture.flush()
+                for name, (source_loss, rate) in persource.items():
+                    events.scalar(f'train/loss/{name}', source_loss, iter_num)
+                    events.scalar(f'throughput/{name}', rate, iter_num)
+
+        if evaluation is not None:
+            if (iter_num % args.validate_at) == 0:
+                evaluation.submit(iter_num, datasets.getstate(iter_num, time.perf_counter()))
+            report(evaluation.poll())
+
+        elif ((iter_num % args.validate_at) == 0) and iter_num>0 and not args.async_validation:
 
             model.eval()
             with torch.inference_mode():
 
-                for eval_iter, (ubatchv, ybatchv) in enumerate(validation_dataset):
+                # window-weighted mean over the whole validation set, reset at every validation
+                cum_validation_loss, validation_windows = 0, 0
+                for batchv in prefetcher(validation_dataset, datasets.device):
 
-                    ubatchv, ybatchv = ubatchv.cuda(non_blocking=True), ybatchv.cuda(non_blocking=True)
-                    ubatchv, umeanv, ustdv = datasets.normalizestd(ubatchv)
-                    ybatchv, ymeanv, ystdv = datasets.normalizestd(ybatchv)
-
-                    uctxv,unewv = datasets.seperate_context(ubatchv)
-                    yctxv,ynewv = datasets.seperate_context(ybatchv)
-                    
-                    ysimv = model(yctxv, uctxv, unewv)
-
-                    ysimv = datasets.denormalizestd(ysimv, ymeanv, ystdv)
-                    ynewv = datasets.denormalizestd(ynewv, ymeanv, ystdv)
-
-                    validation_loss = getloss(args, yact=ynewv, ysim=ysimv)
-                    cum_validation_loss += validation_loss.item()
+                    validation_loss = validforward(*batchv)
+                    cum_validation_loss += validation_loss.item()*len(batchv[0])
+                    validation_windows += len(batchv[0])
                     datasets.setlosslist(validation_loss=validation_loss.item())
 
-                validation_loss_interval = cum_validation_loss/eval_iter
+                validation_loss_interval = datasets.allreducemean(cum_validation_loss, validation_windows)
                 print(f"\n{iter_num=} {validation_loss_interval=:.4f}\n")
+                events.scalar('validation/loss', validation_loss_interval, iter_num)
+                for name, module in model.named_children():
+                    events.histogram(f'weights/{name}', torch.cat([p.flatten() for p in module.parameters()]), iter_num)
 
                 if validation_loss_interval < datasets.best_validation_loss[1]:
                     datasets.setlosslist(best_validation_loss=validation_loss_interval)
-                    datasets.setcheckpoint(iter=iter_num, curtime=time.perf_counter())   
+                    datasets.setcheckpoint(iter=iter_num, curtime=time.perf_counter())
+                    datasets.savecheckpoint(loss=validation_loss_interval)
 
             model.train()
 
         scheduler.step()
-        print(f"\n{iter_num=} {training_loss.item()=:.4f} {scheduler.get_last_lr()=}")
+        # resumable checkpoint mid-file, the canonical model file then always holds the newest cursor
+        if args.checkpoint_every and iter_num % args.checkpoint_every == 0:
+            datasets.setcheckpoint(iter_num, time.perf_counter())
+            datasets.savecheckpoint()
+        if flushed_loss is not None and datasets.rank == 0:
+            message = f"\n{iter_num=} training_loss={flushed_loss:.4f} {scheduler.get_last_lr()=}"
+            if mixture is not None:
+                message += ''.join(f"\n  {name} loss={source_loss:.4f} {rate:.1f} windows/s"
+                                   for name, (source_loss, rate) in persource.items())
+            tracker.log(message)
 
     datasets.setmodel(modelargs, model, optimizer, scheduler)
 
+    datasets.setcursor(fileindex+1, 0)
     datasets.setcheckpoint(iter_num, time.perf_counter())
-    torch.save(datasets.checkpoint, f'{datasets.modelpath}/{datasets.modelname}')
+    datasets.savecheckpoint()
     datasets.reset()
 
+if evaluation is not None:
+    report(evaluation.close())
+
 torch.cuda.empty_cache()
 datasets.gettime(time.perf_counter())
+datasets.cleanup()
 
 datasets.writer()
 datasets.logger()
@@ -0,0 +1,28 @@
+#!/bin/sh
+
+# Data-parallel training on CPU cores with the gloo backend, extra arguments are passed to train.py
+# One box:         ./train_ddp.sh -dn MG1 transformer -ctx 20
+# Several boxes:   NNODES=2 NODE_RANK=<0|1> MASTER_ADDR=<node 0 address> ./train_ddp.sh -dn MG1 transformer -ctx 20
+# Dataset mixture: ./train_ddp.sh -dn MG1+MG2 -dw 2,1 transformer -ctx 20
+# Every rank uses CORES/NPROC intra-op threads, the effective batch is NPROC*NNODES times the local one
+
+NNODES=${NNODES:-1}
+NODE_RANK=${NODE_RANK:-0}
+NPROC=${NPROC:-4}
+MASTER_ADDR=${MASTER_ADDR:-127.0.0.1}
+MASTER_PORT=${MASTER_PORT:-29500}
+CORES=$(nproc)
+
+export OMP_NUM_THREADS=${OMP_NUM_THREADS:-$(( CORES / NPROC > 0 ? CORES / NPROC : 1 ))}
+
+echo "Beginning Data-Parallel Training"
+echo "Node $NODE_RANK/$NNODES, $NPROC ranks with $OMP_NUM_THREADS threads each"
+
+torchrun --nnodes=$NNODES \
+         --node-rank=$NODE_RANK \
+         --nproc-per-node=$NPROC \
+         --master-addr=$MASTER_ADDR \
+         --master-port=$MASTER_PORT \
+         train.py --distributed --disable_cuda "$@"
+
+echo "Ending Data-Parallel Training"
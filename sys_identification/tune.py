@@ -0,0 +1,161 @@
+"""
+Tunes the training batch size, the validation batch size and the DataLoader worker count of a
+model config and dataset on the current host. The largest batches that fit the memory of the
+device are found by doubling and bisection, the worker count is the smallest one within 5% of
+the best end-to-end training throughput. The values are written to profiles/<hostname>.json and
+picked up by train.py, e.g.
+
+python tune.py -dn MG1 transformer -ctx 20
+"""
+
+import os
+import json
+import time
+import datetime
+import torch
+from itertools import islice
+from torch.utils.data import DataLoader
+from datasets import dataset
+from utils import arguments
+from prefetch import prefetcher
+from memory import resetpeak, peakmemory
+
+parser = arguments()
+args = parser.parse_arguments(profile=False)
+# every probe steps the optimizer so that its states are part of the measured peak
+args.accumulation_steps = 1
+
+datasets = dataset(args=args)
+datasets.resolve_datasets()
+datasets.initialize_model()
+datasets.load(datasets.traindatalist[0])
+datasets.configure_dataset()
+modelargs, model, optimizer, scheduler = datasets.getmodel()
+training_dataset, validation_dataset, test_dataset = datasets.getdataset()
+windows = training_dataset.dataset
+sample = windows[0]
+
+if datasets.device.type == 'cuda':
+    memory = torch.cuda.get_device_properties(datasets.device).total_memory
+else:
+    # a cpu allocation beyond the free memory swaps instead of failing, the budget is the available memory
+    memory = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+budget = args.tune_memory_fraction*memory
+peaks = {}
+
+def synthetic(batch_size):
+    return [x.unsqueeze(0).expand(batch_size, *x.shape).contiguous().to(datasets.device) for x in sample]
+
+trainforward = datasets.gettrainforward(model)
+
+def trainstep(yctx, uctx, unew, ynew, scale):
+    datasets.trainstep(trainforward, model, yctx, uctx, unew, ynew)
+
+def validstep(yctx, uctx, unew, ynew, scale):
+    with torch.inference_mode(), datasets.autocast():
+        model(yctx, uctx, unew)
+
+def affordable(step, batch_size):
+    """
+    On cpu a batch is only probed when the peak extrapolated from the largest fitting batch of the
+    step stays within the budget, on cuda running out of memory is caught by the probe
+    """
+    if datasets.device.type == 'cuda' or not peaks.get(step):
+        return True
+    fitting, peak = max(peaks[step].items())
+    return peak*batch_size/fitting < budget
+
+def fits(step, batch_size):
+    """
+    Runs two steps on a synthetic batch, the batch fits when neither runs out of memory and the
+    peak stays within the memory budget
+    """
+    if not affordable(step, batch_size):
+        return False
+    if datasets.device.type == 'cuda':
+        torch.cuda.empty_cache()
+    resetpeak(datasets.device)
+    try:
+        batch = synthetic(batch_size)
+        step(*batch)
+        step(*batch)
+        peak = peakmemory(datasets.device)
+    except torch.cuda.OutOfMemoryError:
+        return False
+    finally:
+        batch = None
+        optimizer.zero_grad(set_to_none=True)
+    if peak >= budget:
+        return False
+    peaks.setdefault(step, {})[batch_size] = peak
+    return True
+
+def largest(step, cap):
+    """
+    Largest fitting batch size up to cap, doubling then bisection
+    """
+    good, bad = 0, cap + 1
+    batch_size = 1
+    while batch_size <= cap and fits(step, batch_size):
+        good, batch_size = batch_size, batch_size*2
+    bad = min(batch_size, bad)
+    while bad - good > 1:
+        mid = (good + bad)//2
+        if fits(step, mid):
+            good = mid
+        else:
+            bad = mid
+    return max(good, 1)
+
+def throughput(batch_size, num_workers):
+    """
+    End-to-end training samples/s of the real loader and training step, the first batch is not
+    timed since it includes the start of the workers
+    """
+    loader = DataLoader(windows, batch_size=batch_size, shuffle=True, drop_last=True,
+                        pin_memory=datasets.device.type=='cuda', num_workers=num_workers)
+    batches = iter(prefetcher(islice(loader, args.tune_steps + 1), datasets.device))
+    trainstep(*next(batches))
+    ts = time.perf_counter()
+    steps = 0
+    for batch in batches:
+        trainstep(*batch)
+        steps += 1
+    if datasets.device.type == 'cuda':
+        torch.cuda.synchronize()
+    return steps*batch_size/max(time.perf_counter() - ts, 1e-9)
+
+model.train()
+cap = min(args.tune_max_batch, len(windows))
+training_batch_size = largest(trainstep, cap)
+print(f'Largest training batch --> {training_batch_size}')
+validation_batch_size = largest(validstep, min(args.tune_max_batch, max(len(validation_dataset.dataset), 1)))
+print(f'Largest validation batch --> {validation_batch_size}')
+
+candidates = sorted({0} | {2**i for i in range(8) if 2**i <= (os.cpu_count() or 1)})
+rates = {}
+for num_workers in candidates:
+    rates[num_workers] = throughput(training_batch_size, num_workers)
+    print(f'{num_workers} workers --> {rates[num_workers]:.1f} samples/s')
+best = max(rates.values())
+num_workers = min(n for n, rate in rates.items() if rate >= 0.95*best)
+print(f'Chosen worker count --> {num_workers}')
+
+path = parser.profilepath()
+os.makedirs(os.path.dirname(path), exist_ok=True)
+try:
+    with open(path, 'r') as f:
+        profiles = json.load(f)
+except (FileNotFoundError, json.JSONDecodeError):
+    profiles = {}
+profiles[parser.profilekey(args)] = {
+    "training_batch_size" : training_batch_size,
+    "validation_batch_size" : validation_batch_size,
+    "num_workers" : num_workers,
+    "samples_per_s" : round(rates[num_workers], 1),
+    "tuned" : datetime.datetime.now().isoformat(timespec='seconds')
+}
+with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+    json.dump(profiles, f, ensure_ascii=False, sort_keys=True, indent=4)
+os.replace(f'{path}.tmp', path)
+print(f'Profile written to:\n{path}\n')
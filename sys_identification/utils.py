@@ -22,6 +22,10 @@ from scipy.ndimage import uniform_filter1d
 
 from pathlib import Path
 import argparse
+import socket
+import sys
+import json
+import os
 
 from architectures.transformer.transformer_sim import Config, TSTransformer
 from metrics import *
@@ -44,47 +48,111 @@ class arguments():
     def __str__(self):
         return f'Parser Object instantiated'
 
-    def parse_arguments(self):
+    def parse_arguments(self, profile=True):
         """
         Possible arguments are: COULD BE DEPRECATED
         --
+        The command line is parsed, params is the default command line of scripts run without arguments
+        Batch sizes and the worker count left at their defaults are taken from the tuned profile
+        of the host when one exists for the model config - refer to tune.py
         """
         self.parser.add_argument('-init','--init-type', type=str, default='scratch', choices=['scratch',
                                                                                               'resume',
                                                                                               'pretrained'],
                             help='init from (scratch|resume|pretrained)')
         self.parser.add_argument('-dn','--data-name', type=str, default='MG1_rep',
-                            help='name of the file in which the models are to be saved')
+                            help='dataset to train on, datasets joined by + (MG1+MG2) are mixed in one run')
+        self.parser.add_argument('-dw','--data-weights', type=lambda w: [float(x) for x in w.split(',')], default=None,
+                            help='comma separated mixing weights of the datasets of --data-name (2,1), equal weights by default')
         self.parser.add_argument('-mn','--model-name', type=str, default='',
                             help='name of the model in which the models are to be saved')
         self.parser.add_argument('-dc','--disable_cuda', action='store_true',
                             help="tensor process device")   
+        self.parser.add_argument('-ddp','--distributed', action='store_true',
+                            help="data-parallel training over torchrun processes on the gloo backend - refer to train_ddp.sh")
+        self.parser.add_argument('-amp','--mixed-precision', action='store_true',
+                            help="autocast mixed precision, bf16 on cpu and fp16 with gradient scaling on cuda")
+        self.parser.add_argument('-cmp','--compile', action='store_true',
+                            help="torch.compile the forward, loss and normalization steps, eager on failure")
+        self.parser.add_argument('-cmpm','--compile-mode', type=str, default='default', choices=['default',
+                                                                                             'reduce-overhead',
+                                                                                             'max-autotune'],
+                            help="torch.compile mode (default|reduce-overhead|max-autotune)")
+        self.parser.add_argument('-ac','--activation-checkpointing', action='store_true',
+                            help="recompute the encoder and decoder blocks in the backward pass instead of storing their activations")
+        self.parser.add_argument('-lchk','--loss-chunk', type=int, default=0,
+                            help="horizon steps per chunk of the checkpointed lm_head and training loss (all losses but RMSE), 0 disables chunking")
+        self.parser.add_argument('-ema','--ema-decay', type=float, default=0.0,
+                            help="decay of the exponential moving average of the weights kept with the checkpoints, 0 disables it")
+        self.parser.add_argument('-emak','--ema-every', type=int, default=1,
+                            help="optimizer steps between EMA updates")
+        self.parser.add_argument('-uema','--use-ema', action='store_true',
+                            help="load the EMA weights of a checkpoint instead of the trained weights")
         self.parser.add_argument('-im','--include-mass-vectors', action='store_true',
                             help="includes mass vectors in training")     
         self.parser.add_argument('-id','--include-control-diffs', action='store_true',
                             help="include control derivatives in training")
+        self.parser.add_argument('-aug','--augment-noise', type=float, default=0.0,
+                            help="std of the gaussian noise added to the normalized model inputs in training")
         self.parser.add_argument('-nj','--num-of-joints', type=int, default=7,
                             help="umber of joints of interest of the dataset")   
         self.parser.add_argument('-nc','--num-of-coordinates', type=int, default=14,
                             help="number of coordinates of interest of the dataset")
         self.parser.add_argument('-tsi','--total-sim-iterations', type=int, default=1000,
                             help="number of total simulation iterations of the dataset")                     
+        self.parser.add_argument('-hdo','--orientation-dimension', type=str, default='4D', choices=['3D',
+                                                                                                 '4D',
+                                                                                                 '6D'],
+                            help="orientation resolved from the stored quaternions at load time (3D|4D|6D)")
         
         self.parser.add_argument('-trb','--training-batch-size',type=int,default=8,
                             help='batch size for training data')
         self.parser.add_argument('-vlb','--validation-batch-size',type=int,default=8,
                             help='batch size for validation data')
+        self.parser.add_argument('-nw','--num-workers',type=int,default=10,
+                            help='DataLoader worker processes of the training and validation data')
+        self.parser.add_argument('-np','--no-profile', action='store_true',
+                            help='ignore the tuned profile of the host')
+        self.parser.add_argument('-tmb','--tune-max-batch',type=int,default=1024,
+                            help='largest batch size probed by tune.py')
+        self.parser.add_argument('-tmf','--tune-memory-fraction',type=float,default=0.9,
+                            help='fraction of the device memory a probed batch may use in tune.py')
+        self.parser.add_argument('-tst','--tune-steps',type=int,default=10,
+                            help='timed training steps per probe in tune.py')
+        self.parser.add_argument('-as','--accumulation-steps',type=int,default=1,
+                            help='micro-batches of training-batch-size accumulated per optimizer step')
         self.parser.add_argument("-lf",'--loss-function', type=str, default='MSE', choices=["MAE",
                                                                                          "MSE",
-                                                                                         "Huber"],
-                            help="loss function: 'MAE'-'MSE'-'Huber'")
+                                                                                         "Huber",
+                                                                                         "RMSE",
+                                                                                         "LC"],
+                            help="loss function: 'MAE'-'MSE'-'Huber'-'RMSE'-'LC' (log-cosh)")
+        self.parser.add_argument("-ldis",'--loss-discount', type=float, default=1.0,
+                            help="multiplies the loss of the t^th predicted step by discount**t (normalized to mean 1), 1 disables it")
+        self.parser.add_argument("-ldw",'--loss-dim-weights', type=float, nargs='+', default=None,
+                            help="loss weight of every output dimension, a single value applies to all")
         
         self.parser.add_argument("-evint",'--eval-interval', type=int, default=50,
                             help='evaluation interval')
         self.parser.add_argument("-evitr",'--validate-at', type=int, default=50,
                             help='evaluation iteraration')
+        self.parser.add_argument("-vbud",'--validation-budget', type=int, default=0,
+                            help='windows of a fixed validation set stratified over files and randomization settings, 0 validates on 20%% of each file')
+        self.parser.add_argument("-av",'--async-validation', action='store_true',
+                            help='validate weight snapshots in a separate evaluator process while training continues')
+        self.parser.add_argument("-evth",'--eval-threads', type=int, default=2,
+                            help='cpu threads of the asynchronous evaluator process')
         self.parser.add_argument("-il",'--log-at', type=int, default=50,
                             help='log to wandb at iteration num')
+        self.parser.add_argument("-pint",'--print-interval', type=float, default=5.0,
+                            help='minimum seconds between training progress prints')
+
+        self.parser.add_argument("-kl",'--keep-last', type=int, default=1,
+                            help='number of latest checkpoints kept under models/checkpoints')
+        self.parser.add_argument("-kb",'--keep-best', type=int, default=1,
+                            help='number of lowest validation loss checkpoints kept under models/checkpoints')
+        self.parser.add_argument("-cke",'--checkpoint-every', type=int, default=500,
+                            help='optimizer steps between resumable checkpoints within a file, 0 checkpoints at file ends only')
 
         self.parser.add_argument("-lr",'--learning-rate', type=float, default=5e-3,
                             help='learning rate')
@@ -153,9 +221,64 @@ class arguments():
                     help='number of wanted test trajectories for each file')
         
 
-        args = self.parser.parse_args()
+        self.argv = sys.argv[1:] or self.params
+        args = self.parser.parse_args(self.argv)
+        args.data_sources = args.data_name.split('+')
+        if args.loss_chunk and args.loss_function == 'RMSE':
+            self.parser.error('--loss-chunk sums the losses of the chunks, the square root of RMSE does not split over chunks')
+        if args.data_weights is not None and (len(args.data_weights) != len(args.data_sources)
+                                              or min(args.data_weights) < 0 or sum(args.data_weights) <= 0):
+            self.parser.error(f'--data-weights needs {len(args.data_sources)} non-negative weights with a positive sum')
+        if profile and not args.no_profile:
+            self.applyprofile(args)
         return args
 
+    def profilepath(self):
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles', f'{socket.gethostname()}.json')
+
+    def profilekey(self, args):
+        """
+        Profiles are kept per model config, dataset and device
+        """
+        device = 'cuda' if not args.disable_cuda and torch.cuda.is_available() else 'cpu'
+        # the model options belong to the subcommand and are missing for the others
+        model = '_'.join(str(getattr(args, key, 0)) for key in ('context', 'n_embd', 'n_head', 'n_layer'))
+        return (f'{args.subcommand}_{args.data_name}_{model}_{args.total_sim_iterations}_{args.orientation_dimension}_'
+                f'{int(args.mixed_precision)}{int(args.activation_checkpointing)}_{device}')
+
+    def given(self):
+        """
+        Destinations of the options given on the parsed command line, the command line is parsed
+        again with every default suppressed so that a value equal to its default still counts
+        """
+        defaults = {action: action.default for action in self.parser._actions}
+        for action in defaults:
+            action.default = argparse.SUPPRESS
+        try:
+            namespace, _ = self.parser.parse_known_args(self.argv)
+        finally:
+            for action, default in defaults.items():
+                action.default = default
+        return set(vars(namespace))
+
+    def applyprofile(self, args):
+        """
+        Sets the tuned batch sizes and worker count of the host, values given on the command line are kept
+        """
+        try:
+            with open(self.profilepath(), 'r') as f:
+                profile = json.load(f).get(self.profilekey(args))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if profile is None:
+            return
+        given = self.given()
+        for key in ('training_batch_size', 'validation_batch_size', 'num_workers'):
+            if key in profile and key not in given:
+                setattr(args, key, profile[key])
+        print(f'Tuned profile of {socket.gethostname()} --> training batch {args.training_batch_size}, '
+              f'validation batch {args.validation_batch_size}, {args.num_workers} workers')
+
 class preprocess(dataset):
     """
     Preprocessing class used to manipulate created models and datasets. Current use is only
@@ -262,8 +385,8 @@ class preprocess(dataset):
     def resolve_datasets(self, eval=True):
         return super().resolve_datasets(eval)
     
-    def initialize_model(self, modelname=True):
-        return super().initialize_model(modelname)
+    def initialize_model(self, modelname=True, eval=True):
+        return super().initialize_model(modelname, eval)
     
     def configure_dataset(self, eval=True):
         return super().configure_dataset(eval)